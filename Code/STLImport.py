@@ -9,11 +9,52 @@ Authors: Max Idermark & Mats Gard
 import numpy as np
 import trimesh
 import matplotlib.pyplot as plt
+import itertools
 import json
+import os
 import time
+import multiprocessing
 
+from scipy import ndimage
 from scipy.spatial.transform import Rotation
 
+import instrumentation
+
+from progress import check_cancelled
+
+
+# Available backends for stl_to_voxel_array
+VOXEL_BACKENDS = ("rays", "scanline", "winding")
+
+# Header of the packed voxel format: magic followed by the grid shape as three
+# little-endian uint64
+PACKED_VOXEL_MAGIC = b"STLVOX01"
+PACKED_VOXEL_HEADER = np.dtype([("magic", "S8"), ("shape", "<u8", (3,))])
+
+# Record of one triangle in a binary STL file, after the 80 byte header and the
+# uint32 triangle count
+BINARY_STL_HEADER_SIZE = 84
+BINARY_STL_DTYPE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)),
+                             ("attributes", "<u2")])
+
+# Smallest number of slabs a run is split into when it reports progress or can
+# be cancelled
+PROGRESS_SLABS = 16
+
+# Largest work of one of these slabs, about half a second on one core, which
+# bounds the time between two progress reports or cancel checks whatever the
+# grid size: rays cast by the "rays" and "scanline" backends and (voxel center,
+# triangle) pairs of the "winding" backend. A slab holds at least one x plane.
+SLAB_WORK = {"rays": 4096, "scanline": 16384, "winding": 8 * 1024**2}
+
+# Approximate number of bytes of temporaries the winding number backend needs
+# for every (voxel center, triangle) pair in a batch
+WINDING_BYTES_PER_PAIR = 256
+
+# Triangles spanning at most this many more cells per axis are marked on the
+# cells of progressive voxelization all at once, larger ones one by one
+SURFACE_CELL_SPAN = 3
+
 
 def rescale_mesh(stl_mesh, voxel_size, target_scale, height_dimension=2):
     """Rescales an STL mesh file to a certain height. Millimeters is used.
@@ -96,25 +137,135 @@ def align_tallest_dimension_with_z(stl_mesh):
     return set_z_axis_mesh(stl_mesh, tallest_dim_index)
 
 
-def stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=10, seed=0) -> np.array:
+def stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=10, seed=0,
+                       backend="rays", max_batch_bytes=256 * 1024**2,
+                       workers=1, progress=None, cancel=None) -> np.array:
     """
     Converts an STL mesh into a voxel representation. Voxels are set to True if their
-    centers are within the geometry of the mesh. One ray is always towards the center of the mesh, 
-    the remaining are randomly generated.
+    centers are within the geometry of the mesh.
+
+    Three backends are available:
+        "rays": One ray per voxel is always cast towards the center of the mesh,
+            the remaining are randomly generated. All rays must agree that the
+            voxel center is inside.
+        "scanline": One ray is cast per (x, y) column of the grid and the inside
+            intervals along the column are filled by parity. The cost depends on
+            the number of columns instead of the number of voxels.
+        "winding": The generalized winding number of the mesh is computed for 
+            every voxel center. Tolerates open and self-intersecting meshes 
+            such as 3D scans.
 
     Args:
         stl_mesh: The input STL mesh.
         voxel_size: The size of the voxel in each dimension.
         num_random_rays: The number of random rays to cast from each voxel (additional to the one towards the center).
-        seed: The seed for the random number generator.
+            Only used by the "rays" backend.
+        seed: The seed for the random number generator. Only used by the "rays" backend.
+        backend: The voxelization backend, "rays", "scanline" or "winding".
+        max_batch_bytes: Upper bound on the memory used by one batch of 
+            (voxel center, triangle) pairs. Only used by the "winding" backend.
+        workers: The number of processes to use. With more than one worker 
+            the grid is split into slabs along the x axis which are voxelized
+            in a process pool and stitched back together. The result is 
+            identical to the single process run.
+        progress: Optional callable progress(done, total), called with the 
+            number of slabs voxelized so far.
+        cancel: Optional CancelToken. The voxelization stops with 
+            ConversionCancelled after the slab that is running when it is 
+            cancelled. The slabs are sized by their work, see SLAB_WORK.
 
     Returns:
         A 3D numpy array representing the voxelized mesh.
     """
+    if backend not in VOXEL_BACKENDS:
+        raise ValueError("Invalid backend. Must be one of: " +
+                         ", ".join(VOXEL_BACKENDS))
 
-    # Set the seed for the random number generator
-    np.random.seed(seed)
+    min_coords, grid_dimensions, grid_offset = voxel_grid_geometry(
+        stl_mesh, voxel_size)
+
+    options = (backend, voxel_size, min_coords, grid_dimensions, grid_offset,
+               num_random_rays, seed, max_batch_bytes)
+
+    instrumentation.count("voxels", int(np.prod(grid_dimensions)))
+    if backend == "scanline":
+        instrumentation.count("rays_cast", int(grid_dimensions[0] * grid_dimensions[1]))
+
+    if workers > 1 and grid_dimensions[0] > 1:
+        return _voxelize_slabs_parallel(stl_mesh, options, workers, progress, cancel)
+
+    if progress is None and cancel is None:
+        return _voxelize_slab(stl_mesh, options, (0, grid_dimensions[0]))
+
+    # Voxelize in slabs to be able to report progress and stop in between
+    slab_ranges = _work_slab_ranges(stl_mesh, options, PROGRESS_SLABS)
+    slabs = []
+    for x_range in slab_ranges:
+        check_cancelled(cancel)
+        slabs.append(_voxelize_slab(stl_mesh, options, x_range))
+        if progress is not None:
+            progress(len(slabs), len(slab_ranges))
 
+    return np.concatenate(slabs, axis=0)
+
+
+def iter_voxel_slabs(stl_mesh, voxel_size, slab_width, num_random_rays=10, seed=0,
+                     backend="rays", max_batch_bytes=256 * 1024**2,
+                     progress=None, cancel=None):
+    """
+    Voxelizes an STL mesh one slab of the grid at a time along the x axis, so
+    that the whole grid never has to be held as a dense array. Used to fill
+    sparse grids, see sparse_grid.stl_to_chunked_grid. The slabs are identical
+    to the corresponding parts of the result of stl_to_voxel_array.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the voxel in each dimension.
+        slab_width: The number of x indices per slab.
+        num_random_rays, seed, backend, max_batch_bytes, progress, cancel: See
+            stl_to_voxel_array. Progress is reported per slab.
+
+    Yields:
+        Tuples (x_start, slab) with the index of the first x plane of the slab
+        and a 3D numpy array with the voxels of the slab.
+    """
+    if backend not in VOXEL_BACKENDS:
+        raise ValueError("Invalid backend. Must be one of: " +
+                         ", ".join(VOXEL_BACKENDS))
+
+    min_coords, grid_dimensions, grid_offset = voxel_grid_geometry(
+        stl_mesh, voxel_size)
+
+    options = (backend, voxel_size, min_coords, grid_dimensions, grid_offset,
+               num_random_rays, seed, max_batch_bytes)
+
+    instrumentation.count("voxels", int(np.prod(grid_dimensions)))
+    if backend == "scanline":
+        instrumentation.count("rays_cast", int(grid_dimensions[0] * grid_dimensions[1]))
+
+    num_x = int(grid_dimensions[0])
+    x_starts = range(0, num_x, slab_width)
+    for done, x_start in enumerate(x_starts, start=1):
+        check_cancelled(cancel)
+        yield x_start, _voxelize_slab(stl_mesh, options,
+                                      (x_start, min(x_start + slab_width, num_x)))
+        if progress is not None:
+            progress(done, len(x_starts))
+
+
+def voxel_grid_geometry(stl_mesh, voxel_size):
+    """
+    Calculates the layout of the voxel grid that encloses the mesh. The grid is
+    centered on the bounding box of the mesh, so any padding (grid_offset) is 
+    split evenly on both sides.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the voxel in each dimension.
+
+    Returns:
+        A tuple (min_coords, grid_dimensions, grid_offset).
+    """
     # Calculate the bounding box of the STL mesh (returns x y z)
     min_coords = stl_mesh.bounds[0]
     max_coords = stl_mesh.bounds[1]
@@ -128,15 +279,201 @@ def stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=10, seed=0) -> np.a
 
     print("Grid dimension: " + str(grid_dimensions))
 
-    # Initialize the voxel grid
-    voxel_grid = np.zeros(grid_dimensions, dtype=bool)
-
     # Calculate the offset to align the voxel grid with the pyramid's centroid
     grid_offset = (grid_dimensions * voxel_size -
                    (max_coords - min_coords)) / 2
 
+    return min_coords, grid_dimensions, grid_offset
+
+
+def voxel_centers(voxel_size, min_coords, grid_dimensions, grid_offset,
+                  x_range=None):
+    """
+    Calculates the coordinates of the voxel centers along each axis.
+
+    Args:
+        voxel_size: The size of the voxel in each dimension.
+        min_coords, grid_dimensions, grid_offset: The grid layout as returned
+            by voxel_grid_geometry.
+        x_range: Optional (start, stop) tuple limiting the x indices.
+
+    Returns:
+        A list of three 1D arrays with the x, y and z center coordinates.
+    """
+    centers = [min_coords[i] + voxel_size[i] * (np.arange(grid_dimensions[i]) + 0.5)
+               + grid_offset[i] for i in range(3)]
+
+    if x_range is not None:
+        centers[0] = centers[0][x_range[0]:x_range[1]]
+
+    return centers
+
+
+# Mesh used by the voxelization worker processes. It is set once per worker,
+# either inherited when the pool is forked or through _init_slab_worker, so
+# the mesh is never sent along with the individual slab tasks.
+_slab_mesh = None
+
+
+def _init_slab_worker(stl_mesh):
+    """
+    Initializes a voxelization worker process with the shared mesh.
+    """
+    global _slab_mesh
+    _slab_mesh = stl_mesh
+
+
+def _voxelize_slab_task(task):
+    """
+    Voxelizes one slab in a worker process using the shared mesh.
+    """
+    options, x_range = task
+    return _voxelize_slab(_slab_mesh, options, x_range)
+
+
+def _voxelize_slab(stl_mesh, options, x_range) -> np.array:
+    """
+    Voxelizes the slab of the grid with x indices in [x_range[0], x_range[1]).
+
+    Args:
+        stl_mesh: The input STL mesh.
+        options: Tuple (backend, voxel_size, min_coords, grid_dimensions, 
+            grid_offset, num_random_rays, seed, max_batch_bytes).
+        x_range: The (start, stop) x indices of the slab.
+
+    Returns:
+        A 3D numpy array with the voxels of the slab.
+    """
+    (backend, voxel_size, min_coords, grid_dimensions, grid_offset,
+     num_random_rays, seed, max_batch_bytes) = options
+
+    if backend == "scanline":
+        return _voxelize_scanline(stl_mesh, voxel_size, min_coords,
+                                  grid_dimensions, grid_offset, x_range)
+
+    if backend == "winding":
+        return _voxelize_winding(stl_mesh, voxel_size, min_coords,
+                                 grid_dimensions, grid_offset, x_range,
+                                 max_batch_bytes)
+
+    return _voxelize_rays(stl_mesh, voxel_size, min_coords, grid_dimensions,
+                          grid_offset, x_range, num_random_rays, seed)
+
+
+def _slab_ranges(num_x, num_slabs):
+    """
+    Splits the x indices [0, num_x) into at most num_slabs (start, stop) ranges
+    of nearly equal size.
+    """
+    num_slabs = max(1, min(num_x, num_slabs))
+    bounds = np.linspace(0, num_x, num_slabs + 1).astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(num_slabs)]
+
+
+def _work_slab_ranges(stl_mesh, options, min_slabs):
+    """
+    Splits the x indices of the grid into at least min_slabs slabs, and into more
+    where needed so that no slab holds more work than SLAB_WORK of its backend.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        options: The options of _voxelize_slab.
+        min_slabs: The smallest number of slabs.
+
+    Returns:
+        The (start, stop) x indices of the slabs, see _slab_ranges.
+    """
+    backend, num_random_rays = options[0], options[5]
+    num_x, num_y, num_z = (int(dim) for dim in options[3])
+
+    if backend == "scanline":
+        plane_work = num_y
+    elif backend == "winding":
+        plane_work = num_y * num_z * len(stl_mesh.triangles)
+    else:
+        # Rays stop at the first one that finds the voxel outside
+        plane_work = num_y * num_z * (num_random_rays + 1)
+
+    planes_per_slab = max(1, SLAB_WORK[backend] // max(1, plane_work))
+    return _slab_ranges(num_x, max(min_slabs, -(-num_x // planes_per_slab)))
+
+
+def _voxelize_slabs_parallel(stl_mesh, options, workers, progress=None,
+                             cancel=None) -> np.array:
+    """
+    Splits the grid into slabs along the x axis, voxelizes them in a process
+    pool and stitches the slabs back into one grid. See stl_to_voxel_array for
+    progress and cancel.
+    """
+    global _slab_mesh
+
+    backend = options[0]
+
+    # A few slabs per worker evens out slabs with more geometry than others
+    tasks = [(options, x_range)
+             for x_range in _work_slab_ranges(stl_mesh, options, workers * 4)]
+
+    # Build the ray acceleration structure once so the workers inherit it
+    if backend in ("rays", "scanline"):
+        stl_mesh.ray.intersects_any(ray_origins=[stl_mesh.centroid],
+                                    ray_directions=[[0.0, 0.0, 1.0]])
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        # The forked workers share the mesh with the parent
+        context = multiprocessing.get_context("fork")
+        _slab_mesh = stl_mesh
+        pool = context.Pool(workers)
+    else:
+        # The mesh is pickled once per worker, not once per slab
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(workers, initializer=_init_slab_worker,
+                            initargs=(stl_mesh,))
+
+    slabs = []
+    try:
+        # The slabs arrive in order as they finish
+        for slab in pool.imap(_voxelize_slab_task, tasks):
+            slabs.append(slab)
+            if progress is not None:
+                progress(len(slabs), len(tasks))
+            check_cancelled(cancel)
+        pool.close()
+    finally:
+        # Stops the remaining slabs if the run was cancelled
+        pool.terminate()
+        pool.join()
+        _slab_mesh = None
+
+    return np.concatenate(slabs, axis=0)
+
+
+def _voxelize_rays(stl_mesh, voxel_size, min_coords, grid_dimensions,
+                   grid_offset, x_range, num_random_rays, seed) -> np.array:
+    """
+    Voxelizes the mesh by casting several rays from every voxel center. See 
+    stl_to_voxel_array and _voxelize_slab for the meaning of the arguments.
+    """
+
+    # Set the seed for the random number generator
+    np.random.seed(seed)
+
+    # Skip the random numbers drawn for the voxels before this slab, so that 
+    # every voxel gets the same rays as in a run over the whole grid
+    skipped_draws = x_range[0] * grid_dimensions[1] * \
+        grid_dimensions[2] * num_random_rays * 2
+    while skipped_draws > 0:
+        draws = min(skipped_draws, 2**20)
+        np.random.random_sample(draws)
+        skipped_draws -= draws
+
+    # Initialize the voxel grid
+    voxel_grid = np.zeros((x_range[1] - x_range[0], grid_dimensions[1],
+                           grid_dimensions[2]), dtype=bool)
+
+    rays_cast = 0
+
     # Loop through each voxel in the grid
-    for x in range(grid_dimensions[0]):
+    for x in range(x_range[0], x_range[1]):
         for y in range(grid_dimensions[1]):
             for z in range(grid_dimensions[2]):
                 # Calculate the coordinates of the voxel's center
@@ -161,6 +498,7 @@ def stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=10, seed=0) -> np.a
 
                 # Check each ray
                 for ray_direction in ray_directions:
+                    rays_cast += 1
                     # Perform a ray-mesh intersection query
                     locations, index_ray, index_tri = stl_mesh.ray.intersects_location(
                         ray_origins=[voxel_center], ray_directions=[
@@ -173,17 +511,431 @@ def stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=10, seed=0) -> np.a
                         break  # No need to check the rest of the rays
 
                 if all_rays_inside:
-                    voxel_grid[x, y, z] = 1
+                    voxel_grid[x - x_range[0], y, z] = 1
+
+    instrumentation.count("rays_cast", rays_cast)
 
     return voxel_grid
 
 
+def _voxelize_scanline(stl_mesh, voxel_size, min_coords, grid_dimensions,
+                       grid_offset, x_range) -> np.array:
+    """
+    Voxelizes the mesh by casting one ray upwards through every (x, y) column of
+    the grid. The hit depths of each column are sorted and every surface 
+    crossing toggles inside/outside for the voxel centers above it. See 
+    stl_to_voxel_array and _voxelize_slab for the meaning of the arguments.
+    """
+    # Voxel center coordinates along each axis
+    centers = voxel_centers(voxel_size, min_coords, grid_dimensions,
+                            grid_offset, x_range)
+    num_x, num_y, num_z = [len(axis_centers) for axis_centers in centers]
+
+    # One ray per column, starting one voxel below the mesh and pointing up
+    column_x, column_y = np.meshgrid(centers[0], centers[1], indexing="ij")
+    index_ray, depths = _column_crossings(
+        stl_mesh, np.column_stack((column_x.ravel(), column_y.ravel())),
+        min_coords[2] - voxel_size[2])
+
+    # Count the surface crossings below each voxel center, per column
+    crossings = np.zeros((num_x * num_y, num_z + 1), dtype=np.int32)
+    if len(depths) > 0:
+        # Index of the first voxel center above each crossing
+        first_voxel = np.searchsorted(centers[2], depths)
+        np.add.at(crossings, (index_ray, first_voxel), 1)
+
+    # Inside where an odd number of crossings lie below the voxel center
+    inside = (np.cumsum(crossings[:, :num_z], axis=1) % 2).astype(bool)
+
+    return inside.reshape(num_x, num_y, num_z)
+
+
+def _column_crossings(stl_mesh, columns, z_start):
+    """
+    Casts one ray upwards through every column and returns where it crosses
+    the surface, see _voxelize_scanline.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        columns: (n, 2) array of the x, y coordinates of the columns.
+        z_start: The z coordinate the rays start at, below the mesh.
+
+    Returns:
+        A tuple (index_ray, depths) of the column and the z coordinate of every
+        crossing, sorted by column and then by depth. Every column has an even
+        number of crossings.
+    """
+    ray_origins = np.column_stack((columns, np.full(len(columns), z_start)))
+    ray_directions = np.tile([0.0, 0.0, 1.0], (len(columns), 1))
+
+    locations, index_ray, _ = stl_mesh.ray.intersects_location(
+        ray_origins=ray_origins, ray_directions=ray_directions, multiple_hits=True)
+    if len(locations) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    # Sort the hits by column and then by depth
+    depths = locations[:, 2]
+    order = np.lexsort((depths, index_ray))
+    index_ray = index_ray[order]
+    depths = depths[order]
+
+    # A ray passing through a shared edge or vertex reports the same
+    # crossing once per triangle, so drop duplicated depths in a column
+    tolerance = 1e-9 * max(1.0, float(np.max(np.abs(depths))))
+    unique = np.ones(len(depths), dtype=bool)
+    unique[1:] = (index_ray[1:] != index_ray[:-1]) | \
+        (np.diff(depths) > tolerance)
+    index_ray = index_ray[unique]
+    depths = depths[unique]
+
+    # A column with an odd number of crossings has grazed an edge or
+    # passed through a hole, drop its last crossing so that it does not
+    # stay inside all the way to the top of the grid
+    last_hit = np.ones(len(depths), dtype=bool)
+    last_hit[:-1] = index_ray[1:] != index_ray[:-1]
+    hits_per_column = np.bincount(index_ray, minlength=len(columns))
+    keep = ~(last_hit & (hits_per_column[index_ray] % 2 == 1))
+
+    return index_ray[keep], depths[keep]
+
+
+def _voxelize_winding(stl_mesh, voxel_size, min_coords, grid_dimensions,
+                      grid_offset, x_range, max_batch_bytes) -> np.array:
+    """
+    Voxelizes the mesh by computing the generalized winding number at every 
+    voxel center. A center is inside when the absolute winding number is at 
+    least 0.5, which also works for meshes with holes or with all normals 
+    pointing inwards. The centers and triangles are processed in batches so 
+    that no more than max_batch_bytes of temporaries are alive at once. See 
+    stl_to_voxel_array and _voxelize_slab for the meaning of the other 
+    arguments.
+    """
+    # Coordinates of every voxel center, in the same order as the grid
+    centers = voxel_centers(voxel_size, min_coords, grid_dimensions,
+                            grid_offset, x_range)
+    points = np.stack(np.meshgrid(*centers, indexing="ij"), axis=-1).reshape(-1, 3)
+
+    triangles = np.asarray(stl_mesh.triangles, dtype=np.float64)
+    inside = _winding_inside(points, triangles, max_batch_bytes)
+
+    return inside.reshape([len(axis_centers) for axis_centers in centers])
+
+
+def _winding_inside(points, triangles, max_batch_bytes) -> np.array:
+    """
+    Determines which points are inside the mesh by their generalized winding
+    number, in batches of at most max_batch_bytes of temporaries. See
+    _voxelize_winding.
+
+    Args:
+        points: (n, 3) array of query points.
+        triangles: (m, 3, 3) array of triangle vertices.
+        max_batch_bytes: The memory cap of one batch.
+
+    Returns:
+        An (n,) boolean array, True for the points inside.
+    """
+    # Number of pairs that fit in the memory cap
+    pairs_per_batch = max(1, int(max_batch_bytes) // WINDING_BYTES_PER_PAIR)
+    triangles_per_batch = max(1, min(len(triangles), pairs_per_batch))
+    points_per_batch = max(1, pairs_per_batch // triangles_per_batch)
+
+    winding_numbers = np.zeros(len(points))
+    for point_start in range(0, len(points), points_per_batch):
+        batch_points = points[point_start:point_start + points_per_batch]
+        for triangle_start in range(0, len(triangles), triangles_per_batch):
+            winding_numbers[point_start:point_start + points_per_batch] += \
+                _winding_number(batch_points,
+                                triangles[triangle_start:triangle_start + triangles_per_batch])
+
+    return np.abs(winding_numbers) >= 0.5
+
+
+def _winding_number(points, triangles) -> np.array:
+    """
+    Computes the contribution of the given triangles to the generalized 
+    winding number at each point, using the solid angle formula of 
+    Van Oosterom and Strackee.
+
+    Args:
+        points: (n, 3) array of query points.
+        triangles: (m, 3, 3) array of triangle vertices.
+
+    Returns:
+        An (n,) array with the summed winding numbers.
+    """
+    # Vectors from every point to every triangle corner, one (n, m) array per 
+    # component to keep the temporaries small
+    a = [triangles[None, :, 0, i] - points[:, i, None] for i in range(3)]
+    b = [triangles[None, :, 1, i] - points[:, i, None] for i in range(3)]
+    c = [triangles[None, :, 2, i] - points[:, i, None] for i in range(3)]
+
+    length_a = np.sqrt(a[0]**2 + a[1]**2 + a[2]**2)
+    length_b = np.sqrt(b[0]**2 + b[1]**2 + b[2]**2)
+    length_c = np.sqrt(c[0]**2 + c[1]**2 + c[2]**2)
+
+    # Scalar triple product a . (b x c)
+    determinant = (a[0] * (b[1] * c[2] - b[2] * c[1])
+                   + a[1] * (b[2] * c[0] - b[0] * c[2])
+                   + a[2] * (b[0] * c[1] - b[1] * c[0]))
+
+    dot_ab = a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+    dot_bc = b[0] * c[0] + b[1] * c[1] + b[2] * c[2]
+    dot_ca = c[0] * a[0] + c[1] * a[1] + c[2] * a[2]
+    divisor = (length_a * length_b * length_c + dot_ab * length_c
+               + dot_bc * length_a + dot_ca * length_b)
+
+    # Each triangle subtends a solid angle of 2 * atan2(det, divisor)
+    solid_angles = 2 * np.arctan2(determinant, divisor)
+
+    return solid_angles.sum(axis=1) / (4 * np.pi)
+
+
+def stl_to_voxel_array_progressive(stl_mesh, voxel_size, coarse_factor=4, backend="scanline",
+                                   num_random_rays=10, seed=0, max_batch_bytes=256 * 1024**2,
+                                   preview=None, progress=None, cancel=None) -> np.array:
+    """
+    Converts an STL mesh into a voxel array from coarse to fine, on the same
+    grid as stl_to_voxel_array. The grid is first voxelized by the backend with
+    cells of coarse_factor voxels per side, which is a quick preview of the
+    model. Cells that the surface does not pass through are completely inside
+    or outside and are filled in bulk. Cells near the surface are split in
+    eight, octree style, until only the single voxels near the surface are
+    classified one by one, so the full resolution work follows the surface.
+
+    For closed meshes the result matches stl_to_voxel_array, except for voxel
+    centers lying on the surface. The cells below the coarse level are
+    classified with one upward ray per cell center using the parity rule of
+    the "scanline" backend, or with the winding number for "winding".
+
+    The bulk filling assumes that a cell the surface does not pass through is 
+    on one side of it, which only holds for watertight meshes. Open meshes, 
+    such as 3D scans, are voxelized at full resolution with stl_to_voxel_array
+    after the coarse pass, so the result is the same as theirs.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the voxel in each dimension.
+        coarse_factor: The edge length of the coarse cells in voxels, a power
+            of two. 1 classifies every voxel with the backend.
+        backend, num_random_rays, seed, max_batch_bytes: See stl_to_voxel_array.
+            They apply to the coarse pass, num_random_rays and seed only to
+            the "rays" backend.
+        preview: Optional callable preview(coarse_array, cell_size), called with
+            the coarse voxel array and its cell size as soon as it is done.
+        progress: Optional callable progress(done, total), called with the
+            number of levels done, the coarse pass being the first. For open
+            meshes, see stl_to_voxel_array.
+        cancel: Optional CancelToken, checked before every level.
+
+    Returns:
+        A 3D numpy array representing the voxelized mesh.
+    """
+    if backend not in VOXEL_BACKENDS:
+        raise ValueError("Invalid backend. Must be one of: " +
+                         ", ".join(VOXEL_BACKENDS))
+    if coarse_factor < 1 or coarse_factor & (coarse_factor - 1):
+        raise ValueError("Invalid coarse factor. Must be a power of two.")
+
+    voxel_size = np.asarray(voxel_size, dtype=np.float64)
+
+    if not stl_mesh.is_watertight:
+        # The coarse pass is only the preview
+        if preview is not None:
+            check_cancelled(cancel)
+            preview(stl_to_coarse_voxel_array(stl_mesh, voxel_size, coarse_factor, backend,
+                                              num_random_rays, seed, max_batch_bytes),
+                    voxel_size * coarse_factor)
+        return stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays, seed, backend,
+                                  max_batch_bytes, progress=progress, cancel=cancel)
+
+    min_coords, grid_dimensions, grid_offset = voxel_grid_geometry(
+        stl_mesh, voxel_size)
+    # Corner of the first voxel, the cells of every level are aligned with it
+    origin = min_coords + grid_offset
+    triangles = np.asarray(stl_mesh.triangles, dtype=np.float64)
+
+    levels = int(coarse_factor).bit_length()
+    instrumentation.count("voxels", int(np.prod(grid_dimensions)))
+
+    check_cancelled(cancel)
+    cell_size = voxel_size * coarse_factor
+    coarse = stl_to_coarse_voxel_array(stl_mesh, voxel_size, coarse_factor, backend,
+                                       num_random_rays, seed, max_batch_bytes)
+    num_cells = np.array(coarse.shape)
+    if preview is not None:
+        preview(coarse, cell_size)
+    if progress is not None:
+        progress(1, levels)
+
+    # The voxels of whole coarse cells, cropped to the grid at the end
+    voxel_grid = np.zeros(num_cells * coarse_factor, dtype=bool)
+
+    size = coarse_factor
+    cells = np.argwhere(np.ones(num_cells, dtype=bool))
+    inside = coarse.ravel()
+    voxels_refined = 0
+
+    for level in range(1, levels + 1):
+        if size > 1:
+            # Cells away from the surface get the value of their center
+            near = _surface_cells(triangles, origin, voxel_size * size,
+                                  num_cells * coarse_factor // size)[tuple(cells.T)]
+            blocks = voxel_grid.reshape(-1, size, voxel_grid.shape[1] // size, size,
+                                        voxel_grid.shape[2] // size, size)
+            filled = cells[~near & inside]
+            blocks[filled[:, 0], :, filled[:, 1], :, filled[:, 2], :] = True
+
+            # Split the cells near the surface and classify their children
+            check_cancelled(cancel)
+            size //= 2
+            cells = (cells[near][:, None, :] * 2
+                     + np.array(list(itertools.product((0, 1), repeat=3)))).reshape(-1, 3)
+            centers = origin + voxel_size * size * (cells + 0.5)
+            inside = _points_inside(stl_mesh, triangles, centers, backend, max_batch_bytes)
+            if size == 1:
+                voxels_refined = len(cells)
+            if progress is not None:
+                progress(level + 1, levels)
+        else:
+            voxel_grid[tuple(cells[inside].T)] = True
+
+    instrumentation.count("voxels_refined", voxels_refined)
+
+    return np.ascontiguousarray(voxel_grid[:grid_dimensions[0], :grid_dimensions[1],
+                                           :grid_dimensions[2]])
+
+
+def stl_to_coarse_voxel_array(stl_mesh, voxel_size, coarse_factor=4, backend="scanline",
+                              num_random_rays=10, seed=0,
+                              max_batch_bytes=256 * 1024**2) -> np.array:
+    """
+    Converts an STL mesh into a coarse voxel array for previews. Every coarse
+    voxel is a cell of coarse_factor voxels per side of the grid of
+    stl_to_voxel_array, and is set when the center of the cell is inside the
+    mesh.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the full resolution voxel in each dimension.
+        coarse_factor: The edge length of the coarse cells in voxels.
+        backend, num_random_rays, seed, max_batch_bytes: See stl_to_voxel_array.
+
+    Returns:
+        A 3D numpy array with one value per coarse cell. The cells have the
+        size voxel_size * coarse_factor.
+    """
+    voxel_size = np.asarray(voxel_size, dtype=np.float64)
+    min_coords, grid_dimensions, grid_offset = voxel_grid_geometry(
+        stl_mesh, voxel_size)
+
+    # A grid whose voxels are the cells, starting at the corner of the first voxel
+    num_cells = -(-grid_dimensions // coarse_factor)
+    options = (backend, voxel_size * coarse_factor, min_coords + grid_offset, num_cells,
+               np.zeros(3), num_random_rays, seed, max_batch_bytes)
+
+    return _voxelize_slab(stl_mesh, options, (0, num_cells[0]))
+
+
+def _surface_cells(triangles, origin, cell_size, num_cells) -> np.array:
+    """
+    Marks the cells of a grid that the surface of a mesh may pass through: the
+    cells that overlap the bounding box of a triangle and are crossed by the
+    plane of that triangle. Cells that are not marked lie completely inside or
+    completely outside the mesh.
+
+    Args:
+        triangles: (m, 3, 3) array of triangle vertices.
+        origin: The corner of the first cell.
+        cell_size: The size of the cells in each dimension.
+        num_cells: The number of cells along each axis.
+
+    Returns:
+        A 3D boolean array, True for the cells near the surface.
+    """
+    num_cells = np.asarray(num_cells, dtype=np.int64)
+    cells = np.zeros(tuple(num_cells), dtype=bool)
+
+    # Slightly enlarged boxes, so a triangle on a cell face marks both cells
+    margin = 1e-6 * cell_size
+    low = np.floor((triangles.min(axis=1) - margin - origin) / cell_size).astype(np.int64)
+    high = np.floor((triangles.max(axis=1) + margin - origin) / cell_size).astype(np.int64)
+    in_grid = np.all((high >= 0) & (low < num_cells), axis=1)
+    triangles = triangles[in_grid]
+    low = np.clip(low[in_grid], 0, num_cells - 1)
+    high = np.clip(high[in_grid], 0, num_cells - 1)
+
+    # A plane crosses a cell when the cell center is within the projected
+    # half extent of the cell from it
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    plane_offsets = np.einsum("ij,ij->i", normals, triangles[:, 0])
+    radii = 0.5 * np.abs(normals) @ cell_size
+
+    def mark(index, triangle_index):
+        centers = origin + cell_size * (index + 0.5)
+        distance = np.abs(np.einsum("ij,ij->i", centers, normals[triangle_index])
+                          - plane_offsets[triangle_index])
+        crossed = distance <= radii[triangle_index] * (1 + 1e-6)
+        cells[tuple(index[crossed].T)] = True
+
+    # Small triangles try every offset within their span at once
+    max_span = (high - low).max(axis=1)
+    for span in range(SURFACE_CELL_SPAN + 1):
+        selected = np.flatnonzero(max_span == span)
+        for offset in itertools.product(range(span + 1), repeat=3):
+            index = low[selected] + offset
+            within = np.all(index <= high[selected], axis=1)
+            mark(index[within], selected[within])
+
+    for triangle_index in np.flatnonzero(max_span > SURFACE_CELL_SPAN):
+        index = np.stack(np.meshgrid(*[np.arange(low[triangle_index, axis],
+                                                 high[triangle_index, axis] + 1)
+                                       for axis in range(3)], indexing="ij"),
+                         axis=-1).reshape(-1, 3)
+        mark(index, np.full(len(index), triangle_index))
+
+    return cells
+
+
+def _points_inside(stl_mesh, triangles, points, backend, max_batch_bytes) -> np.array:
+    """
+    Determines which points are inside the mesh, with the winding number for
+    the "winding" backend and otherwise by the parity of the surface crossings
+    below each point. Points in the same column share one upward ray, see
+    _voxelize_scanline.
+
+    Returns:
+        An (n,) boolean array, True for the points inside.
+    """
+    if len(points) == 0:
+        return np.zeros(0, dtype=bool)
+
+    if backend == "winding":
+        return _winding_inside(points, triangles, max_batch_bytes)
+
+    columns, point_column = np.unique(points[:, :2], axis=0, return_inverse=True)
+    point_column = point_column.ravel()
+    index_ray, depths = _column_crossings(stl_mesh, columns,
+                                          triangles[:, :, 2].min() - 1.0)
+    instrumentation.count("rays_cast", len(columns))
+
+    # Crossings and points on one axis, ordered by column and then by height,
+    # so the crossings below a point are found with one search
+    span = max(1.0, float(np.ptp(np.concatenate([depths, points[:, 2]])))) * 2
+    base = min(float(depths.min()) if len(depths) else 0.0, float(points[:, 2].min()))
+    crossing_keys = index_ray * span + (depths - base)
+    point_keys = point_column * span + (points[:, 2] - base)
+    column_start = np.searchsorted(crossing_keys, point_column * span)
+    below = np.searchsorted(crossing_keys, point_keys) - column_start
+
+    return below % 2 == 1
 
 
 def find_surface_voxels(voxel_array) -> np.array:
     """
     Identifies the surface voxels in the voxel array. A voxel is considered a surface voxel 
-    if it has a False neighbor.
+    if it has a False neighbor. Voxels on the border of the grid are surface voxels, since 
+    everything outside the grid is empty.
 
     Args:
         voxel_array: 3D numpy array representing the voxel grid.
@@ -192,23 +944,117 @@ def find_surface_voxels(voxel_array) -> np.array:
         A 3D numpy array of the same size as the input array, with True values 
         for surface voxels and False elsewhere.
     """
-    surface_voxels = np.zeros_like(voxel_array, dtype=bool)
+    voxel_array = voxel_array.astype(bool)
+    # Erosion with the 6-neighborhood keeps the voxels whose neighbors are all filled
+    return voxel_array & ~ndimage.binary_erosion(voxel_array, border_value=0)
+
+
+def shell_voxels(voxel_array, wall_thickness=2, max_overhang=1) -> np.array:
+    """
+    Hollows out a voxel array, keeping a shell of the given wall thickness and the 
+    interior voxels needed to support it.
+
+    The shell is made of the filled voxels within wall_thickness of an empty voxel, 
+    measured with a Euclidean distance transform, and of the filled voxels within 
+    wall_thickness layers of an empty voxel straight above or below them. The latter 
+    keeps floors and roofs wide enough on shallow slopes that every layer of the 
+    shell rests on the layer below, as the tiler needs a brick below every brick.
+
+    The ceiling of the cavity is left hanging above the removed interior. Going 
+    down from the top layer, every kept voxel without a kept voxel within 
+    max_overhang cells in the layer below, where the solid had one, gets a 
+    supporting voxel in the layer below. It is moved up to max_overhang cells 
+    towards the nearest kept voxel, so the supports lean into the walls instead of 
+    running down to the floor.
 
-    for x in range(1, voxel_array.shape[0] - 1):
-        for y in range(1, voxel_array.shape[1] - 1):
-            for z in range(1, voxel_array.shape[2] - 1):
-                if voxel_array[x, y, z]:
-                    if (
-                        not voxel_array[x - 1, y, z] or
-                        not voxel_array[x + 1, y, z] or
-                        not voxel_array[x, y - 1, z] or
-                        not voxel_array[x, y + 1, z] or
-                        not voxel_array[x, y, z - 1] or
-                        not voxel_array[x, y, z + 1]
-                    ):
-                        surface_voxels[x, y, z] = True
+    Args:
+        voxel_array: 3D numpy array representing the voxel grid, indexed (x, y, z) 
+            with z pointing up.
+        wall_thickness: The wall thickness in voxels. Walls of 1 voxel keep only
+            the surface voxels, which the tiler can not support on shallow slopes.
+        max_overhang: The number of cells a ceiling voxel may stick out horizontally 
+            over its support.
 
-    return surface_voxels
+    Returns:
+        A 3D boolean numpy array with the shell and its supports.
+    """
+    if wall_thickness < 1:
+        raise ValueError("Invalid wall thickness. Must be at least 1 voxel.")
+
+    solid = voxel_array.astype(bool)
+    shell = shell_walls(solid, wall_thickness)
+    support_shell(shell, solid, max_overhang)
+
+    instrumentation.count("shell_voxels_removed", int(np.count_nonzero(solid & ~shell)))
+
+    return shell
+
+
+def shell_walls(solid, wall_thickness) -> np.array:
+    """
+    Returns the walls, floors and roofs of the shell of shell_voxels, without the 
+    supports. A voxel only depends on the voxels up to wall_thickness + 1 cells 
+    away, so the walls of a z range can be computed from that range and a halo of 
+    wall_thickness + 1 layers on both sides, see sparse_grid.shell_chunked_grid.
+
+    Args:
+        solid: 3D boolean numpy array of the voxel grid, indexed (x, y, z).
+        wall_thickness: The wall thickness in voxels.
+
+    Returns:
+        A 3D boolean numpy array with the walls.
+    """
+    # Distance of every filled voxel to the nearest empty voxel, with the
+    # outside of the grid counting as empty
+    distance = ndimage.distance_transform_edt(np.pad(solid, 1))[1:-1, 1:-1, 1:-1]
+    shell = solid & (distance <= wall_thickness)
+
+    # Voxels with an empty voxel up to wall_thickness + 1 layers below or above
+    # them. The extra layer makes consecutive layers of a floor or roof overlap.
+    padded = np.pad(solid, ((0, 0), (0, 0), (wall_thickness + 1,) * 2))
+    interior = padded.copy()
+    for dz in range(1, wall_thickness + 2):
+        interior[:, :, dz:] &= padded[:, :, :-dz]
+        interior[:, :, :-dz] &= padded[:, :, dz:]
+    shell |= solid & ~interior[:, :, wall_thickness + 1:-wall_thickness - 1]
+
+    return shell
+
+
+def support_shell(shell, solid, max_overhang=1):
+    """
+    Adds the supports of shell_voxels to a shell, in place. Going down from the 
+    top layer, every layer gets the supports of the finished layer above it, so a
+    z range can be supported on its own once the layer above it is finished: 
+    pass that layer as the top layer of shell and solid.
+
+    Args:
+        shell: 3D boolean numpy array of the shell, indexed (x, y, z).
+        solid: 3D boolean numpy array of the solid voxel grid.
+        max_overhang: See shell_voxels.
+    """
+    reach = np.ones((2 * max_overhang + 1,) * 2, dtype=bool)
+    for z in range(solid.shape[2] - 1, 0, -1):
+        below = shell[:, :, z - 1]
+
+        # Voxels that lost the solid below them and have no kept voxel in reach
+        supported = ndimage.binary_dilation(below, structure=reach) if max_overhang else below
+        unsupported = shell[:, :, z] & solid[:, :, z - 1] & ~supported
+        if not unsupported.any():
+            continue
+
+        cells = np.argwhere(unsupported)
+        targets = cells
+        if max_overhang and below.any():
+            # Step towards the nearest kept voxel of the layer below
+            _, nearest = ndimage.distance_transform_edt(~below, return_indices=True)
+            nearest = nearest[:, cells[:, 0], cells[:, 1]].T
+            targets = cells + np.clip(nearest - cells, -max_overhang, max_overhang)
+            # Fall back to the voxel directly below if the step leaves the solid
+            outside = ~solid[targets[:, 0], targets[:, 1], z - 1]
+            targets[outside] = cells[outside]
+
+        below[targets[:, 0], targets[:, 1]] = True
 
 
 def plot_voxel_array(voxel_array, voxel_size):
@@ -268,9 +1114,20 @@ def save_array_json(voxel_array: np.array, path: str):
     extension is automatically added.
 
     Args:
-        voxel_array: The numpy array to be saved.
+        voxel_array: The numpy array to be saved. A ChunkedGrid is also accepted,
+            it is written one plane at a time without creating a dense array of
+            the whole grid. The file is the same as for the dense array.
         path: The directory path where the file is to be saved.
     """
+    if not isinstance(voxel_array, np.ndarray):
+        with open(path + '.json', 'w') as outfile:
+            outfile.write("[")
+            for x in range(voxel_array.shape[0]):
+                plane = np.asarray(voxel_array[x]).tolist()
+                outfile.write((", " if x else "") + json.dumps(plane))
+            outfile.write("]")
+        return
+
     # convert to python nested list
     voxel_list = voxel_array.tolist()
 
@@ -278,9 +1135,74 @@ def save_array_json(voxel_array: np.array, path: str):
         json.dump(voxel_list, outfile)
 
 
+def save_array_packed(voxel_array: np.array, path: str):
+    """
+    Saves a boolean voxel array in a compact binary format at the specified path. 
+    The '.bvox' extension is automatically added. The file holds a header with 
+    the grid shape followed by the voxels packed 8 per byte along the last 
+    axis, see load_array_packed.
+
+    Args:
+        voxel_array: The 3D boolean numpy array to be saved. A ChunkedGrid is
+            also accepted, it is written one plane at a time without creating
+            a dense array of the whole grid.
+        path: The path of the file without extension.
+    """
+    header = np.zeros((), dtype=PACKED_VOXEL_HEADER)
+    header["magic"] = PACKED_VOXEL_MAGIC
+    header["shape"] = voxel_array.shape
+
+    with open(path + '.bvox', 'wb') as outfile:
+        outfile.write(header.tobytes())
+        if isinstance(voxel_array, np.ndarray):
+            outfile.write(np.packbits(voxel_array.astype(bool), axis=-1).tobytes())
+            return
+        for x in range(voxel_array.shape[0]):
+            plane = np.asarray(voxel_array[x], dtype=bool)
+            outfile.write(np.packbits(plane, axis=-1).tobytes())
+
+
+def load_array_packed(path: str, unpack=True) -> np.array:
+    """
+    Loads a voxel array saved by save_array_packed. The payload is memory-mapped,
+    so nothing is parsed and only the parts that are used are read from disk.
+
+    Args:
+        path: The path of the file, including the '.bvox' extension.
+        unpack: If True, return the voxels as a boolean array. If False, return 
+            the memory-mapped packed bytes, which can be sliced along the first 
+            two axes and unpacked with np.unpackbits(..., axis=-1, count=shape[2]).
+
+    Returns:
+        A 3D numpy array.
+    """
+    header = np.fromfile(path, dtype=PACKED_VOXEL_HEADER, count=1)[0]
+    if header["magic"] != PACKED_VOXEL_MAGIC:
+        raise ValueError("Not a packed voxel file: " + path)
+
+    shape = tuple(int(dim) for dim in header["shape"])
+    packed = np.memmap(path, dtype=np.uint8, mode='r',
+                       offset=PACKED_VOXEL_HEADER.itemsize,
+                       shape=(shape[0], shape[1], (shape[2] + 7) // 8))
+
+    if not unpack:
+        return packed
+
+    return np.unpackbits(packed, axis=-1, count=shape[2]).astype(bool)
+
+
 def stl_to_mesh(stl_path: str) -> trimesh.Trimesh:
     """
-    Loads an STL file from a given path and returns a trimesh object.
+    Loads an STL file from a given path and returns a trimesh object. Binary 
+    STL files are memory-mapped and read in a single pass, other files are 
+    loaded through trimesh. Load the mesh once and pass it on, both STL_height
+    and main_calculations accept the mesh instead of the path.
+
+    The mesh is built like trimesh builds it: the corners are converted to 
+    float64 and merged into shared vertices, which the voxelization needs, so 
+    the mesh is a copy of the file and not a view of it. When only the size of
+    the model is needed, stl_bounds reads it from the mapped file without 
+    building a mesh.
 
     Args:
         stl_path: The path of the STL file.
@@ -288,6 +1210,14 @@ def stl_to_mesh(stl_path: str) -> trimesh.Trimesh:
     Returns:
         A trimesh object.
     """
+    triangles = None
+    if str(stl_path).lower().endswith(".stl"):
+        triangles = map_binary_stl(stl_path)
+
+    if triangles is not None:
+        # The same processing as trimesh applies when it loads an STL
+        return trimesh.Trimesh(**trimesh.triangles.to_kwargs(triangles))
+
     stl_mesh = trimesh.load_mesh(stl_path)
 
     # Check if the loaded_mesh is a Scene object, if so, extract the mesh
@@ -297,3 +1227,56 @@ def stl_to_mesh(stl_path: str) -> trimesh.Trimesh:
         stl_mesh = stl_mesh
 
     return stl_mesh
+
+
+def map_binary_stl(stl_path: str):
+    """
+    Memory-maps the triangles of a binary STL file.
+
+    Args:
+        stl_path: The path of the STL file.
+
+    Returns:
+        A read-only (n, 3, 3) float32 view of the triangle corners in the 
+        file, or None if the file is not a binary STL.
+    """
+    file_size = os.path.getsize(stl_path)
+    if file_size < BINARY_STL_HEADER_SIZE:
+        return None
+
+    triangle_count = int(np.fromfile(stl_path, dtype="<u4", count=1, offset=80)[0])
+
+    # ASCII files start with "solid" and do not match the binary size
+    if file_size != BINARY_STL_HEADER_SIZE + triangle_count * BINARY_STL_DTYPE.itemsize:
+        return None
+
+    if triangle_count == 0:
+        return np.zeros((0, 3, 3), dtype=np.float32)
+
+    records = np.memmap(stl_path, dtype=BINARY_STL_DTYPE, mode='r',
+                        offset=BINARY_STL_HEADER_SIZE, shape=(triangle_count,))
+
+    return records["vertices"]
+
+
+def stl_bounds(stl_path: str):
+    """
+    Computes the bounding box of a binary STL file from its memory-mapped 
+    triangles, without building a mesh or copying the triangles.
+
+    Args:
+        stl_path: The path of the STL file.
+
+    Returns:
+        A (2, 3) float64 array with the minimum and maximum corner, the same as
+        the bounds of the mesh of stl_to_mesh, or None if the file is not a 
+        binary STL.
+    """
+    triangles = map_binary_stl(stl_path)
+    if triangles is None:
+        return None
+    if len(triangles) == 0:
+        return np.zeros((2, 3))
+
+    return np.array([triangles.min(axis=(0, 1)), triangles.max(axis=(0, 1))],
+                    dtype=np.float64)
@@ -0,0 +1,343 @@
+"""
+-----------------------------------------
+STL to LEGO Converter - Batch Command Line
+-----------------------------------------
+
+Description:
+-------------
+Converts a directory or glob of STL files to LEGO bricks at one or more target
+heights without a GUI. Every (file, height) pair is a job, and the jobs run in a
+process pool. With --sweep, every file is one job that voxelizes all heights
+from a single loaded mesh. Each job writes its results to its own directory, and a summary
+with the throughput of the whole batch is written to summary.json.
+
+Example:
+    python3 batch_stl2lego.py STLs --heights 10 20 40 --output-dir out --workers 8
+"""
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import instrumentation
+
+from layer_cache import LayerCache
+from pipeline import HEIGHT_UNITS, convert_stl, convert_stl_heights
+from scale_sweep import SWEEP_BACKENDS
+from STLImport import VOXEL_BACKENDS
+
+
+def find_stl_files(inputs):
+    """
+    Expands directories and glob patterns to a sorted list of STL files.
+
+    Args:
+        inputs: Directories, glob patterns or file paths.
+
+    Returns:
+        The list of STL file paths.
+    """
+    stl_files = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.stl")
+        stl_files.update(path for path in glob.glob(pattern)
+                         if path.lower().endswith(".stl"))
+    return sorted(stl_files)
+
+
+def job_names(stl_files):
+    """
+    Names the jobs of each file after the file. Files with the same name in
+    different directories, ignoring case, get a short hash of their path
+    appended, so their jobs never share an output directory.
+
+    Args:
+        stl_files: The STL file paths.
+
+    Returns:
+        A dictionary with the job name of each file.
+    """
+    stems = {path: os.path.splitext(os.path.basename(path))[0] for path in stl_files}
+    counts = {}
+    for stem in stems.values():
+        counts[stem.lower()] = counts.get(stem.lower(), 0) + 1
+
+    names = {}
+    for path, stem in stems.items():
+        if counts[stem.lower()] > 1:
+            digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+            stem = f"{stem}_{digest}"
+        names[path] = stem
+    return names
+
+
+def job_output_dir(output_dir, job_name, height):
+    """
+    Returns the output directory of one job, named after the file and the height.
+    """
+    return os.path.join(output_dir, f"{job_name}_h{height:g}")
+
+
+def run_job(job):
+    """
+    Runs one conversion job in a worker process.
+
+    Args:
+        job: Tuple (stl_path, height, options) with the keyword arguments of
+            convert_stl in options, and the names of job_names under "job_names".
+
+    Returns:
+        The result of convert_stl, with the instrumentation record under
+        "metrics" if requested, or a dictionary with the error.
+    """
+    stl_path, height, options = job
+    output_dir = job_output_dir(options["output_dir"], options["job_names"][stl_path], height)
+
+    if options["metrics"]:
+        os.makedirs(output_dir, exist_ok=True)
+        profile_path = None
+        if options["profile_stage"] is not None:
+            profile_path = os.path.join(output_dir, options["profile_stage"] + ".prof")
+        collector = instrumentation.collect(options["profile_stage"], profile_path)
+    else:
+        collector = contextlib.nullcontext()
+
+    layer_cache = None
+    if options["layer_cache"]:
+        # Each job keeps its own cache, so jobs never write the same file
+        os.makedirs(output_dir, exist_ok=True)
+        layer_cache = LayerCache(os.path.join(output_dir, "layer_cache.json"))
+
+    try:
+        with collector as metrics:
+            result = convert_stl(stl_path, height, options["unit"], output_dir,
+                                 backend=options["backend"],
+                                 export_json=options["export_json"],
+                                 cache_dir=options["cache_dir"],
+                                 sparse=options["sparse"],
+                                 wall_thickness=options["wall_thickness"],
+                                 layer_cache=layer_cache,
+                                 tiling_workers=options["tiling_workers"],
+                                 optimize_seconds=options["optimize_seconds"],
+                                 catalog_path=options["catalog_path"],
+                                 remove_floating=options["remove_floating"])
+    except Exception as e:
+        return {"stl_path": stl_path, "height": height, "error": repr(e)}
+
+    if metrics is not None:
+        result["metrics"] = metrics.record()
+    if layer_cache is not None:
+        result["layer_cache"] = layer_cache.stats()
+
+    with open(os.path.join(output_dir, "job.json"), "w") as outfile:
+        json.dump(result, outfile, indent=2)
+
+    return result
+
+
+def run_sweep_job(job):
+    """
+    Runs the conversion of one file at all heights in a worker process, see
+    convert_stl_heights.
+
+    Args:
+        job: Tuple (stl_path, heights, options), see run_job.
+
+    Returns:
+        The list of results of the heights, or of dictionaries with the error.
+    """
+    stl_path, heights, options = job
+    output_dirs = [job_output_dir(options["output_dir"], options["job_names"][stl_path], height)
+                   for height in heights]
+
+    layer_caches = None
+    if options["layer_cache"]:
+        layer_caches = []
+        for output_dir in output_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+            layer_caches.append(LayerCache(os.path.join(output_dir, "layer_cache.json")))
+
+    try:
+        results = convert_stl_heights(stl_path, heights, options["unit"], output_dirs,
+                                      backend=options["backend"],
+                                      export_json=options["export_json"],
+                                      wall_thickness=options["wall_thickness"],
+                                      layer_caches=layer_caches,
+                                      optimize_seconds=options["optimize_seconds"],
+                                      catalog_path=options["catalog_path"],
+                                      remove_floating=options["remove_floating"])
+    except Exception as e:
+        return [{"stl_path": stl_path, "height": height, "error": repr(e)}
+                for height in heights]
+
+    for index, result in enumerate(results):
+        if layer_caches is not None:
+            result["layer_cache"] = layer_caches[index].stats()
+        with open(os.path.join(result["output_dir"], "job.json"), "w") as outfile:
+            json.dump(result, outfile, indent=2)
+
+    return results
+
+
+def run_batch(stl_files, heights, options, workers):
+    """
+    Runs every (file, height) job in a process pool, or one job per file with
+    options["sweep"].
+
+    Args:
+        stl_files: The STL files to convert.
+        heights: The target heights.
+        options: The shared job options, see run_job.
+        workers: The number of worker processes.
+
+    Returns:
+        A summary dictionary with the job results and the batch throughput.
+    """
+    options = dict(options, job_names=job_names(stl_files))
+    if options["sweep"]:
+        jobs = [(stl_path, tuple(heights), options) for stl_path in stl_files]
+        run = run_sweep_job
+    else:
+        jobs = [(stl_path, height, options) for stl_path in stl_files for height in heights]
+        run = run_job
+
+    start_time = time.time()
+    results = []
+    # A single worker runs the jobs in this process, where they can start
+    # processes of their own for parallel tiling
+    with multiprocessing.Pool(workers) if workers > 1 else contextlib.nullcontext() as pool:
+        for job_results in pool.imap_unordered(run, jobs) if pool else map(run, jobs):
+            # A sweep job gives the results of all its heights
+            if isinstance(job_results, dict):
+                job_results = [job_results]
+            for result in job_results:
+                if "error" in result:
+                    print(f"FAILED {result['stl_path']} at {result['height']:g}: "
+                          f"{result['error']}")
+                else:
+                    print(f"Done {result['stl_path']} at {result['height']:g}: "
+                          f"{result['bricks']} bricks in {result['seconds']:.2f} s")
+                results.append(result)
+    elapsed_time = time.time() - start_time
+
+    succeeded = [result for result in results if "error" not in result]
+    voxels = sum(result["voxels"] for result in succeeded)
+    bricks = sum(result["bricks"] for result in succeeded)
+
+    return {
+        "jobs": len(results),
+        "failed": len(results) - len(succeeded),
+        "workers": workers,
+        "seconds": elapsed_time,
+        "jobs_per_minute": 60 * len(succeeded) / elapsed_time if elapsed_time > 0 else 0.0,
+        "voxels_per_second": voxels / elapsed_time if elapsed_time > 0 else 0.0,
+        "bricks_per_second": bricks / elapsed_time if elapsed_time > 0 else 0.0,
+        "results": results,
+    }
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert STL files to LEGO bricks without a GUI.")
+    parser.add_argument("inputs", nargs="+",
+                        help="STL files, directories of STL files or glob patterns")
+    parser.add_argument("--heights", nargs="+", type=float, required=True,
+                        help="target heights, every file is converted at every height")
+    parser.add_argument("--unit", default="LEGO bricks", choices=HEIGHT_UNITS,
+                        help="unit of the heights (default: LEGO bricks)")
+    parser.add_argument("--output-dir", default="batch_output",
+                        help="directory for the results (default: batch_output)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--tiling-workers", type=int, default=1,
+                        help="tile the layers of each job in this many processes, "
+                             "needs --workers 1 (default: 1, sequential tiling)")
+    parser.add_argument("--optimize", type=float, default=None, metavar="SECONDS",
+                        help="spend this many seconds per job reducing the number of bricks")
+    parser.add_argument("--backend", default="scanline", choices=VOXEL_BACKENDS,
+                        help="voxelization backend (default: scanline)")
+    parser.add_argument("--catalog", default=None, metavar="PATH",
+                        help="brick catalog config with the allowed bricks and their colors "
+                             "(default: brick_catalog.json)")
+    parser.add_argument("--remove-floating", action="store_true",
+                        help="remove the bricks that are not connected to the base layer")
+    parser.add_argument("--json", action="store_true",
+                        help="also write JSON files for the Catia tool")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of a voxel cache shared by the jobs")
+    parser.add_argument("--sparse", action="store_true",
+                        help="hold the voxels in a chunked sparse grid, for very large models")
+    parser.add_argument("--shell", type=int, default=None, metavar="THICKNESS",
+                        help="tile only a hollow shell with walls of this many voxels")
+    parser.add_argument("--sweep", action="store_true",
+                        help="convert every file at all heights in one job that loads the "
+                             "mesh and builds its ray structure once")
+    parser.add_argument("--layer-cache", action="store_true",
+                        help="keep the tiled layers in each job directory, so running the "
+                             "job again only tiles the layers that changed")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record stage times, memory and counters in job.json")
+    parser.add_argument("--profile-stage", default=None,
+                        help="run this stage under cProfile, written to <stage>.prof "
+                             "in the job directory (implies --metrics)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    # The job processes of the pool can not start processes of their own
+    if args.workers > 1 and args.tiling_workers > 1:
+        raise SystemExit("--tiling-workers needs --workers 1")
+
+    if args.sweep:
+        if args.backend not in SWEEP_BACKENDS:
+            raise SystemExit("--sweep needs --backend " + " or ".join(SWEEP_BACKENDS))
+        if args.sparse or args.cache_dir is not None or args.tiling_workers > 1:
+            raise SystemExit("--sweep can not be combined with --sparse, --cache-dir "
+                             "or --tiling-workers")
+        if args.metrics or args.profile_stage is not None:
+            raise SystemExit("--sweep does not record --metrics")
+
+    stl_files = find_stl_files(args.inputs)
+    if not stl_files:
+        raise SystemExit("No STL files found in: " + ", ".join(args.inputs))
+
+    options = {
+        "unit": args.unit,
+        "output_dir": args.output_dir,
+        "backend": args.backend,
+        "export_json": args.json,
+        "cache_dir": args.cache_dir,
+        "sparse": args.sparse,
+        "wall_thickness": args.shell,
+        "layer_cache": args.layer_cache,
+        "tiling_workers": args.tiling_workers,
+        "optimize_seconds": args.optimize,
+        "catalog_path": args.catalog,
+        "remove_floating": args.remove_floating,
+        "sweep": args.sweep,
+        "metrics": args.metrics or args.profile_stage is not None,
+        "profile_stage": args.profile_stage,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    summary = run_batch(stl_files, args.heights, options, max(1, args.workers))
+
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as outfile:
+        json.dump(summary, outfile, indent=2)
+
+    print(f"{summary['jobs'] - summary['failed']}/{summary['jobs']} jobs in "
+          f"{summary['seconds']:.2f} s: {summary['jobs_per_minute']:.1f} jobs/min, "
+          f"{summary['voxels_per_second']:.0f} voxels/s, "
+          f"{summary['bricks_per_second']:.0f} bricks/s")
+
+
+if __name__ == "__main__":
+    main()
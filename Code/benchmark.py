@@ -0,0 +1,256 @@
+"""
+-----------------------------------
+STL to LEGO Converter - Benchmarks
+-----------------------------------
+
+Description:
+-------------
+Times the stages of the conversion on the bundled STLs and on generated solids
+(cube, torus, hollow sphere) at several target heights: voxelization, tiling of
+the solid and of a hollow shell, support and placement checks and JSON export.
+Every case is run a few times and the fastest run is kept. The results are
+written as JSON, and can be compared against a saved baseline to report cases
+that got slower than a threshold.
+
+Example:
+    python3 benchmark.py --save baseline.json
+    python3 benchmark.py --compare baseline.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import trimesh
+
+from STLImport import (stl_to_mesh, rescale_mesh, stl_to_voxel_array, shell_voxels,
+                       stl_to_voxel_array_progressive, save_array_json)
+from bricker_functions import (switch_axis_of_array, tile_volume, can_place_brick,
+                               is_brick_supported, layer_support_table)
+from brick_catalog import load_catalog
+from pipeline import VOXEL_SIZE, height_to_scale
+
+
+STL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "STLs")
+
+# Target heights in LEGO bricks
+DEFAULT_HEIGHTS = (10, 20, 40)
+
+# Voxelization backends timed by default, "winding" and "rays" are much slower
+# at the larger heights and have to be asked for with --backends
+DEFAULT_BACKENDS = ("scanline",)
+
+# Number of random positions used by the support and placement microbenchmarks
+MICROBENCHMARK_QUERIES = 2000
+
+
+def hollow_sphere(outer_radius=1.0, inner_radius=0.6):
+    """
+    Creates a sphere with a spherical cavity, as two nested surfaces with the
+    inner one facing inwards.
+    """
+    outer = trimesh.creation.icosphere(subdivisions=3, radius=outer_radius)
+    inner = trimesh.creation.icosphere(subdivisions=3, radius=inner_radius)
+    inner.invert()
+    return trimesh.util.concatenate([outer, inner])
+
+
+def benchmark_models():
+    """
+    Returns the models to benchmark as a dictionary of functions creating a fresh mesh.
+    """
+    return {
+        "Pyramid": lambda: stl_to_mesh(os.path.join(STL_DIRECTORY, "Pyramid.stl")),
+        "sphere": lambda: stl_to_mesh(os.path.join(STL_DIRECTORY, "sphere.stl")),
+        "cube": lambda: trimesh.creation.box(extents=(1.0, 1.0, 1.0)),
+        "torus": lambda: trimesh.creation.torus(major_radius=1.0, minor_radius=0.35),
+        "hollow_sphere": hollow_sphere,
+    }
+
+
+def best_time(function, repeats):
+    """
+    Runs a function several times and returns the fastest time in seconds and
+    the result of the last run.
+    """
+    fastest = float("inf")
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        fastest = min(fastest, time.perf_counter() - start_time)
+    return fastest, result
+
+
+def random_queries(voxel_array, count, seed=0):
+    """
+    Returns random (brick, z, y, x) queries for the microbenchmarks.
+    """
+    rng = np.random.default_rng(seed)
+    bricks = list(load_catalog().colors)
+    shape = voxel_array.shape
+    return [(bricks[rng.integers(len(bricks))], int(rng.integers(shape[0])),
+             int(rng.integers(shape[1])), int(rng.integers(shape[2])))
+            for _ in range(count)]
+
+
+def run_benchmarks(heights, backends, repeats):
+    """
+    Runs every benchmark case.
+
+    Args:
+        heights: The target heights in LEGO bricks.
+        backends: The voxelization backends to time.
+        repeats: The number of runs of each case.
+
+    Returns:
+        A dictionary mapping case names to the fastest time in seconds.
+    """
+    results = {}
+
+    for model_name, create_mesh in benchmark_models().items():
+        for height in heights:
+            prefix = f"{model_name}/h{height}"
+
+            scale = height_to_scale(height, "LEGO bricks", create_mesh().extents[2])
+            voxel_array = None
+            for backend in backends:
+                # Each run gets a fresh mesh so ray structures are built every time
+                def voxelize():
+                    stl_mesh = rescale_mesh(create_mesh(), VOXEL_SIZE, scale)
+                    return stl_to_voxel_array(stl_mesh, VOXEL_SIZE, backend=backend)
+
+                seconds, voxel_array = best_time(voxelize, repeats)
+                results[f"{prefix}/voxelize_{backend}"] = seconds
+
+                def voxelize_progressive():
+                    stl_mesh = rescale_mesh(create_mesh(), VOXEL_SIZE, scale)
+                    return stl_to_voxel_array_progressive(stl_mesh, VOXEL_SIZE, backend=backend)
+
+                results[f"{prefix}/voxelize_{backend}_progressive"] = best_time(
+                    voxelize_progressive, repeats)[0]
+
+            volume = switch_axis_of_array(voxel_array, [2, 1, 0])
+
+            seconds, (_, tiled_volume) = best_time(lambda: tile_volume(volume), repeats)
+            results[f"{prefix}/tile_volume"] = seconds
+
+            seconds, shell = best_time(lambda: shell_voxels(voxel_array), repeats)
+            results[f"{prefix}/shell_voxels"] = seconds
+            shell_volume = switch_axis_of_array(shell, [2, 1, 0])
+            results[f"{prefix}/tile_volume_shell"] = best_time(
+                lambda: tile_volume(shell_volume), repeats)[0]
+
+            # Support and placement checks on the finished model
+            queries = random_queries(volume, MICROBENCHMARK_QUERIES)
+            support_tables = {z: layer_support_table(tiled_volume, z)
+                              for z in range(volume.shape[0])}
+
+            results[f"{prefix}/can_place_brick"] = best_time(
+                lambda: [can_place_brick(brick, volume, tiled_volume, z, y, x)
+                         for brick, z, y, x in queries], repeats)[0]
+            results[f"{prefix}/is_brick_supported"] = best_time(
+                lambda: [is_brick_supported(brick, tiled_volume, z, y, x, support_tables[z])
+                         for brick, z, y, x in queries], repeats)[0]
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "voxel_array")
+                results[f"{prefix}/save_array_json"] = best_time(
+                    lambda: save_array_json(voxel_array, path), repeats)[0]
+
+            print(f"{prefix}: grid {list(volume.shape)}, "
+                  f"{int(np.count_nonzero(volume))} voxels")
+
+    return results
+
+
+def compare_results(results, baseline, threshold, min_delta=0.0):
+    """
+    Compares results against a baseline.
+
+    Args:
+        results: The new case timings.
+        baseline: The baseline case timings.
+        threshold: The allowed relative slowdown, 0.2 allows 20 %.
+        min_delta: Slowdowns smaller than this many seconds are ignored, which
+            keeps timer noise in the fastest cases from being reported.
+
+    Returns:
+        A list of (case, baseline seconds, new seconds) for the cases that are
+        slower than the baseline by more than the threshold.
+    """
+    regressions = []
+    for case, seconds in sorted(results.items()):
+        if case in baseline and seconds > baseline[case] * (1 + threshold) \
+                and seconds - baseline[case] > min_delta:
+            regressions.append((case, baseline[case], seconds))
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the STL to LEGO conversion.")
+    parser.add_argument("--heights", nargs="+", type=int, default=list(DEFAULT_HEIGHTS),
+                        help="target heights in LEGO bricks")
+    parser.add_argument("--backends", nargs="+", default=list(DEFAULT_BACKENDS),
+                        help="voxelization backends to time")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="runs per case, the fastest is kept")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="file the results are written to")
+    parser.add_argument("--save", default=None,
+                        help="also save the results as a baseline at this path")
+    parser.add_argument("--compare", default=None,
+                        help="baseline to compare the results against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default: 0.2)")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="ignore slowdowns smaller than this many seconds (default: 0.005)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    results = run_benchmarks(args.heights, args.backends, args.repeats)
+
+    report = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "trimesh": trimesh.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "heights": args.heights,
+        "backends": args.backends,
+        "repeats": args.repeats,
+        "results": results,
+    }
+
+    for path in filter(None, (args.output, args.save)):
+        with open(path, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+    if args.compare is None:
+        return
+
+    with open(args.compare) as infile:
+        baseline = json.load(infile)["results"]
+
+    regressions = compare_results(results, baseline, args.threshold, args.min_delta)
+    for case, old_seconds, new_seconds in regressions:
+        print(f"REGRESSION {case}: {old_seconds:.4f} s -> {new_seconds:.4f} s "
+              f"({new_seconds / old_seconds - 1:+.0%})")
+
+    if regressions:
+        raise SystemExit(f"{len(regressions)} case(s) slower than the baseline by "
+                         f"more than {args.threshold:.0%}")
+    print("No regressions against " + args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+This module contains the catalog of the LEGO bricks a model may be built from.
+The catalog is loaded once from a JSON config file, brick_catalog.json by
+default, and keeps the bricks in the order the tiler tries them together with
+their sizes, footprints and colors as precomputed arrays, so the tiler and the
+renderers never sort or look up bricks per voxel.
+
+A config file lists the bricks with their color:
+
+    {
+        "rotate": true,
+        "priority": "volume",
+        "bricks": [{"size": [1, 2, 4], "color": "purple"}, ...]
+    }
+
+The sizes are (depth, height, width) in cells. With rotate, the rotation of each
+brick in the layer plane is added after it. The priority is "volume" to try the
+largest bricks first or "listed" to try them in the order of the file.
+"""
+
+import functools
+import json
+import os
+
+import matplotlib.colors as mcolors
+import numpy as np
+
+
+# The catalog used when none is given
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "brick_catalog.json")
+
+# Orders the bricks can be tried in
+CATALOG_PRIORITIES = ("volume", "listed")
+
+# Color of bricks that are not in the catalog
+UNKNOWN_BRICK_COLOR = "grey"
+
+
+class BrickCatalog:
+    """
+    The allowed bricks, in the order the tiler tries them.
+
+    Attributes:
+        bricks: The (depth, height, width) of the bricks, in priority order.
+        sizes: (n, 3) integer array of the brick dimensions, in priority order.
+        footprints: (n, 2) integer array of the (height, width) of the bricks.
+        volumes: The number of cells of each brick.
+        max_depth: The largest depth of the bricks.
+        colors: The color name of each brick, in the order of the config file.
+        rgba: (n, 4) array of the RGBA color of the bricks, in priority order.
+        index: The row of each brick in the arrays.
+    """
+
+    def __init__(self, entries, rotate=True, priority="volume"):
+        """
+        Args:
+            entries: The (size, color) of the bricks.
+            rotate: Whether to add the rotation of each brick in the layer plane.
+            priority: The order the bricks are tried in, one of CATALOG_PRIORITIES.
+        """
+        if priority not in CATALOG_PRIORITIES:
+            raise ValueError("Invalid priority. Must be one of: " + ", ".join(CATALOG_PRIORITIES))
+
+        colors = {}
+        for size, color in entries:
+            size = tuple(int(dim) for dim in size)
+            if len(size) != 3 or min(size) < 1:
+                raise ValueError("Invalid brick size. Must be three positive integers.")
+            colors[size] = color
+            if rotate:
+                depth, height, width = size
+                colors[(depth, width, height)] = color
+        if not colors:
+            raise ValueError("Invalid catalog. Please provide at least one brick.")
+
+        listed = list(colors)
+        volumes = np.array([depth * height * width for depth, height, width in listed])
+        if priority == "volume":
+            # Stable, so bricks of the same volume keep the order of the file
+            order = np.argsort(-volumes, kind="stable")
+        else:
+            order = np.arange(len(listed))
+
+        self.bricks = tuple(listed[i] for i in order)
+        self.sizes = np.array(self.bricks, dtype=np.int64)
+        self.footprints = self.sizes[:, 1:]
+        self.volumes = volumes[order]
+        self.max_depth = int(self.sizes[:, 0].max())
+        self.colors = colors
+        self.rgba = mcolors.to_rgba_array([colors[brick] for brick in self.bricks])
+        self.index = {brick: row for row, brick in enumerate(self.bricks)}
+
+    @classmethod
+    def from_bricks(cls, bricks):
+        """
+        Creates a catalog of the given bricks, tried largest first, without rotations.
+        """
+        return cls([(brick, UNKNOWN_BRICK_COLOR) for brick in bricks], rotate=False)
+
+    def __len__(self):
+        return len(self.bricks)
+
+    def __iter__(self):
+        return iter(self.bricks)
+
+    def rgba_of(self, bricks) -> np.ndarray:
+        """
+        Returns the RGBA colors of the given bricks, grey for bricks not in the catalog.
+        """
+        unknown = mcolors.to_rgba(UNKNOWN_BRICK_COLOR)
+        return np.array([self.rgba[self.index[tuple(brick)]] if tuple(brick) in self.index
+                         else unknown for brick in bricks]).reshape(-1, 4)
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalog(path=DEFAULT_CATALOG_PATH) -> BrickCatalog:
+    """
+    Loads a brick catalog from a JSON config file, see the module description.
+    Each file is only read once.
+
+    Args:
+        path: The path of the config file.
+
+    Returns:
+        The catalog.
+    """
+    with open(path) as infile:
+        config = json.load(infile)
+
+    try:
+        entries = [(brick["size"], brick.get("color", UNKNOWN_BRICK_COLOR))
+                   for brick in config["bricks"]]
+    except (KeyError, TypeError):
+        raise ValueError("Invalid catalog. Every brick needs a size.") from None
+
+    return BrickCatalog(entries, config.get("rotate", True), config.get("priority", "volume"))
+
+
+def as_catalog(bricks) -> BrickCatalog:
+    """
+    Returns the catalog of the bricks passed to the tiler: the default catalog for
+    None, the catalog itself, or a catalog of a list of brick dimensions.
+    """
+    if bricks is None:
+        return load_catalog()
+    if isinstance(bricks, BrickCatalog):
+        return bricks
+    return BrickCatalog.from_bricks(bricks)
@@ -0,0 +1,190 @@
+"""
+This module contains the connectivity check of a tiled model. Two bricks are
+connected when one stands on the other, so the studs of the lower brick reach
+into the upper one. Every brick of the base layer stands on the ground. Bricks
+that are not connected to the ground through a chain of such contacts would
+fall off the finished model.
+
+The contacts are found layer by layer from the labels of the bricks covering
+each cell (see bricker_functions.LABEL_DTYPE), with one vectorized comparison
+of every layer with the layer below, and the connected components are kept in
+a union-find structure. The structure can also be updated while tiling, see
+tile_volume.
+"""
+
+import numpy as np
+
+import instrumentation
+from bricker_functions import LABEL_DTYPE, bricks_to_arrays
+
+
+class BrickGraph:
+    """
+    The connected components of the stud contacts between placed bricks, kept
+    in a union-find structure. The nodes are the brick labels, the label of a
+    brick being its index in the list of placed bricks plus one, and node 0 is
+    the ground.
+
+    Attributes:
+        contacts: The number of distinct stud contacts added.
+    """
+
+    def __init__(self):
+        self._parent = [0]
+        self.contacts = 0
+
+    def _find(self, node) -> int:
+        parent = self._parent
+        while parent[node] != node:
+            # Path halving
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def _union(self, first, second):
+        first, second = self._find(first), self._find(second)
+        if first != second:
+            # The larger root joins the smaller, so the ground always stays a root
+            if first < second:
+                first, second = second, first
+            self._parent[first] = second
+
+    def _grow(self, num_bricks):
+        if num_bricks >= len(self._parent):
+            self._parent.extend(range(len(self._parent), num_bricks + 1))
+
+    def add_layer(self, labels, labels_below):
+        """
+        Adds the bricks of a finished layer and their contacts with the layer below.
+
+        Args:
+            labels: 2D array of the brick label of every cell of the layer, 0 where empty.
+            labels_below: The labels of the layer below, or None for the base layer,
+                whose bricks stand on the ground.
+        """
+        present = np.unique(labels[labels != 0])
+        if len(present):
+            self._grow(int(present[-1]))
+
+        if labels_below is None:
+            pairs = np.column_stack((present, np.zeros_like(present)))
+        else:
+            # Cells of two different bricks on top of each other
+            touching = (labels != 0) & (labels_below != 0) & (labels != labels_below)
+            codes = np.unique(labels[touching].astype(np.int64) << 32
+                              | labels_below[touching].astype(np.int64))
+            pairs = np.column_stack((codes >> 32, codes & 0xFFFFFFFF))
+            if len(pairs):
+                self._grow(int(pairs[:, 1].max()))
+
+        self.contacts += len(pairs)
+        for upper, lower in pairs.tolist():
+            self._union(upper, lower)
+
+    def grounded(self, num_bricks=None) -> np.ndarray:
+        """
+        Returns for every brick whether it is connected to the ground.
+
+        Args:
+            num_bricks: The number of placed bricks, the bricks added so far by default.
+
+        Returns:
+            A boolean array indexed by the brick index.
+        """
+        if num_bricks is None:
+            num_bricks = len(self._parent) - 1
+        self._grow(num_bricks)
+        return np.array([self._find(label) == 0 for label in range(1, num_bricks + 1)],
+                        dtype=bool)
+
+    def floating(self, num_bricks=None) -> np.ndarray:
+        """
+        Returns the indices of the bricks that are not connected to the ground, see grounded.
+        """
+        return np.flatnonzero(~self.grounded(num_bricks))
+
+
+def label_layers(bricks_placed):
+    """
+    Draws the labels of the placed bricks one layer at a time, so no label volume
+    of the whole model is needed.
+
+    Args:
+        bricks_placed: The bricks placed and their positions, as returned by tile_volume.
+
+    Yields:
+        The 2D label array of every layer from the bottom, see LABEL_DTYPE.
+    """
+    dims, positions = bricks_to_arrays(bricks_placed)
+    if len(dims) == 0:
+        return
+
+    num_z, num_y, num_x = (positions + dims).max(axis=0)
+    bottoms = positions[:, 0]
+    tops = bottoms + dims[:, 0]
+    order = np.argsort(bottoms, kind="stable").tolist()
+
+    # Bricks spanning the current layer
+    active = []
+    next_brick = 0
+    for z in range(num_z):
+        while next_brick < len(order) and bottoms[order[next_brick]] == z:
+            active.append(order[next_brick])
+            next_brick += 1
+        active = [index for index in active if tops[index] > z]
+
+        labels = np.zeros((num_y, num_x), dtype=LABEL_DTYPE)
+        for index in active:
+            _, height, width = dims[index]
+            _, y, x = positions[index]
+            labels[y:y + height, x:x + width] = index + 1
+        yield labels
+
+
+def find_floating_bricks(bricks_placed, tiled_volume=None) -> np.ndarray:
+    """
+    Finds the bricks that are not connected to the base layer through stud contacts.
+
+    Args:
+        bricks_placed: The bricks placed and their positions, as returned by tile_volume.
+        tiled_volume: Optional label volume of the bricks, as returned by tile_volume,
+            which saves drawing the labels. Without it the labels are drawn from
+            bricks_placed one layer at a time.
+
+    Returns:
+        The indices of the floating bricks in bricks_placed.
+    """
+    if tiled_volume is not None and tiled_volume.dtype.itemsize < LABEL_DTYPE.itemsize:
+        raise ValueError("Invalid tiled volume. Must be a label volume, see LABEL_DTYPE.")
+
+    layers = label_layers(bricks_placed) if tiled_volume is None \
+        else (tiled_volume[z] for z in range(tiled_volume.shape[0]))
+
+    graph = BrickGraph()
+    labels_below = None
+    for labels in layers:
+        graph.add_layer(labels, labels_below)
+        labels_below = labels
+
+    floating = graph.floating(len(bricks_placed))
+    instrumentation.count("stud_contacts", graph.contacts)
+    instrumentation.count("floating_bricks", len(floating))
+
+    return floating
+
+
+def remove_floating_bricks(bricks_placed, tiled_volume=None) -> tuple:
+    """
+    Removes the bricks that are not connected to the base layer, see find_floating_bricks.
+
+    Returns:
+        A tuple with the list of the connected bricks, in their original order,
+        and the indices of the floating bricks in bricks_placed.
+    """
+    floating = find_floating_bricks(bricks_placed, tiled_volume)
+    if not len(floating):
+        return list(bricks_placed), floating
+
+    floating_set = set(floating.tolist())
+    return [placed for index, placed in enumerate(bricks_placed)
+            if index not in floating_set], floating
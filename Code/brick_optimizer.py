@@ -0,0 +1,286 @@
+"""
+This module contains an anytime optimizer that reduces the number of bricks of a
+tiled model. It starts from the result of the greedy tiler and improves it layer
+by layer until a time budget runs out, so more time gives fewer bricks, and the
+best model found so far is returned at the deadline.
+
+Each step takes a small window of a layer, removes the bricks that lie
+completely inside it and covers their cells again with the fewest bricks, found
+by an exact branch and bound search. Among covers with the same number of
+bricks, the one with the fewest seams lined up with the seams of the layers
+below and above is preferred, which gives a stronger model. The filled cells
+never change, so every step keeps the model valid.
+"""
+
+import time
+
+import numpy as np
+
+import instrumentation
+
+
+# Edge length of the windows that are optimized, in cells
+OPTIMIZER_WINDOW = 6
+
+# Maximum number of search nodes per window, bounds the time of one step
+OPTIMIZER_MAX_NODES = 20000
+
+
+def _aligned_seams(labels, neighbors) -> int:
+    """
+    Counts the seams of a layer that line up with a seam of a neighboring layer.
+    A seam is a cell edge between two cells of different bricks.
+
+    Args:
+        labels: 2D array of the brick of every cell of the layer, -1 where empty.
+        neighbors: 2D label arrays of the same region of the neighboring layers.
+
+    Returns:
+        The number of aligned seams.
+    """
+    def seams(layer):
+        filled = layer >= 0
+        return ((layer[:, 1:] != layer[:, :-1]) & filled[:, 1:] & filled[:, :-1],
+                (layer[1:, :] != layer[:-1, :]) & filled[1:, :] & filled[:-1, :])
+
+    vertical, horizontal = seams(labels)
+    total = 0
+    for neighbor in neighbors:
+        neighbor_vertical, neighbor_horizontal = seams(neighbor)
+        total += int(np.count_nonzero(vertical & neighbor_vertical))
+        total += int(np.count_nonzero(horizontal & neighbor_horizontal))
+    return total
+
+
+class _Layer:
+    """
+    The bricks of one layer with the brick index of every cell.
+
+    Attributes:
+        bricks: The (height, width, y, x) of the bricks, None for removed bricks.
+        labels: 2D array of the brick index of every cell, -1 where empty.
+    """
+
+    def __init__(self, shape):
+        self.bricks = []
+        self.labels = np.full(shape, -1, dtype=np.int64)
+
+    def add(self, height, width, y, x):
+        self.labels[y:y + height, x:x + width] = len(self.bricks)
+        self.bricks.append((height, width, y, x))
+
+
+def _cover_window(layer, below, above, footprints, window, max_nodes):
+    """
+    Covers the cells of the bricks inside a window of a layer again with the fewest
+    bricks, and the fewest seams aligned with the neighboring layers among those.
+
+    Args:
+        layer: The _Layer to improve.
+        below: The label array of the layer below, or None for the base layer.
+        above: The label array of the layer above, or None for the top layer.
+        footprints: The (height, width) of the allowed bricks.
+        window: The (y, x, height, width) of the window.
+        max_nodes: The maximum number of search nodes.
+
+    Returns:
+        The number of bricks saved, 0 if the layer was not changed.
+    """
+    y0, x0, num_y, num_x = window
+    labels = layer.labels[y0:y0 + num_y, x0:x0 + num_x]
+
+    # The bricks completely inside the window
+    inside = []
+    for index in np.unique(labels[labels >= 0]).tolist():
+        height, width, y, x = layer.bricks[index]
+        if y >= y0 and x >= x0 and y + height <= y0 + num_y and x + width <= x0 + num_x:
+            inside.append(index)
+    if len(inside) < 2:
+        return 0
+
+    # The cells of the window as bits, in raster order
+    region = np.isin(labels, inside)
+    region_mask = 0
+    for wy, wx in np.argwhere(region).tolist():
+        region_mask |= 1 << (wy * num_x + wx)
+
+    # Bricks supported in the window, anchored at their top left cell
+    supported = None
+    if below is not None:
+        filled_below = below[y0:y0 + num_y, x0:x0 + num_x] >= 0
+        supported = np.zeros((num_y + 1, num_x + 1), dtype=np.int64)
+        np.cumsum(np.cumsum(filled_below, axis=0), axis=1, out=supported[1:, 1:])
+
+    options = {}
+    for wy, wx in np.argwhere(region).tolist():
+        cell_options = []
+        for height, width in footprints:
+            if wy + height > num_y or wx + width > num_x:
+                continue
+            row = ((1 << width) - 1) << wx
+            rect = 0
+            for dy in range(height):
+                rect |= row << ((wy + dy) * num_x)
+            if rect & ~region_mask:
+                continue
+            if supported is not None and (
+                    supported[wy + height, wx + width] - supported[wy, wx + width]
+                    - supported[wy + height, wx] + supported[wy, wx]) == 0:
+                continue
+            cell_options.append((rect, height, width))
+        options[wy * num_x + wx] = cell_options
+
+    # Seams are compared on the window and a margin of one cell around it
+    margin_y = slice(max(0, y0 - 1), y0 + num_y + 1)
+    margin_x = slice(max(0, x0 - 1), x0 + num_x + 1)
+    offset_y, offset_x = y0 - margin_y.start, x0 - margin_x.start
+    neighbors = [other[margin_y, margin_x] for other in (below, above) if other is not None]
+
+    def seam_cost(cover):
+        candidate = layer.labels[margin_y, margin_x].copy()
+        for number, (cell, height, width) in enumerate(cover):
+            wy, wx = divmod(cell, num_x)
+            candidate[offset_y + wy:offset_y + wy + height,
+                      offset_x + wx:offset_x + wx + width] = len(layer.bricks) + number
+        return _aligned_seams(candidate, neighbors)
+
+    current_cover = [((layer.bricks[index][2] - y0) * num_x + layer.bricks[index][3] - x0,
+                      layer.bricks[index][0], layer.bricks[index][1]) for index in inside]
+    best = {"count": len(inside), "seams": seam_cost(current_cover), "cover": None}
+    max_area = max(height * width for height, width in footprints)
+    nodes = 0
+
+    def search(covered, cover):
+        nonlocal nodes
+        nodes += 1
+        if nodes > max_nodes:
+            return
+
+        remaining = region_mask & ~covered
+        if not remaining:
+            if len(cover) <= best["count"]:
+                seams = seam_cost(cover)
+                if (len(cover), seams) < (best["count"], best["seams"]):
+                    best.update(count=len(cover), seams=seams, cover=list(cover))
+            return
+
+        # Every remaining cell needs a brick, bound by the largest brick
+        if len(cover) + -(-bin(remaining).count("1") // max_area) > best["count"]:
+            return
+
+        # The first free cell in raster order is the top left cell of its brick
+        cell = (remaining & -remaining).bit_length() - 1
+        for rect, height, width in options[cell]:
+            if not rect & covered:
+                cover.append((cell, height, width))
+                search(covered | rect, cover)
+                cover.pop()
+
+    search(0, [])
+    instrumentation.count("optimizer_nodes", nodes)
+
+    if best["cover"] is None:
+        return 0
+
+    for index in inside:
+        layer.bricks[index] = None
+    for cell, height, width in best["cover"]:
+        wy, wx = divmod(cell, num_x)
+        layer.add(height, width, y0 + wy, x0 + wx)
+
+    return len(inside) - best["count"]
+
+
+def _windows(num_y, num_x, size, offset):
+    """
+    Returns the (y, x, height, width) windows of a grid covering a layer, with the
+    grid shifted up and left by offset cells and the windows clipped to the layer.
+    """
+    windows = []
+    for y in range(-offset, num_y, size):
+        for x in range(-offset, num_x, size):
+            y_start, x_start = max(0, y), max(0, x)
+            windows.append((y_start, x_start, min(y + size, num_y) - y_start,
+                            min(x + size, num_x) - x_start))
+    return windows
+
+
+def optimize_bricks(bricks_placed, time_budget=1.0, window=OPTIMIZER_WINDOW, seed=0,
+                    max_nodes=OPTIMIZER_MAX_NODES, catalog=None):
+    """
+    Reduces the number of bricks of a tiled model within a time budget, see the module
+    description. The filled cells are the same as in the input.
+
+    Args:
+        bricks_placed: The bricks placed by the tiler, as returned by tile_volume.
+        time_budget: The wall clock time in seconds after which the best model found so
+            far is returned.
+        window: The edge length of the optimized windows in cells.
+        seed: The seed of the random window positions used after the first passes.
+        max_nodes: The maximum number of search nodes per window.
+        catalog: Optional BrickCatalog of the allowed bricks. Its bricks one layer
+            tall may be used in both orientations, in addition to the bricks placed.
+            Without it, only the bricks already in the model are used.
+
+    Returns:
+        The list of bricks placed, in the format of tile_volume.
+    """
+    deadline = time.perf_counter() + time_budget
+
+    if any(placed["brick"][0] != 1 for placed in bricks_placed):
+        raise ValueError("Invalid bricks. The optimizer only supports bricks one layer tall.")
+    if not bricks_placed:
+        return []
+
+    footprints = {tuple(placed["brick"][1:]) for placed in bricks_placed}
+    if catalog is not None:
+        for depth, height, width in catalog:
+            if depth == 1:
+                footprints.update({(height, width), (width, height)})
+    footprints = sorted(footprints, key=lambda footprint: footprint[0] * footprint[1],
+                        reverse=True)
+    num_z = max(placed["position"][0] for placed in bricks_placed) + 1
+    num_y = max(placed["position"][1] + placed["brick"][1] for placed in bricks_placed)
+    num_x = max(placed["position"][2] + placed["brick"][2] for placed in bricks_placed)
+
+    layers = [_Layer((num_y, num_x)) for _ in range(num_z)]
+    for placed in bricks_placed:
+        z, y, x = placed["position"]
+        layers[z].add(placed["brick"][1], placed["brick"][2], y, x)
+
+    rng = np.random.default_rng(seed)
+    bricks_saved = 0
+    windows_tried = 0
+    passes = 0
+
+    while time.perf_counter() < deadline:
+        # Two passes on shifted grids of windows, then random window positions
+        if passes < 2:
+            offset = passes * (window // 2)
+        else:
+            offset = int(rng.integers(1, window))
+        saved_in_pass = 0
+
+        for z, layer in enumerate(layers):
+            below = layers[z - 1].labels if z > 0 else None
+            above = layers[z + 1].labels if z + 1 < num_z else None
+
+            for current_window in _windows(num_y, num_x, window, offset):
+                if time.perf_counter() >= deadline:
+                    break
+                windows_tried += 1
+                saved_in_pass += _cover_window(layer, below, above, footprints,
+                                               current_window, max_nodes)
+
+        bricks_saved += saved_in_pass
+        passes += 1
+        # Stop early once random windows no longer find anything
+        if passes > 2 and saved_in_pass == 0:
+            break
+
+    instrumentation.count("optimizer_windows", windows_tried)
+    instrumentation.count("optimizer_bricks_saved", bricks_saved)
+
+    return [{"brick": (1, height, width), "position": (z, y, x)}
+            for z, layer in enumerate(layers)
+            for height, width, y, x in filter(None, layer.bricks)]
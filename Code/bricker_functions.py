@@ -1,17 +1,29 @@
 """
 This script contains a collection of functions designed for generating, manipulating, and plotting 3D LEGO models.
 The core functionality includes switching array axes, checking if a LEGO brick can be placed or is supported at a 
-given position, placing bricks, and generating plots of completed models. In addition, bricks and their rotations 
-are defined and colors are assigned for plotting.
+given position, placing bricks, and generating plots of completed models. The allowed bricks, their rotations 
+and their plot colors come from the brick catalog, see brick_catalog.py.
 
 Authors: Max Idermark & Mats Gard
 """
 
 import itertools
+import multiprocessing
+import os
 import numpy as np
 import json
+import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 import time
+import trimesh
+
+import instrumentation
+
+from brick_catalog import BrickCatalog, as_catalog, load_catalog
+from progress import check_cancelled
+from sparse_grid import ChunkedGrid
+
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
 
 def switch_axis_of_array(array, new_axes_order):
@@ -56,21 +68,115 @@ def can_place_brick(brick, volume_array, tiled_volume, z, y, x):
                     or y + dy >= volume_array.shape[1]
                     or x + dx >= volume_array.shape[2]
                     or not volume_array[z + dz, y + dy, x + dx]
-                    or tiled_volume[z + dz, y + dy, x + dx] == 1
+                    or tiled_volume[z + dz, y + dy, x + dx] != 0
                 ):
                     return False
     return True
 
 
+def summed_area_table(layer):
+    """
+    Computes the summed-area table of a 2D array. The table has one extra row and 
+    column of zeros in front, so the sum of layer[y0:y1, x0:x1] is
+    table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0].
+
+    Parameters:
+    layer (numpy.ndarray): The 2D array to sum.
+
+    Returns:
+    numpy.ndarray: The summed-area table, of shape (layer.shape[0] + 1, layer.shape[1] + 1).
+    """
+    table = np.zeros((layer.shape[0] + 1, layer.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(layer, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def brick_fit_map(brick, volume_array, tiled_volume, z):
+    """
+    Determines for every position in layer z whether a brick can be placed there. 
+    This gives the same answer as can_place_brick for all (y, x) of the layer at once.
+
+    Parameters:
+    brick (tuple): The dimensions of the brick.
+    volume_array (numpy.ndarray): The 3D array representing the volume to be filled.
+    tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
+    z (int): The layer of the volume array where the brick should be placed.
+
+    Returns:
+    numpy.ndarray: A 2D boolean array that is True where the brick fits.
+    """
+    return layer_fit_maps([brick], volume_array, tiled_volume, z)[brick]
+
+
+def layer_fit_maps(bricks, volume_array, tiled_volume, z):
+    """
+    Computes the fit map of every brick for layer z, see brick_fit_map. The free cells and 
+    their summed-area table are computed once for all bricks of the same depth.
+
+    Parameters:
+    bricks (list): The dimensions of the bricks.
+    volume_array (numpy.ndarray): The 3D array representing the volume to be filled.
+    tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
+    z (int): The layer of the volume array.
+
+    Returns:
+    dict: The fit map of each brick, keyed on the brick dimensions.
+    """
+    num_y, num_x = volume_array.shape[1:]
+    tables = {}
+    fit_maps = {}
+
+    for brick in bricks:
+        depth, height, width = brick
+        fit_map = np.zeros((num_y, num_x), dtype=bool)
+        fit_maps[brick] = fit_map
+
+        # Bricks reaching outside the volume never fit
+        if z + depth > volume_array.shape[0] or height > num_y or width > num_x:
+            continue
+
+        table = tables.get(depth)
+        if table is None:
+            # Cells that are free in every layer the bricks of this depth span
+            free = np.logical_and.reduce(
+                volume_array[z:z + depth].astype(bool) & (tiled_volume[z:z + depth] == 0), axis=0)
+            table = tables[depth] = summed_area_table(free)
+
+        # The brick fits where the sum over its footprint equals its area
+        footprint_sum = (table[height:, width:] - table[:-height, width:]
+                         - table[height:, :-width] + table[:-height, :-width])
+        fit_map[:num_y - height + 1, :num_x - width + 1] = footprint_sum == height * width
+
+    return fit_maps
+
+
+def update_fit_maps(fit_maps, placed_brick, y, x):
+    """
+    Updates the fit maps of a layer after a brick has been placed at (y, x). Only the
+    positions where a brick would overlap the placed brick change, and those can no 
+    longer hold a brick.
+
+    Parameters:
+    fit_maps (dict): The fit maps of the layer, as returned by layer_fit_maps.
+    placed_brick (tuple): The dimensions of the placed brick.
+    y, x (int): The coordinates in the layer where the brick was placed.
+    """
+    for brick, fit_map in fit_maps.items():
+        fit_map[max(0, y - brick[1] + 1):y + placed_brick[1],
+                max(0, x - brick[2] + 1):x + placed_brick[2]] = False
+
 
-def is_brick_supported(brick, tiled_volume, z, y, x):
+def is_brick_supported(brick, tiled_volume, z, y, x, support_table=None):
     """
-    Checks if a brick at a given position is supported by another brick.
+    Checks if a brick at a given position is supported by another brick, that is if any
+    cell of the layer directly below its footprint is filled.
 
     Parameters:
     brick (tuple): The dimensions of the brick.
     tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
     z, y, x (int): The coordinates in the volume array of the brick.
+    support_table (numpy.ndarray): Optional summed-area table of layer z - 1, as returned 
+    by layer_support_table. With a table the check takes constant time.
 
     Returns:
     bool: True if the brick is supported, False otherwise.
@@ -78,67 +184,613 @@ def is_brick_supported(brick, tiled_volume, z, y, x):
     if z == 0:  # The brick is on the base layer, and it is supported by default
         return True
 
-    for dz in range(brick[0]):
-        for dy in range(brick[1]):
-            for dx in range(brick[2]):
-                # Check if there's a brick directly below
-                if any(tiled_volume[z - 1, y + dy - bdy, x + dx - bdx] == 1
-                       for bdy in range(brick[1])
-                       for bdx in range(brick[2])):
-                    return True
+    # Footprint of the brick, clipped to the volume
+    y_end = min(y + brick[1], tiled_volume.shape[1])
+    x_end = min(x + brick[2], tiled_volume.shape[2])
+
+    if support_table is None:
+        return bool(np.any(tiled_volume[z - 1, y:y_end, x:x_end] != 0))
+
+    # Number of filled cells below the footprint
+    filled_below = (support_table[y_end, x_end] - support_table[y, x_end]
+                    - support_table[y_end, x] + support_table[y, x])
+    return filled_below > 0
+
+
+def layer_support_table(tiled_volume, z):
+    """
+    Builds the summed-area table of the filled cells in layer z - 1, which answers the 
+    support queries of is_brick_supported for bricks in layer z in constant time. 
+    Layer z - 1 must be completely tiled before the table is built.
+
+    Parameters:
+    tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
+    z (int): The layer of the bricks to be supported.
+
+    Returns:
+    numpy.ndarray: The summed-area table, or None for the base layer.
+    """
+    if z == 0:
+        return None
+    return summed_area_table(tiled_volume[z - 1] != 0)
+
 
-    return False
+# Data type of the label volumes of tile_volume, which hold the label of the brick covering
+# every cell: its index in the list of placed bricks plus one, and 0 where the cell is empty
+LABEL_DTYPE = np.dtype(np.int32)
 
 
-def place_brick(brick, tiled_volume, z, y, x, bricks_placed):
+def place_brick(brick, tiled_volume, z, y, x, bricks_placed, first_label=1):
     """
-    Places a brick in the volume and records its position.
+    Places a brick in the volume and records its position. In a label volume the cells of 
+    the brick get its label, see LABEL_DTYPE. Tiled volumes with a data type too small for 
+    labels, such as the uint8 of a ChunkedGrid, get 1.
 
     Parameters:
     brick (tuple): The dimensions of the brick.
     tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
     z, y, x (int): The coordinates in the volume array where the brick should be placed.
     bricks_placed (list): A list of bricks that have been placed and their positions.
+    first_label (int): The label of the first brick of bricks_placed, for lists that only hold
+    the bricks placed since an earlier brick, see tile_layers.
     """
-    for dz in range(brick[0]):
-        for dy in range(brick[1]):
-            for dx in range(brick[2]):
-                tiled_volume[z + dz, y + dy, x + dx] = 1
+    label = first_label + len(bricks_placed) \
+        if tiled_volume.dtype.itemsize >= LABEL_DTYPE.itemsize else 1
+    tiled_volume[z:z + brick[0], y:y + brick[1], x:x + brick[2]] = label
     bricks_placed.append({"brick": brick, "position": (z, y, x)})
 
 
-def plot_legos(tiled_volume, volume_array):
+def _tile_layer(sorted_bricks, voxel_array, tiled_volume, z, free_layer, max_depth,
+                y_order, x_order, bricks_placed, first_label=1):
     """
-    Plots the LEGO model using matplotlib, given the final tiled volume and the volume array.
+    Tiles layer z of the volume for tile_volume. The fit maps are only computed inside the
+    bounding box of the free cells of the layer, since a brick can not fit where any of its
+    cells is not free. Empty regions of the layer, such as empty chunks of a ChunkedGrid, are
+    never visited.
 
     Parameters:
-    tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
-    volume_array (numpy.ndarray): The 3D array representing the volume to be filled.
+    free_layer (numpy.ndarray): The 2D boolean array of the cells of the layer that need a
+    brick. Updated in place as bricks are placed.
+    max_depth (int): The largest depth of the bricks.
+    first_label (int): See place_brick.
+    The other parameters are those of tile_volume.
+
+    Returns:
+    int: The number of candidate bricks tested.
+    """
+    free_rows = np.flatnonzero(free_layer.any(axis=1))
+    if not len(free_rows):
+        return 0
+    free_columns = np.flatnonzero(free_layer.any(axis=0))
+    y_start, y_stop = free_rows[0], free_rows[-1] + 1
+    x_start, x_stop = free_columns[0], free_columns[-1] + 1
+    z_stop = min(z + max_depth, voxel_array.shape[0])
+
+    # Where each brick fits in the window, updated as bricks are placed
+    fit_maps = layer_fit_maps(sorted_bricks,
+                              voxel_array[z:z_stop, y_start:y_stop, x_start:x_stop],
+                              tiled_volume[z:z_stop, y_start:y_stop, x_start:x_stop], 0)
+    # The layer below is finished, so its support table stays valid
+    support_table = layer_support_table(tiled_volume, z)
+
+    # Visit only the cells that need a brick, in the scan order
+    rows, columns = np.nonzero(free_layer[np.ix_(y_order, x_order)])
+
+    candidates_tested = 0
+    for y, x in zip(y_order[rows].tolist(), x_order[columns].tolist()):
+        # The cell may have been covered by a brick placed earlier in the layer
+        if not free_layer[y, x]:
+            continue
+
+        for brick in sorted_bricks:
+            candidates_tested += 1
+            if fit_maps[brick][y - y_start, x - x_start] and \
+                    is_brick_supported(brick, tiled_volume, z, y, x, support_table):
+
+                place_brick(brick, tiled_volume, z, y, x, bricks_placed, first_label)
+                free_layer[y:y + brick[1], x:x + brick[2]] = False
+                update_fit_maps(fit_maps, brick, y - y_start, x - x_start)
+                # Stop iterating through bricks since one has been placed
+                break
+
+    return candidates_tested
+
+
+# Scan orders supported by tile_volume
+TILING_ORDERS = ("center", "raster")
+
+
+def scan_order(length, order):
+    """
+    Returns the order in which the rows or columns of a layer are visited.
+
+    Parameters:
+    length (int): The number of rows or columns.
+    order (str): "center" starts in the middle and wraps around, "raster" starts at 0.
+
+    Returns:
+    numpy.ndarray: The indices in visiting order.
+    """
+    if order not in TILING_ORDERS:
+        raise ValueError("Invalid order. Must be one of: " + ", ".join(TILING_ORDERS))
+
+    start = length // 2 if order == "center" else 0
+    return np.array(list(range(start, length)) + list(range(0, start)), dtype=int)
+
+
+def _new_tiled_volume(voxel_array):
+    """
+    Returns an empty tiled volume for a voxel array: a label volume of LABEL_DTYPE, or a 
+    ChunkedGrid of uint8 flags for a ChunkedGrid.
+    """
+    if isinstance(voxel_array, ChunkedGrid):
+        return ChunkedGrid(voxel_array.shape, np.uint8, voxel_array.chunk_size)
+    return np.zeros(voxel_array.shape, dtype=LABEL_DTYPE)
+
+
+def tile_volume(voxel_array, bricks=None, order="center", tiled_volume=None, progress=None,
+                cancel=None, layer_cache=None, brick_graph=None):
+    """
+    Tiles the volume with LEGO bricks, layer by layer from the bottom. Every free cell is 
+    visited in scan order and the largest brick that fits and is supported is placed there.
+    Nothing is plotted or written to disk. See tile_layers for the bricks of each layer as 
+    soon as it is tiled.
+
+    Parameters:
+    voxel_array (numpy.ndarray): The 3D array representing the volume to be filled, indexed (z, y, x).
+    A ChunkedGrid is also accepted, then the tiled volume is a ChunkedGrid of uint8 flags and only
+    the layers being tiled are ever held as dense arrays.
+    bricks (BrickCatalog): The allowed bricks, tried in the priority order of the catalog. A list 
+    of brick dimensions is also accepted, then the largest bricks are tried first. Defaults to 
+    the catalog of brick_catalog.json.
+    order (str): The scan order of each layer, "center" or "raster", see scan_order.
+    tiled_volume (numpy.ndarray): Optional 3D array representing the already filled volume, where 
+    any nonzero cell is filled. It is filled in place with the labels of the placed bricks, see 
+    place_brick.
+    progress (callable): Optional progress(done, total), called with the number of layers tiled.
+    cancel (CancelToken): Optional token, checked before every layer. Raises ConversionCancelled
+    once it has been cancelled.
+    layer_cache (LayerCache): Optional cache of tiled layers. Layers whose voxels, support and
+    bricks are unchanged since an earlier run are placed from the cache instead of being tiled.
+    Only used when every brick is one layer tall.
+    brick_graph (BrickGraph): Optional connectivity of the bricks, see brick_graph.py. Every 
+    layer is added to it once it is tiled, so floating bricks are known as soon as the tiling 
+    is done. Needs a label volume.
+
+    Returns:
+    tuple: The list of bricks placed and the tiled volume. By default the tiled volume is a label 
+    volume of LABEL_DTYPE, so the brick covering a cell is found with brick_at.
+    """
+    if tiled_volume is None:
+        tiled_volume = _new_tiled_volume(voxel_array)
+
+    bricks_placed = []
+    for _, layer_bricks in tile_layers(voxel_array, bricks, order, tiled_volume, progress,
+                                       cancel, layer_cache, brick_graph):
+        bricks_placed.extend(layer_bricks)
+
+    instrumentation.count("bricks_placed", len(bricks_placed))
+
+    return bricks_placed, tiled_volume
+
+
+def tile_layers(voxel_array, bricks=None, order="center", tiled_volume=None, progress=None,
+                cancel=None, layer_cache=None, brick_graph=None):
+    """
+    Tiles the volume like tile_volume, but hands out the bricks of every layer as soon as the 
+    layer is tiled, so they can be written or shown while the layers above are still being 
+    tiled. Only the bricks of the current layer are kept, see BrickStreamWriter.
+
+    Parameters:
+    The parameters are those of tile_volume. Pass a tiled_volume to keep the tiled volume.
+
+    Yields:
+    tuple: The index z of the layer and the list of the bricks placed in it, in the format of 
+    tile_volume. Bricks taller than one layer belong to the layer of their bottom. The labels of 
+    the bricks continue from one layer to the next, as in tile_volume.
+    """
+    catalog = as_catalog(bricks)
+
+    if tiled_volume is None:
+        tiled_volume = _new_tiled_volume(voxel_array)
+
+    if brick_graph is not None and tiled_volume.dtype.itemsize < LABEL_DTYPE.itemsize:
+        raise ValueError("Invalid tiled volume. The brick graph needs a label volume.")
+
+    # The first brick in priority order that fits is placed
+    sorted_bricks = catalog.bricks
+
+    # Scan order of the rows and columns
+    y_order = scan_order(voxel_array.shape[1], order)
+    x_order = scan_order(voxel_array.shape[2], order)
+
+    max_depth = catalog.max_depth
+    candidates_tested = 0
+    layers_reused = 0
+    # Label of the first brick of the current layer
+    first_label = 1
+
+    # With bricks one layer tall, a layer depends only on the inputs in its cache key
+    use_cache = layer_cache is not None and max_depth == 1
+
+    for z in range(voxel_array.shape[0]):
+        check_cancelled(cancel)
+
+        # Cells that need a brick. Layers of a ChunkedGrid only read the stored chunks.
+        free_layer = voxel_array[z].astype(bool) & (tiled_volume[z] == 0)
+        layer_bricks = []
+
+        if free_layer.any():
+            placements = None
+            if use_cache:
+                key = layer_cache.key(free_layer, tiled_volume[z - 1] != 0 if z > 0 else None,
+                                      sorted_bricks, order)
+                placements = layer_cache.get(key)
+
+            if placements is not None:
+                for brick, y, x in placements:
+                    place_brick(brick, tiled_volume, z, y, x, layer_bricks, first_label)
+                layers_reused += 1
+            else:
+                candidates_tested += _tile_layer(sorted_bricks, voxel_array, tiled_volume, z,
+                                                 free_layer, max_depth, y_order, x_order,
+                                                 layer_bricks, first_label)
+
+                if use_cache:
+                    layer_cache.put(key, [(placed["brick"], placed["position"][1],
+                                           placed["position"][2])
+                                          for placed in layer_bricks])
+
+        # No brick placed later reaches down into this layer
+        if brick_graph is not None:
+            brick_graph.add_layer(tiled_volume[z], tiled_volume[z - 1] if z > 0 else None)
+
+        # Chunks become final once every layer they span is tiled
+        if isinstance(tiled_volume, ChunkedGrid) and (z + 1) % tiled_volume.chunk_size == 0:
+            tiled_volume.compact()
+
+        if progress is not None:
+            progress(z + 1, voxel_array.shape[0])
+
+        first_label += len(layer_bricks)
+        yield z, layer_bricks
+
+    if isinstance(tiled_volume, ChunkedGrid):
+        tiled_volume.compact()
+
+    instrumentation.count("candidate_bricks_tested", candidates_tested)
+    if use_cache:
+        instrumentation.count("layers_reused", layers_reused)
+
+
+def _tile_layer_task(task):
+    """
+    Tiles one layer in a worker process of tile_volume_parallel. The support of the bricks is 
+    checked against the support mask instead of the tiled layer below, which is not known yet.
+
+    Parameters:
+    task (tuple): The sorted bricks, the 2D boolean array of the free cells of the layer, the 2D 
+    boolean support mask of the layer below (None for the base layer) and the scan order.
+
+    Returns:
+    list: The placements of the layer as (brick, y, x) tuples, in placement order.
+    """
+    sorted_bricks, free_layer, support_layer, order = task
+
+    # A volume of the layer on top of its support mask, or of the layer alone at the base
+    layers = [free_layer] if support_layer is None else [support_layer, free_layer]
+    z = len(layers) - 1
+    voxel_array = np.stack(layers)
+    tiled_volume = np.zeros(voxel_array.shape, dtype=LABEL_DTYPE)
+    tiled_volume[:z] = voxel_array[:z]
+
+    bricks_placed = []
+    _tile_layer(sorted_bricks, voxel_array, tiled_volume, z, free_layer.copy(), 1,
+                scan_order(free_layer.shape[0], order), scan_order(free_layer.shape[1], order),
+                bricks_placed)
+
+    return [(placed["brick"], placed["position"][1], placed["position"][2])
+            for placed in bricks_placed]
+
+
+def tile_volume_parallel(voxel_array, bricks=None, order="center", tiled_volume=None, workers=2,
+                         progress=None, cancel=None, layer_cache=None):
+    """
+    Tiles the volume like tile_volume, with the layers tiled concurrently in a process pool. 
+    Since the tiled layer below is not known while a layer is tiled, the bricks are checked for
+    support against the voxels of the layer below instead. A sequential pass then goes up through
+    the layers, removes the bricks that are not supported by the tiled layer below and tiles
+    their cells again with the sequential greedy. The result does not depend on the number of
+    workers, but it can differ slightly from tile_volume. Only bricks one layer tall are
+    supported.
+
+    Parameters:
+    voxel_array (numpy.ndarray): The 3D array representing the volume to be filled, indexed (z, y, x).
+    A ChunkedGrid is also accepted, see tile_volume.
+    bricks (BrickCatalog): The allowed bricks, see tile_volume.
+    order (str): The scan order of each layer, "center" or "raster", see scan_order.
+    tiled_volume (numpy.ndarray): Optional 3D array representing the already filled volume,
+    see tile_volume. It is filled in place.
+    workers (int): The number of worker processes.
+    progress (callable): Optional progress(done, total), called with the number of layers tiled
+    by the workers.
+    cancel (CancelToken): Optional token, checked as the layers arrive. Raises
+    ConversionCancelled once it has been cancelled.
+    layer_cache (LayerCache): Optional cache of tiled layers, see tile_volume. The layers found
+    in it are not sent to the workers, and the layers the workers tile are stored in it. It is
+    keyed by the support mask the workers tile against.
+
+    Returns:
+    tuple: The list of bricks placed and the tiled volume, see tile_volume.
+    """
+    catalog = as_catalog(bricks)
+
+    if catalog.max_depth != 1:
+        raise ValueError("Invalid bricks. Parallel tiling only supports bricks one layer tall.")
+
+    if tiled_volume is None:
+        tiled_volume = _new_tiled_volume(voxel_array)
+
+    sorted_bricks = catalog.bricks
+    num_layers = voxel_array.shape[0]
+
+    # Look up the layers before any is sent to the workers
+    keys = [None] * num_layers
+    cached = {}
+    if layer_cache is not None:
+        filled_below = None
+        for z in range(num_layers):
+            filled = voxel_array[z].astype(bool)
+            free_layer = filled & (tiled_volume[z] == 0)
+            if free_layer.any():
+                keys[z] = layer_cache.key(free_layer, filled_below, sorted_bricks, order)
+                placements = layer_cache.get(keys[z])
+                if placements is not None:
+                    cached[z] = placements
+            filled_below = filled
+
+    # Each layer is tiled on top of the cells of the layer below that are to be filled
+    def layer_tasks():
+        filled_below = None
+        for z in range(num_layers):
+            filled = voxel_array[z].astype(bool)
+            if z not in cached:
+                free_layer = filled & (tiled_volume[z] == 0)
+                yield sorted_bricks, free_layer, filled_below, order
+            filled_below = filled
+
+    # Forked workers start without importing the modules again, like the voxelization pools
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    layer_placements = []
+    with context.Pool(workers) as pool:
+        # The layers arrive in order, whichever worker tiled them
+        tiled_layers = pool.imap(_tile_layer_task, layer_tasks())
+        for z in range(num_layers):
+            if z in cached:
+                placements = cached[z]
+            else:
+                placements = next(tiled_layers)
+                if keys[z] is not None:
+                    layer_cache.put(keys[z], placements)
+            layer_placements.append(placements)
+            if progress is not None:
+                progress(len(layer_placements), num_layers)
+            check_cancelled(cancel)
+
+    # Keep the supported bricks and tile the cells of the others again, going up
+    y_order = scan_order(voxel_array.shape[1], order)
+    x_order = scan_order(voxel_array.shape[2], order)
+    bricks_placed = []
+    bricks_repaired = 0
+
+    for z, placements in enumerate(layer_placements):
+        support_table = layer_support_table(tiled_volume, z)
+        removed = 0
+        for brick, y, x in placements:
+            if is_brick_supported(brick, tiled_volume, z, y, x, support_table):
+                place_brick(brick, tiled_volume, z, y, x, bricks_placed)
+            else:
+                removed += 1
+
+        if removed:
+            bricks_repaired += removed
+            free_layer = voxel_array[z].astype(bool) & (tiled_volume[z] == 0)
+            _tile_layer(sorted_bricks, voxel_array, tiled_volume, z, free_layer, 1,
+                        y_order, x_order, bricks_placed)
+
+        if isinstance(tiled_volume, ChunkedGrid) and (z + 1) % tiled_volume.chunk_size == 0:
+            tiled_volume.compact()
+
+    if isinstance(tiled_volume, ChunkedGrid):
+        tiled_volume.compact()
+
+    instrumentation.count("bricks_repaired", bricks_repaired)
+    instrumentation.count("bricks_placed", len(bricks_placed))
+
+    return bricks_placed, tiled_volume
+
+
+def brick_at(tiled_volume, bricks_placed, z, y, x):
+    """
+    Looks up the brick covering a cell in a label volume in constant time.
+
+    Parameters:
+    tiled_volume (numpy.ndarray): The label volume, as returned by tile_volume.
+    bricks_placed (list): The bricks placed, as returned by tile_volume, or their table as 
+    returned by bricks_to_table.
+    z, y, x (int): The coordinates of the cell.
+
+    Returns:
+    The entry of the brick in bricks_placed, or None if the cell is empty.
+    """
+    label = int(tiled_volume[z, y, x])
+    return bricks_placed[label - 1] if label else None
+
+
+def bricks_to_arrays(bricks_placed):
+    """
+    Converts a list of placed bricks to arrays.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, as returned by tile_volume, or 
+    their table as returned by bricks_to_table or load_bricks_binary.
+
+    Returns:
+    tuple: Two (n, 3) integer arrays with the brick dimensions and the (z, y, x) positions.
+    """
+    if isinstance(bricks_placed, np.ndarray):
+        return bricks_placed["brick"].astype(int), bricks_placed["position"].astype(int)
+
+    dims = np.array([placed["brick"] for placed in bricks_placed], dtype=int).reshape(-1, 3)
+    positions = np.array([placed["position"] for placed in bricks_placed], dtype=int).reshape(-1, 3)
+    return dims, positions
+
+
+def _box_sums(table, start, stop):
+    """
+    Sums boxes of a 3D array using its summed volume table, for many boxes at once.
+
+    Parameters:
+    table (numpy.ndarray): The summed volume table, with a leading zero plane on each axis.
+    start, stop (numpy.ndarray): (n, 3) arrays with the first and one past the last index 
+    of each box.
+
+    Returns:
+    numpy.ndarray: The sum inside each box.
+    """
+    total = np.zeros(len(start), dtype=np.int64)
+    for corner in itertools.product((0, 1), repeat=3):
+        index = tuple(np.where(corner[axis], stop[:, axis], start[:, axis]) for axis in range(3))
+        sign = (-1) ** (3 - sum(corner))
+        total += sign * table[index]
+    return total
+
+
+# Brightness of the faces pointing -z, +z, -y, +y, -x, +x, shades the rendered bricks
+FACE_SHADING = np.array([0.45, 1.0, 0.7, 0.8, 0.6, 0.9])
+
+
+def brick_faces(bricks_placed, brick_colors, voxel_size=(1, 1, 9.6 / 7.8), tiled_volume=None):
+    """
+    Builds the faces of all placed bricks as one array of quads. Faces that are completely 
+    covered by neighbouring bricks are left out.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, as returned by tile_volume.
+    brick_colors (BrickCatalog): The catalog the colors of the bricks are taken from. A dict of
+    colors keyed on the brick dimensions, as returned by generate_allowed_bricks, also works.
+    voxel_size (tuple): The x, y and z size of one cell.
+    tiled_volume (numpy.ndarray): Optional tiled volume of the bricks, as returned by tile_volume. 
+    The occupancy is then read from it instead of being drawn brick by brick.
+
+    Returns:
+    tuple: An (m, 4, 3) array with the x, y, z corners of every visible face and an (m, 4) 
+    array with their RGBA colors, grouped by color.
+    """
+    dims, positions = bricks_to_arrays(bricks_placed)
+    if len(dims) == 0:
+        return np.zeros((0, 4, 3)), np.zeros((0, 4))
+
+    # Occupancy of the model, padded with one empty cell on every side
+    if tiled_volume is not None:
+        occupancy = np.pad(np.asarray(tiled_volume) != 0, 1)
+        shape = np.array(occupancy.shape)
+    else:
+        shape = (positions + dims).max(axis=0) + 2
+        occupancy = np.zeros(shape, dtype=bool)
+        for (depth, height, width), (z, y, x) in zip(dims.tolist(), positions.tolist()):
+            occupancy[z + 1:z + 1 + depth, y + 1:y + 1 + height, x + 1:x + 1 + width] = True
+
+    # Summed volume table of the occupancy, with a leading zero plane on each axis
+    table = np.zeros(shape + 1, dtype=np.int64)
+    table[1:, 1:, 1:] = occupancy.cumsum(0).cumsum(1).cumsum(2)
+
+    # Corners of each brick in the padded grid
+    low = positions + 1
+    high = low + dims
+
+    # A face is hidden when the layer of cells just outside it is completely filled
+    visible = np.zeros((len(dims), 6), dtype=bool)
+    for axis in range(3):
+        area = np.prod(np.delete(dims, axis, axis=1), axis=1)
+        for side in range(2):
+            start, stop = low.copy(), high.copy()
+            if side == 0:
+                start[:, axis] = low[:, axis] - 1
+                stop[:, axis] = low[:, axis]
+            else:
+                start[:, axis] = high[:, axis]
+                stop[:, axis] = high[:, axis] + 1
+            visible[:, 2 * axis + side] = _box_sums(table, start, stop) < area
+
+    # Corners of each brick in (x, y, z) plot coordinates
+    scale = np.asarray(voxel_size, dtype=float)
+    corner_low = positions[:, ::-1] * scale
+    corner_high = (positions + dims)[:, ::-1] * scale
+    x0, y0, z0 = corner_low.T
+    x1, y1, z1 = corner_high.T
+
+    # The four corners of the faces -z, +z, -y, +y, -x, +x of every brick
+    quads = np.stack([
+        [(x0, y0, z0), (x1, y0, z0), (x1, y1, z0), (x0, y1, z0)],
+        [(x0, y0, z1), (x1, y0, z1), (x1, y1, z1), (x0, y1, z1)],
+        [(x0, y0, z0), (x1, y0, z0), (x1, y0, z1), (x0, y0, z1)],
+        [(x0, y1, z0), (x1, y1, z0), (x1, y1, z1), (x0, y1, z1)],
+        [(x0, y0, z0), (x0, y1, z0), (x0, y1, z1), (x0, y0, z1)],
+        [(x1, y0, z0), (x1, y1, z0), (x1, y1, z1), (x1, y0, z1)],
+    ])  # (6, 4, 3, n)
+    quads = quads.transpose(3, 0, 1, 2)  # (n, 6, 4, 3)
+
+    # One color per brick size, looked up once per size
+    sizes, size_index = np.unique(dims, axis=0, return_inverse=True)
+    if isinstance(brick_colors, BrickCatalog):
+        size_colors = brick_colors.rgba_of(sizes.tolist())
+    else:
+        size_colors = mcolors.to_rgba_array([brick_colors.get(tuple(size), "grey")
+                                             for size in sizes.tolist()])
+    face_colors = size_colors[size_index.ravel()][:, None, :].repeat(6, axis=1)
+    face_colors[..., :3] *= FACE_SHADING[None, :, None]
+
+    # Keep the visible faces, grouped by brick color
+    brick_index, face_index = np.nonzero(visible)
+    order = np.argsort(size_index.ravel()[brick_index], kind="stable")
+    brick_index, face_index = brick_index[order], face_index[order]
+
+    return quads[brick_index, face_index], face_colors[brick_index, face_index]
+
+
+def plot_bricks(bricks_placed, brick_colors, height_scale=9.6 / 7.8, tiled_volume=None):
+    """
+    Plots placed LEGO bricks using matplotlib. All bricks are drawn as a single collection 
+    of faces, see brick_faces.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, as returned by tile_volume.
+    brick_colors (BrickCatalog): The catalog the colors of the bricks are taken from, see
+    brick_faces.
+    height_scale (float): The height of a brick relative to its width.
+    tiled_volume (numpy.ndarray): Optional tiled volume of the bricks, see brick_faces.
     """
     # Create a new figure for the plot
     fig = plt.figure()
     # Add a 3D subplot to the figure
     ax = fig.add_subplot(111, projection="3d")
 
-    # Get the dictionary of allowed bricks and their colors
-    allowed_bricks_dict = generate_allowed_bricks()
-    # Extract the keys (brick dimensions) from the dictionary
-    allowed_lego_bricks = list(allowed_bricks_dict.keys())
+    quads, colors = brick_faces(bricks_placed, brick_colors, (1, 1, height_scale), tiled_volume)
+    ax.add_collection3d(Poly3DCollection(quads, facecolors=colors, edgecolors=(0, 0, 0, 0.2),
+                                         linewidths=0.3))
 
-    bricks_placed = []
+    # Collections do not update the axis limits, so set them from the faces
+    if len(quads) > 0:
+        corners = quads.reshape(-1, 3)
+        ax.set_xlim(corners[:, 0].min(), corners[:, 0].max())
+        ax.set_ylim(corners[:, 1].min(), corners[:, 1].max())
+        ax.set_zlim(corners[:, 2].min(), corners[:, 2].max())
 
-    # Attempt to tile the volume with the allowed Lego bricks
-    for z, y, x in itertools.product(range(volume_array.shape[0]), range(volume_array.shape[1]), range(volume_array.shape[2])):
-        if volume_array[z, y, x] and not tiled_volume[z, y, x]:
-            sorted_bricks = sorted(
-                allowed_lego_bricks, key=lambda brick: brick[0] * brick[1] * brick[2], reverse=True)
-            for brick in sorted_bricks:
-                if can_place_brick(brick, volume_array, z, y, x) and is_brick_supported(brick, tiled_volume, z, y, x):
-                    place_brick(brick, tiled_volume, z, y, x, bricks_placed)
-                    ax.bar3d(x, y, z, brick[2], brick[1], brick[0], color=allowed_bricks_dict.get(
-                        brick), shade=True)
-                    # Stop iterating through bricks since one has been placed
-                    break
     # Set the aspect ratio of x and y axes to be equal
     # You can change the values inside the list to adjust the aspect ratio
     ax.set_box_aspect([7.8, 7.8, 9.6])
@@ -152,74 +804,283 @@ def plot_legos(tiled_volume, volume_array):
     plt.show()
 
 
-def center_plot_legos(tiled_volume, voxel_array):
+def save_bricks_mesh(bricks_placed, brick_colors, path, voxel_size=(7.8, 7.8, 9.6),
+                     tiled_volume=None):
+    """
+    Saves the visible faces of the placed bricks as a mesh file, for viewing the model in 
+    external tools. The format follows the extension of the path (.ply, .obj, .stl, .glb, ...).
+    Formats that support it keep the brick colors.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, as returned by tile_volume.
+    brick_colors (BrickCatalog): The catalog the colors of the bricks are taken from, see
+    brick_faces.
+    path (str): The path of the mesh file, including the extension.
+    voxel_size (tuple): The x, y and z size of one cell, in millimeters.
+    tiled_volume (numpy.ndarray): Optional tiled volume of the bricks, see brick_faces.
+    """
+    quads, colors = brick_faces(bricks_placed, brick_colors, voxel_size, tiled_volume)
+
+    # Split every quad into two triangles
+    vertices = quads.reshape(-1, 3)
+    first = np.arange(len(quads))[:, None] * 4
+    faces = np.concatenate([first + [0, 1, 2], first + [0, 2, 3]])
+    face_colors = np.concatenate([colors, colors])
+
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    mesh.visual.face_colors = (face_colors * 255).astype(np.uint8)
+    mesh.export(path)
+
+
+# Record of one placed brick in the binary brick table
+BRICK_DTYPE = np.dtype([("brick", "<i4", (3,)), ("position", "<i4", (3,))])
+
+# Number of bricks converted at a time when a brick table is saved as json
+JSON_CHUNK_BRICKS = 65536
+
+# Header of the binary brick table: magic followed by the number of bricks
+BRICK_TABLE_MAGIC = b"STLBRK01"
+BRICK_TABLE_HEADER = np.dtype([("magic", "S8"), ("count", "<u8")])
+
+
+def bricks_to_table(bricks_placed):
+    """
+    Converts a list of placed bricks to a structured array with fixed-width integer fields.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, as returned by tile_volume.
+
+    Returns:
+    numpy.ndarray: A structured array of BRICK_DTYPE.
+    """
+    table = np.zeros(len(bricks_placed), dtype=BRICK_DTYPE)
+    table["brick"], table["position"] = bricks_to_arrays(bricks_placed)
+    return table
+
+
+def table_to_bricks(table):
+    """
+    Converts a structured brick table back to a list of placed bricks.
+
+    Parameters:
+    table (numpy.ndarray): A structured array of BRICK_DTYPE.
+
+    Returns:
+    list: The bricks placed and their positions, in the format of tile_volume.
+    """
+    return [{"brick": tuple(brick), "position": tuple(position)}
+            for brick, position in zip(table["brick"].tolist(), table["position"].tolist())]
+
+
+def save_bricks_binary(bricks_placed, path):
+    """
+    Saves the placed bricks as a binary brick table at the specified path. The '.bbrk' 
+    extension is automatically added.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions.
+    path (str): The path of the file without extension.
+    """
+    header = np.zeros((), dtype=BRICK_TABLE_HEADER)
+    header["magic"] = BRICK_TABLE_MAGIC
+    header["count"] = len(bricks_placed)
+
+    with open(path + ".bbrk", "wb") as outfile:
+        outfile.write(header.tobytes())
+        outfile.write(bricks_to_table(bricks_placed).tobytes())
+
+
+def load_bricks_binary(path):
+    """
+    Loads a binary brick table saved by save_bricks_binary. The table is memory-mapped,
+    nothing is parsed.
+
+    Parameters:
+    path (str): The path of the file, including the '.bbrk' extension.
+
+    Returns:
+    numpy.ndarray: A read-only structured array of BRICK_DTYPE.
+    """
+    header = np.fromfile(path, dtype=BRICK_TABLE_HEADER, count=1)[0]
+    if header["magic"] != BRICK_TABLE_MAGIC:
+        raise ValueError("Not a brick table file: " + path)
+
+    if header["count"] == 0:
+        return np.zeros(0, dtype=BRICK_DTYPE)
+
+    return np.memmap(path, dtype=BRICK_DTYPE, mode="r", offset=BRICK_TABLE_HEADER.itemsize,
+                     shape=(int(header["count"]),))
+
+
+class BrickStreamWriter:
+    """
+    Writes placed bricks one layer at a time, so readers can start on the bottom layers while 
+    the layers above are still being tiled, see tile_layers. Every layer is flushed as soon as 
+    it is written and only one layer is held in memory.
+
+    The binary file is a brick table as written by save_bricks_binary. The records of a layer 
+    are written before the count in the header is raised, so load_bricks_binary always reads 
+    the complete layers written so far. The optional NDJSON file has one line per layer:
+    {"z": 0, "bricks": [{"brick": [1, 2, 4], "position": [0, 3, 5]}, ...]}
+
+    Use it as a context manager, the files are closed when the block is left.
+    """
+
+    def __init__(self, path, export_ndjson=False):
+        """
+        Parameters:
+        path (str): The path of the files without extension. The '.bbrk' and '.ndjson' 
+        extensions are automatically added.
+        export_ndjson (bool): Whether to also write the NDJSON file.
+        """
+        self.count = 0
+        self._binary = open(path + ".bbrk", "wb")
+        self._ndjson = open(path + ".ndjson", "w") if export_ndjson else None
+        self._write_header()
+
+    def _write_header(self):
+        header = np.zeros((), dtype=BRICK_TABLE_HEADER)
+        header["magic"] = BRICK_TABLE_MAGIC
+        header["count"] = self.count
+        self._binary.seek(0)
+        self._binary.write(header.tobytes())
+        self._binary.seek(0, os.SEEK_END)
+
+    def write_layer(self, z, layer_bricks):
+        """
+        Appends the bricks of one layer and flushes the files.
+
+        Parameters:
+        z (int): The index of the layer.
+        layer_bricks (list): The bricks placed in the layer, as yielded by tile_layers.
+        """
+        self._binary.write(bricks_to_table(layer_bricks).tobytes())
+        self._binary.flush()
+        self.count += len(layer_bricks)
+        self._write_header()
+        self._binary.flush()
+
+        if self._ndjson is not None:
+            self._ndjson.write(json.dumps({"z": int(z), "bricks": layer_bricks}) + "\n")
+            self._ndjson.flush()
+
+    def close(self):
+        self._binary.close()
+        if self._ndjson is not None:
+            self._ndjson.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_bricks_ndjson(path):
+    """
+    Reads the layers of an NDJSON file written by BrickStreamWriter, one layer at a time.
+
+    Parameters:
+    path (str): The path of the file, including the '.ndjson' extension.
+
+    Yields:
+    tuple: The index z of the layer and the list of its bricks, in the format of tile_volume.
+    """
+    with open(path) as infile:
+        for line in infile:
+            # A layer still being written is not complete yet
+            if not line.endswith("\n"):
+                break
+            layer = json.loads(line)
+            yield layer["z"], [{"brick": tuple(placed["brick"]),
+                                "position": tuple(placed["position"])}
+                               for placed in layer["bricks"]]
+
+
+def save_bricks_json(bricks_placed, path):
+    """
+    Saves the placed bricks as a json file at the specified path. The '.json' 
+    extension is automatically added. The file is written in chunks, so a brick table 
+    is never converted to a list of all its bricks.
+
+    Parameters:
+    bricks_placed (list): The bricks placed and their positions, or their table as returned 
+    by load_bricks_binary.
+    path (str): The path of the file without extension.
+    """
+    with open(path + ".json", "w") as json_file:
+        json_file.write("[")
+        for start in range(0, len(bricks_placed), JSON_CHUNK_BRICKS):
+            chunk = bricks_placed[start:start + JSON_CHUNK_BRICKS]
+            if isinstance(chunk, np.ndarray):
+                chunk = table_to_bricks(chunk)
+            # The items of the chunk without the brackets of the list
+            json_file.write((", " if start else "") + json.dumps(chunk)[1:-1])
+        json_file.write("]")
+
+
+def plot_legos(tiled_volume, volume_array):
     """
     Plots the LEGO model using matplotlib, given the final tiled volume and the volume array.
-    This function attempts to tile the volume starting from the middle bottom.
 
     Parameters:
     tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
     volume_array (numpy.ndarray): The 3D array representing the volume to be filled.
     """
+    # Get the catalog of allowed bricks and their colors
+    catalog = load_catalog()
 
-    # Create a new figure for the plot
-    fig = plt.figure()
-    # Add a 3D subplot to the figure
-    ax = fig.add_subplot(111, projection="3d")
+    # Attempt to tile the volume with the allowed Lego bricks
+    bricks_placed, tiled_volume = tile_volume(volume_array, catalog, order="raster",
+                                              tiled_volume=tiled_volume)
 
-    # Get the dictionary of allowed bricks and their colors
-    allowed_bricks_dict = generate_allowed_bricks()
-    # Extract the keys (brick dimensions) from the dictionary
-    allowed_lego_bricks = list(allowed_bricks_dict.keys())
+    plot_bricks(bricks_placed, catalog, height_scale=1, tiled_volume=tiled_volume)
 
-    bricks_placed = []
 
-    # Calculate the middle indices for the volume array
-    middle_indices = [dim // 2 for dim in voxel_array.shape]
+def center_plot_legos(tiled_volume, voxel_array, export_json=True, workers=1):
+    """
+    Plots the LEGO model using matplotlib, given the final tiled volume and the volume array.
+    This function attempts to tile the volume starting from the middle bottom. The placed
+    bricks are saved as latest_bricks_placed.bbrk, and as latest_bricks_placed.json for 
+    the Catia JSON2LEGO tool. With one worker the layers are written to the .bbrk file and 
+    to latest_bricks_placed.ndjson as soon as they are tiled, see BrickStreamWriter.
+
+    Parameters:
+    tiled_volume (numpy.ndarray): The 3D array representing the filled volume.
+    volume_array (numpy.ndarray): The 3D array representing the volume to be filled.
+    export_json (bool): Whether to also save the placed bricks as json.
+    workers (int): With more than one worker the layers are tiled in parallel, see 
+    tile_volume_parallel.
+    """
+    # Get the catalog of allowed bricks and their colors
+    catalog = load_catalog()
 
     start_time = time.time()
-    # Iterate through the volume array starting from the middle bottom
-    for z, y, x in itertools.product(
-        list(range(0, voxel_array.shape[0])),
-        list(range(middle_indices[1], voxel_array.shape[1])
-             ) + list(range(0, middle_indices[1])),
-        list(range(middle_indices[2], voxel_array.shape[2])
-             ) + list(range(0, middle_indices[2]))
-    ):
-        if voxel_array[z, y, x] and not tiled_volume[z, y, x]:
-            sorted_bricks = sorted(
-                allowed_lego_bricks, key=lambda brick: brick[0] * brick[1] * brick[2], reverse=True)
-
-            for brick in sorted_bricks:
-                if can_place_brick(brick, voxel_array, tiled_volume, z, y, x) and \
-                        is_brick_supported(brick, tiled_volume, z, y, x):
-
-                    place_brick(brick, tiled_volume, z, y, x, bricks_placed)
-
-                    ax.bar3d(x, y, z, brick[2], brick[1], brick[0] * 9.6 /
-                             7.8, color=allowed_bricks_dict.get(brick), shade=True)
-                    # Stop iterating through bricks since one has been placed
-                    break
+    # Tile the volume starting from the middle bottom
+    if workers > 1:
+        bricks_placed, tiled_volume = tile_volume_parallel(voxel_array, catalog, order="center",
+                                                           tiled_volume=tiled_volume,
+                                                           workers=workers)
+        save_bricks_binary(bricks_placed, "latest_bricks_placed")
+    else:
+        if tiled_volume is None:
+            tiled_volume = _new_tiled_volume(voxel_array)
+        with BrickStreamWriter("latest_bricks_placed", export_ndjson=export_json) as writer:
+            for z, layer_bricks in tile_layers(voxel_array, catalog, order="center",
+                                               tiled_volume=tiled_volume):
+                writer.write_layer(z, layer_bricks)
+        # Only the bricks of one layer were kept, the plot reads the written brick table
+        bricks_placed = load_bricks_binary("latest_bricks_placed.bbrk")
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"The optimizer took {elapsed_time} seconds to execute.")
 
-    # Save the dictionary as a JSON file
-    with open("latest_bricks_placed.json", "w") as json_file:
-        json.dump(bricks_placed, json_file)
+    # JSON is only needed by the Catia tool
+    if export_json:
+        save_bricks_json(bricks_placed, "latest_bricks_placed")
 
-    # Set the aspect ratio of x and y axes to be equal
-    # You can change the values inside the list to adjust the aspect ratio
-    ax.set_box_aspect([7.8, 7.8, 9.6])
-    plt.gca().set_aspect('equal', adjustable='box')
-
-    # Set the axis labels for the plot
-    ax.set_xlabel("X")
-    ax.set_ylabel("Y")
-    ax.set_zlabel("Z")
-    # Show the plot
-    plt.show()
+    plot_bricks(bricks_placed, catalog, tiled_volume=tiled_volume)
 
 
 def rotate_2D_coordinates(coordinates):
@@ -238,29 +1099,11 @@ def rotate_2D_coordinates(coordinates):
 
 def generate_allowed_bricks():
     """
-    Generates a list of allowed LEGO brick sizes and their corresponding colors.
+    Returns the allowed LEGO brick sizes, including their rotations, and their corresponding
+    colors from the default brick catalog, see brick_catalog.py.
 
     Returns:
-    dict: A dictionary of allowed LEGO bricks. The keys are strings representing 
-    the brick dimensions and the values are their corresponding colors.
+    dict: A dictionary of allowed LEGO bricks. The keys are tuples of the brick dimensions
+    and the values are their corresponding colors.
     """
-
-    brick_list = {
-        (1, 1, 1): "red",
-        (1, 1, 2): "blue",
-        (1, 2, 2): "green",
-        (1, 2, 3): "orange",
-        (1, 2, 4): "purple",
-        (1, 4, 6): "grey",
-        (1, 1, 3): "turquoise",
-    }
-
-    rotated_brick_list = {}
-
-    for coords, color in brick_list.items():
-        for rotated_coords in rotate_2D_coordinates(coords):
-            rotated_brick_list[rotated_coords] = color
-
-    print(rotated_brick_list)
-
-    return rotated_brick_list
+    return dict(load_catalog().colors)
@@ -0,0 +1,260 @@
+"""
+This module contains lightweight instrumentation for the conversion pipeline:
+stage timers, memory sampling and counters, collected into one structured
+record per run. An optional cProfile hook profiles a single selected stage.
+
+Nothing is collected unless a run is wrapped in collect(). Outside of it,
+stage() returns a shared no-op context manager and count() returns right away,
+so the calls can stay in the pipeline at close to no cost.
+
+The memory is the current resident set size, polled by a background thread
+while a run is collected, so the peak of a stage is the peak during that stage
+even in a pool worker that ran earlier jobs. It is only measured where
+/proc/self/statm exists, on Linux, and is None elsewhere.
+
+Example:
+    with collect(profile_stage="tiling") as metrics:
+        with stage("tiling"):
+            ...
+        count("bricks_placed", 10)
+    print(metrics.record())
+"""
+
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+
+# Metrics of the run being collected, None when instrumentation is disabled
+_active = None
+
+# Shared context manager returned by stage() when instrumentation is disabled
+_NO_STAGE = contextlib.nullcontext()
+
+# Seconds between two samples of the resident set size
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss_mb():
+    """
+    Returns the current resident set size of the process in megabytes, or None if
+    it can not be measured on this platform.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+class _RssSampler:
+    """
+    Polls the resident set size in a background thread and keeps its peak in
+    every open window. A window is opened at the start of a stage and closed at
+    its end, so nested stages each get their own peak.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self._interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Measures the resident set size and updates the peaks of the open windows.
+        """
+        rss = current_rss_mb()
+        with self._lock:
+            for token, peak in self._windows.items():
+                self._windows[token] = max(peak, rss)
+        return rss
+
+    def open(self):
+        """
+        Opens a window and returns its token and the resident set size at its start.
+        """
+        token = object()
+        rss = current_rss_mb()
+        with self._lock:
+            self._windows[token] = rss
+        return token, rss
+
+    def peak(self, token, close=False):
+        """
+        Returns the peak resident set size of a window so far, optionally closing it.
+        """
+        self.sample()
+        with self._lock:
+            if close:
+                return self._windows.pop(token)
+            return self._windows[token]
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class RunMetrics:
+    """
+    The metrics of one run.
+
+    Attributes:
+        stages: Time, number of calls and memory of each stage, by name. The memory
+            is the peak resident set size during the stage and its largest growth
+            over the size at the start of one call, in megabytes.
+        counters: The counters, by name.
+        profile_stage: The name of the stage to profile, or None.
+        profile_path: Optional path the profile of profile_stage is dumped to.
+        profile_summary: The top functions of the profile, once the stage has run.
+    """
+
+    def __init__(self, profile_stage=None, profile_path=None):
+        self.stages = {}
+        self.counters = {}
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.profile_summary = None
+        self._start_time = time.perf_counter()
+
+        self._sampler = None
+        if current_rss_mb() is not None:
+            self._sampler = _RssSampler()
+            self._run_window, self._start_rss = self._sampler.open()
+
+    def close(self):
+        """
+        Stops the memory sampling. The metrics already collected are kept.
+        """
+        if self._sampler is not None:
+            self._sampler.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times a stage of the run. A stage that runs several times is summed.
+        """
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        window = None
+        if self._sampler is not None:
+            window, start_rss = self._sampler.open()
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+
+            if profiler is not None:
+                profiler.disable()
+                self._store_profile(profiler)
+
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            entry["seconds"] += elapsed_time
+            entry["calls"] += 1
+            if window is None:
+                entry["peak_rss_mb"] = entry["rss_growth_mb"] = None
+            else:
+                peak = self._sampler.peak(window, close=True)
+                entry["peak_rss_mb"] = max(entry.get("peak_rss_mb") or 0.0, peak)
+                entry["rss_growth_mb"] = max(entry.get("rss_growth_mb") or 0.0,
+                                             peak - start_rss)
+
+    def _store_profile(self, profiler):
+        if self.profile_path is not None:
+            profiler.dump_stats(self.profile_path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(20)
+        self.profile_summary = summary.getvalue()
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self) -> dict:
+        """
+        Returns the metrics as a dictionary that can be written as JSON.
+        """
+        peak = None if self._sampler is None else self._sampler.peak(self._run_window)
+        record = {
+            "seconds": time.perf_counter() - self._start_time,
+            "peak_rss_mb": peak,
+            "rss_growth_mb": None if peak is None else peak - self._start_rss,
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+        if self.profile_stage is not None:
+            record["profile_stage"] = self.profile_stage
+            record["profile_path"] = self.profile_path
+        return record
+
+
+@contextlib.contextmanager
+def collect(profile_stage=None, profile_path=None):
+    """
+    Collects the metrics of everything that runs inside the with block.
+
+    Args:
+        profile_stage: Optional name of a stage to run under cProfile.
+        profile_path: Optional path the profile is dumped to, readable with pstats.
+
+    Yields:
+        The RunMetrics of the run.
+    """
+    global _active
+
+    previous = _active
+    metrics = RunMetrics(profile_stage, profile_path)
+    _active = metrics
+    try:
+        yield metrics
+    finally:
+        _active = previous
+        metrics.close()
+
+
+def _forget_in_child():
+    global _active
+    _active = None
+
+
+# A forked child has no sampling thread and its metrics are never collected,
+# e.g. the tiling workers of a job that records metrics
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_in_child)
+
+
+def stage(name):
+    """
+    Returns a context manager timing a stage of the active run, or a no-op
+    context manager when no run is being collected.
+    """
+    if _active is None:
+        return _NO_STAGE
+    return _active.stage(name)
+
+
+def count(name, amount=1):
+    """
+    Adds to a counter of the active run, if any.
+    """
+    if _active is not None:
+        _active.count(name, amount)
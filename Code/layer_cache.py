@@ -0,0 +1,116 @@
+"""
+This module contains a cache of tiled layers. Every brick of the catalog is one
+layer tall, so the bricks placed in a layer depend only on the voxels of that
+layer, the tiled cells of the layer below, the brick catalog and the scan order.
+The cache stores the placements of each layer under a key derived from those
+inputs. Tiling the model again after changing the catalog, trimming the top or
+editing a few voxels then only tiles the layers whose inputs changed, and every
+layer above the first changed one that still gets the same support.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LayerCache:
+    """
+    A least recently used cache of the brick placements of tiled layers, kept in
+    memory and optionally saved to a JSON file.
+
+    Attributes:
+        path: Optional JSON file the cache is loaded from and saved to.
+        max_layers: The maximum number of cached layers.
+        hits: The number of layers reused from the cache.
+        misses: The number of layers that had to be tiled.
+    """
+
+    def __init__(self, path=None, max_layers=100000):
+        self.path = path
+        self.max_layers = max_layers
+        self.hits = 0
+        self.misses = 0
+        self._layers = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as infile:
+                for key, placements in json.load(infile).items():
+                    self._layers[key] = [(tuple(brick), y, x) for brick, y, x in placements]
+
+    def key(self, free_layer, support_layer, bricks, order) -> str:
+        """
+        Computes the cache key of a layer.
+
+        Args:
+            free_layer: The 2D boolean array of the cells of the layer that need a brick.
+            support_layer: The 2D boolean array of the tiled cells of the layer below,
+                or None for the base layer.
+            bricks: The dimensions of the allowed bricks, in the order they are tried.
+            order: The scan order of the layer.
+
+        Returns:
+            The key as a hex string.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "shape": list(free_layer.shape),
+            "bricks": [list(brick) for brick in bricks],
+            "order": order,
+            "base": support_layer is None,
+        }, sort_keys=True).encode())
+        digest.update(np.packbits(free_layer).tobytes())
+        if support_layer is not None:
+            digest.update(np.packbits(support_layer).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up the placements of a layer and marks them as recently used.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            A list of (brick, y, x) placements, or None if the layer is not cached.
+        """
+        placements = self._layers.get(key)
+        if placements is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._layers.move_to_end(key)
+        return placements
+
+    def put(self, key, placements):
+        """
+        Stores the placements of a layer and evicts the least recently used
+        layers beyond max_layers.
+
+        Args:
+            key: The cache key.
+            placements: A list of (brick, y, x) placements.
+        """
+        self._layers[key] = placements
+        self._layers.move_to_end(key)
+        while len(self._layers) > self.max_layers:
+            self._layers.popitem(last=False)
+
+    def save(self):
+        """
+        Writes the cache to its JSON file, if it has one.
+        """
+        if self.path is None:
+            return
+        with open(self.path, "w") as outfile:
+            json.dump({key: [[list(brick), y, x] for brick, y, x in placements]
+                       for key, placements in self._layers.items()}, outfile)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of reused and tiled layers and the number of cached layers.
+        """
+        return {"hits": self.hits, "misses": self.misses, "layers": len(self._layers)}
@@ -0,0 +1,400 @@
+"""
+This module contains the STL to LEGO conversion pipeline without any user
+interface: loading, rescaling, voxelization, tiling and export. It is shared by
+the Tk GUI in stl2lego.py and the batch command line in batch_stl2lego.py.
+"""
+
+import os
+import time
+
+import numpy as np
+import trimesh
+
+import instrumentation
+from brick_catalog import load_catalog
+from brick_graph import BrickGraph, find_floating_bricks, remove_floating_bricks
+from brick_optimizer import optimize_bricks
+from STLImport import (stl_to_mesh, rescale_mesh, stl_to_voxel_array, shell_voxels,
+                       stl_to_voxel_array_progressive, stl_to_coarse_voxel_array,
+                       save_array_packed, save_array_json)
+from bricker_functions import (switch_axis_of_array, tile_volume, tile_volume_parallel,
+                               tile_layers, BrickStreamWriter, save_bricks_binary,
+                               load_bricks_binary, save_bricks_json)
+from scale_sweep import voxelize_scales
+from sparse_grid import ChunkedGrid, stl_to_chunked_grid, shell_chunked_grid
+from voxel_cache import VoxelCache, cached_stl_to_voxel_array
+
+
+# Size of one LEGO brick cell in millimeters (x, y, z)
+VOXEL_SIZE = np.array([7.8, 7.8, 9.6])
+LEGO_BRICK_HEIGHT_MM = 9.6
+
+# Units a target height can be given in
+HEIGHT_UNITS = ("LEGO bricks", "mm", "cm", "m")
+
+
+def height_to_scale(height, unit, stl_height):
+    """
+    Converts a target height to the scale passed to rescale_mesh.
+
+    Args:
+        height: The target height.
+        unit: The unit of the height, one of HEIGHT_UNITS.
+        stl_height: The height of the unscaled mesh.
+
+    Returns:
+        The scale.
+    """
+    if unit not in HEIGHT_UNITS:
+        raise ValueError("Invalid unit. Must be one of: " + ", ".join(HEIGHT_UNITS))
+
+    if unit == "cm":
+        height = height * 10
+    elif unit == "m":
+        height = height * 1000
+
+    if unit != "LEGO bricks":
+        height = height / LEGO_BRICK_HEIGHT_MM
+
+    return height / stl_height
+
+
+def voxelize_mesh(stl_mesh, scale, backend="scanline", workers=1, cache=None,
+                  progress=None, cancel=None, sparse=False, coarse_factor=None, preview=None):
+    """
+    Rescales a mesh in place and converts it to a voxel array.
+
+    Args:
+        stl_mesh: The input STL mesh, or the path of an STL file.
+        scale: The scale, see height_to_scale.
+        backend: The voxelization backend, see stl_to_voxel_array.
+        workers: The number of voxelization processes.
+        cache: Optional VoxelCache to reuse earlier results. Its stats() tell
+            whether the voxels were found.
+        progress, cancel: See stl_to_voxel_array.
+        sparse: If True, voxelize into a ChunkedGrid one slab of chunks at a
+            time, for models too large for a dense array. Sparse runs are
+            single process and do not use the cache.
+        coarse_factor: If given, voxelize from coarse to fine starting with
+            cells of this many voxels per side, see
+            stl_to_voxel_array_progressive. Progressive runs are single
+            process and do not use the cache.
+        preview: Optional callable preview(coarse_array, cell_size) of a
+            progressive run.
+
+    Returns:
+        A 3D numpy array or ChunkedGrid representing the voxelized mesh,
+        indexed (x, y, z).
+    """
+    # Create a mesh object, unless an already loaded mesh was passed
+    if not isinstance(stl_mesh, trimesh.Trimesh):
+        with instrumentation.stage("stl_parse"):
+            stl_mesh = stl_to_mesh(stl_mesh)
+
+    # Rotate the STL mesh
+    # stl_mesh = set_new_z_axis(stl_mesh, 2)
+
+    # Align the tallest dimension of the mesh with the Z axis
+    # stl_mesh = align_tallest_dimension_with_z(stl_mesh)
+
+    # Rescale the STL mesh
+    with instrumentation.stage("rescale_mesh"):
+        stl_mesh = rescale_mesh(stl_mesh, VOXEL_SIZE, scale)
+
+    # Convert the STL mesh to a voxel array
+    with instrumentation.stage("voxelize"):
+        if sparse:
+            return stl_to_chunked_grid(stl_mesh, VOXEL_SIZE, backend=backend,
+                                       progress=progress, cancel=cancel)
+
+        if coarse_factor is not None:
+            return stl_to_voxel_array_progressive(stl_mesh, VOXEL_SIZE, coarse_factor,
+                                                  backend=backend, preview=preview,
+                                                  progress=progress, cancel=cancel)
+
+        if cache is None:
+            return stl_to_voxel_array(stl_mesh, VOXEL_SIZE, backend=backend, workers=workers,
+                                      progress=progress, cancel=cancel)
+
+        # Reuse the voxels of earlier runs of the same model at the same scale
+        return cached_stl_to_voxel_array(stl_mesh, VOXEL_SIZE, cache, backend=backend,
+                                         workers=workers, progress=progress, cancel=cancel)
+
+
+def preview_mesh(stl_mesh, scale, coarse_factor=4, backend="scanline"):
+    """
+    Voxelizes a mesh at a coarse resolution for a quick look at the model
+    before the full conversion. The mesh is not modified.
+
+    Args:
+        stl_mesh: The input STL mesh, or the path of an STL file.
+        scale: The scale, see height_to_scale.
+        coarse_factor: The edge length of the preview cells in voxels.
+        backend: The voxelization backend, see stl_to_voxel_array.
+
+    Returns:
+        A tuple (coarse_array, cell_size) with the coarse voxel array, indexed
+        (x, y, z), and the size of its cells in millimeters.
+    """
+    if isinstance(stl_mesh, trimesh.Trimesh):
+        stl_mesh = stl_mesh.copy()
+    else:
+        stl_mesh = stl_to_mesh(stl_mesh)
+
+    stl_mesh = rescale_mesh(stl_mesh, VOXEL_SIZE, scale)
+    coarse_array = stl_to_coarse_voxel_array(stl_mesh, VOXEL_SIZE, coarse_factor, backend)
+
+    return coarse_array, VOXEL_SIZE * coarse_factor
+
+
+def convert_stl(stl_path, height, unit, output_dir, backend="scanline", workers=1,
+                export_json=False, cache_dir=None, sparse=False, wall_thickness=None,
+                layer_cache=None, tiling_workers=1, optimize_seconds=None,
+                catalog_path=None, remove_floating=False) -> dict:
+    """
+    Runs the whole conversion for one STL file and writes the results to
+    output_dir: voxel_array.bvox, bricks_placed.bbrk and, if requested, the
+    JSON versions of both.
+
+    Args:
+        stl_path: The path of the STL file.
+        height: The target height.
+        unit: The unit of the height, one of HEIGHT_UNITS.
+        output_dir: The directory the results are written to.
+        backend: The voxelization backend, see stl_to_voxel_array.
+        workers: The number of voxelization processes.
+        export_json: Whether to also write JSON files.
+        cache_dir: Optional directory of a VoxelCache. Its stats are returned
+            under "voxel_cache".
+        sparse: Whether to voxelize and tile a ChunkedGrid, see voxelize_mesh.
+        wall_thickness: If given, only a hollow shell of this thickness in voxels
+            is tiled, see shell_voxels. The voxel files still hold the solid model.
+        layer_cache: Optional LayerCache, layers that are unchanged since an
+            earlier run are not tiled again. It is saved once the run is done.
+        tiling_workers: With more than one, the layers are tiled in a process
+            pool, see tile_volume_parallel.
+        optimize_seconds: If given, the tiled model is improved with
+            optimize_bricks for this many seconds.
+        catalog_path: Optional brick catalog config file, see brick_catalog.py.
+            Defaults to brick_catalog.json.
+        remove_floating: Whether to remove the bricks that are not connected to
+            the base layer, see brick_graph.py. They are always counted.
+
+    Returns:
+        A dictionary with the job parameters, the number of voxels and bricks
+        and the time spent.
+    """
+    start_time = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+
+    with instrumentation.stage("stl_parse"):
+        stl_mesh = stl_to_mesh(stl_path)
+    scale = height_to_scale(height, unit, stl_mesh.extents[2])
+
+    cache = None if cache_dir is None else VoxelCache(cache_dir)
+    voxel_array = voxelize_mesh(stl_mesh, scale, backend, workers, cache, sparse=sparse)
+
+    result = {
+        "stl_path": stl_path,
+        "height": height,
+        "unit": unit,
+        "scale": scale,
+        "wall_thickness": wall_thickness,
+        "output_dir": output_dir,
+    }
+    result.update(convert_voxel_array(voxel_array, output_dir, export_json, wall_thickness,
+                                      layer_cache, tiling_workers, optimize_seconds,
+                                      catalog_path, remove_floating))
+    if cache is not None:
+        result["voxel_cache"] = cache.stats()
+    result["seconds"] = time.time() - start_time
+
+    return result
+
+
+def convert_stl_heights(stl_path, heights, unit, output_dirs, backend="scanline", workers=1,
+                        export_json=False, wall_thickness=None, layer_caches=None,
+                        optimize_seconds=None, catalog_path=None,
+                        remove_floating=False) -> list:
+    """
+    Runs the conversion of one STL file at many heights, like convert_stl for
+    every height. The mesh is loaded and its ray structure is built only once,
+    see scale_sweep.voxelize_scales.
+
+    Args:
+        stl_path: The path of the STL file.
+        heights: The target heights.
+        unit: The unit of the heights, one of HEIGHT_UNITS.
+        output_dirs: The directory the results of each height are written to.
+        backend: The voxelization backend, one of scale_sweep.SWEEP_BACKENDS.
+        workers: The number of processes voxelizing the heights concurrently.
+        layer_caches: Optional LayerCache of each height.
+        export_json, wall_thickness, optimize_seconds, catalog_path,
+            remove_floating: See convert_stl.
+
+    Returns:
+        The result of convert_stl of each height. The seconds of a height
+        include its share of the voxelization.
+    """
+    if layer_caches is None:
+        layer_caches = [None] * len(heights)
+
+    with instrumentation.stage("stl_parse"):
+        stl_mesh = stl_to_mesh(stl_path)
+    scales = [height_to_scale(height, unit, stl_mesh.extents[2]) for height in heights]
+
+    results = []
+    start_time = time.time()
+    sweep = voxelize_scales(stl_mesh, scales, VOXEL_SIZE, backend, workers)
+    for height, output_dir, layer_cache, (scale, voxel_array) in zip(
+            heights, output_dirs, layer_caches, sweep):
+        os.makedirs(output_dir, exist_ok=True)
+        result = {
+            "stl_path": stl_path,
+            "height": height,
+            "unit": unit,
+            "scale": scale,
+            "wall_thickness": wall_thickness,
+            "output_dir": output_dir,
+        }
+        result.update(convert_voxel_array(voxel_array, output_dir, export_json, wall_thickness,
+                                          layer_cache, 1, optimize_seconds, catalog_path,
+                                          remove_floating))
+        result["seconds"] = time.time() - start_time
+        start_time = time.time()
+        results.append(result)
+
+    return results
+
+
+def convert_voxel_array(voxel_array, output_dir, export_json=False, wall_thickness=None,
+                        layer_cache=None, tiling_workers=1, optimize_seconds=None,
+                        catalog_path=None, remove_floating=False) -> dict:
+    """
+    Runs the part of the conversion after the voxelization, see convert_stl:
+    writes the voxel array, tiles it, checks that the bricks hold together and
+    writes the placed bricks. Unless the bricks are optimized, tiled in
+    parallel or have their floating bricks removed, every layer is written as
+    soon as it is tiled, see stream_tiling, and bricks_placed.ndjson is also
+    written with the JSON files.
+
+    Args:
+        voxel_array: The voxel array, indexed (x, y, z).
+        output_dir: The directory the results are written to.
+        export_json, wall_thickness, layer_cache, tiling_workers,
+            optimize_seconds, catalog_path, remove_floating: See convert_stl.
+
+    Returns:
+        A dictionary with the grid shape and the number of voxels, bricks and
+        floating bricks.
+    """
+    with instrumentation.stage("voxel_write"):
+        save_array_packed(voxel_array, os.path.join(output_dir, "voxel_array"))
+        if export_json:
+            save_array_json(voxel_array, os.path.join(output_dir, "voxel_array"))
+
+    if wall_thickness is not None:
+        with instrumentation.stage("shell"):
+            # Sparse grids are hollowed out one slab at a time
+            if isinstance(voxel_array, ChunkedGrid):
+                voxel_array = shell_chunked_grid(voxel_array, wall_thickness)
+            else:
+                voxel_array = shell_voxels(voxel_array, wall_thickness)
+
+    # Layers first, as expected by the tiler
+    with instrumentation.stage("axis_switch"):
+        voxel_array = switch_axis_of_array(voxel_array, [2, 1, 0])
+
+    result = {
+        "grid_shape": list(voxel_array.shape),
+        "voxels": int(voxel_array.size),
+        "filled_voxels": voxel_array.count_nonzero() if isinstance(voxel_array, ChunkedGrid)
+        else int(np.count_nonzero(voxel_array)),
+    }
+
+    catalog = load_catalog() if catalog_path is None else load_catalog(catalog_path)
+    bricks_path = os.path.join(output_dir, "bricks_placed")
+
+    if optimize_seconds is None and tiling_workers <= 1 and not remove_floating:
+        num_bricks, floating = stream_tiling(voxel_array, catalog, bricks_path, export_json,
+                                             layer_cache)
+        result.update(bricks=num_bricks, greedy_bricks=num_bricks,
+                      floating_bricks=len(floating))
+        return result
+
+    with instrumentation.stage("tiling"):
+        if tiling_workers > 1:
+            bricks_placed, _ = tile_volume_parallel(voxel_array, catalog, workers=tiling_workers,
+                                                    layer_cache=layer_cache)
+        else:
+            bricks_placed, _ = tile_volume(voxel_array, catalog, layer_cache=layer_cache)
+    if layer_cache is not None:
+        layer_cache.save()
+
+    greedy_bricks = len(bricks_placed)
+    if optimize_seconds is not None:
+        with instrumentation.stage("optimize"):
+            bricks_placed = optimize_bricks(bricks_placed, time_budget=optimize_seconds,
+                                            catalog=catalog)
+
+    # The labels are drawn from the final bricks, which the optimizer may have changed
+    with instrumentation.stage("connectivity"):
+        if remove_floating:
+            bricks_placed, floating = remove_floating_bricks(bricks_placed)
+        else:
+            floating = find_floating_bricks(bricks_placed)
+
+    with instrumentation.stage("brick_write"):
+        save_bricks_binary(bricks_placed, bricks_path)
+        if export_json:
+            save_bricks_json(bricks_placed, bricks_path)
+
+    result.update(bricks=len(bricks_placed), greedy_bricks=greedy_bricks,
+                  floating_bricks=len(floating))
+    return result
+
+
+def stream_tiling(voxel_array, catalog, bricks_path, export_json=False, layer_cache=None):
+    """
+    Tiles a voxel array with tile_layers and writes every layer to the brick
+    files as soon as it is tiled, see BrickStreamWriter, so only the bricks of
+    one layer are held in memory. The connectivity is updated layer by layer.
+
+    Args:
+        voxel_array: The voxel array, indexed (z, y, x).
+        catalog: The BrickCatalog of the allowed bricks.
+        bricks_path: The path of the brick files without extension.
+        export_json: Whether to also write the NDJSON and JSON files. The JSON
+            file is written from the finished brick table.
+        layer_cache: Optional LayerCache, saved once the tiling is done.
+
+    Returns:
+        A tuple with the number of bricks placed and the indices of the
+        floating bricks.
+    """
+    # The tiled volume of a ChunkedGrid holds flags, not labels
+    brick_graph = None if isinstance(voxel_array, ChunkedGrid) else BrickGraph()
+
+    with instrumentation.stage("tiling"):
+        with BrickStreamWriter(bricks_path, export_ndjson=export_json) as writer:
+            for z, layer_bricks in tile_layers(voxel_array, catalog, layer_cache=layer_cache,
+                                               brick_graph=brick_graph):
+                writer.write_layer(z, layer_bricks)
+            num_bricks = writer.count
+    instrumentation.count("bricks_placed", num_bricks)
+    if layer_cache is not None:
+        layer_cache.save()
+
+    with instrumentation.stage("connectivity"):
+        if brick_graph is not None:
+            floating = brick_graph.floating(num_bricks)
+            instrumentation.count("stud_contacts", brick_graph.contacts)
+            instrumentation.count("floating_bricks", len(floating))
+        else:
+            floating = find_floating_bricks(load_bricks_binary(bricks_path + ".bbrk"))
+
+    if export_json:
+        with instrumentation.stage("brick_write"):
+            save_bricks_json(load_bricks_binary(bricks_path + ".bbrk"), bricks_path)
+
+    return num_bricks, floating
@@ -0,0 +1,41 @@
+"""
+This module contains the cancellation support of long running conversions. A
+CancelToken is handed to the voxelizer and the tiler, which check it between
+slabs and layers and raise ConversionCancelled once it has been cancelled.
+Progress is reported through plain callables taking (done, total).
+"""
+
+import threading
+
+
+class ConversionCancelled(Exception):
+    """
+    Raised by the voxelizer and the tiler when their CancelToken is cancelled.
+    """
+
+
+class CancelToken:
+    """
+    A thread-safe flag that asks a running conversion to stop.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """
+        Asks the conversion to stop at its next check.
+        """
+        self._event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+def check_cancelled(cancel):
+    """
+    Raises ConversionCancelled if the given token has been cancelled. A token
+    of None is never cancelled.
+    """
+    if cancel is not None and cancel.is_cancelled():
+        raise ConversionCancelled()
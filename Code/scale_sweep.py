@@ -0,0 +1,170 @@
+"""
+This module contains the voxelization of one model at many scales. The mesh is
+loaded and its ray acceleration structure is built once, on the unscaled
+geometry. Each scale then sees the mesh through a ScaledMesh, which maps the
+rays of the voxelization backends into the unscaled mesh and the hits back,
+instead of rescaling the mesh and building the structure again.
+"""
+
+import multiprocessing
+
+import numpy as np
+import trimesh
+
+from progress import check_cancelled
+from STLImport import stl_to_mesh, stl_to_voxel_array
+
+
+# Backends that only query the mesh through rays and triangles, see ScaledMesh
+SWEEP_BACKENDS = ("scanline", "winding")
+
+
+class ScaledMesh:
+    """
+    A read-only view of a mesh as rescale_mesh would leave it: moved so that its
+    lowest z is at 0 and scaled by target_scale * voxel_size. It provides what
+    the "scanline" and "winding" backends of stl_to_voxel_array use, the
+    bounds, the triangles and ray queries, the latter answered by the ray
+    structure of the unscaled mesh.
+
+    Attributes:
+        mesh: The unscaled mesh.
+        translation: The translation applied before scaling.
+        scale: The scale factor of each axis.
+        vertices: The scaled vertices.
+        ray: The object answering ray queries, the view itself.
+    """
+
+    def __init__(self, mesh, voxel_size, target_scale):
+        self.mesh = mesh
+        self.translation = np.array([0.0, 0.0, mesh.bounds[0][2]])
+        self.scale = target_scale * np.asarray(voxel_size, dtype=np.float64)
+        self.vertices = (mesh.vertices - self.translation) * self.scale
+        self.ray = self
+
+    @property
+    def bounds(self):
+        return np.array([self.vertices.min(axis=0), self.vertices.max(axis=0)])
+
+    @property
+    def extents(self):
+        return np.ptp(self.vertices, axis=0)
+
+    @property
+    def triangles(self):
+        return self.vertices[self.mesh.faces]
+
+    def intersects_location(self, ray_origins, ray_directions, multiple_hits=True):
+        """
+        Intersects rays given in scaled coordinates with the mesh, like
+        trimesh's ray.intersects_location.
+
+        Returns:
+            A tuple (locations, index_ray, index_tri) with the hit locations in
+            scaled coordinates.
+        """
+        origins = np.asarray(ray_origins, dtype=np.float64) / self.scale + self.translation
+        directions = np.asarray(ray_directions, dtype=np.float64) / self.scale
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+
+        locations, index_ray, index_tri = self.mesh.ray.intersects_location(
+            ray_origins=origins, ray_directions=directions, multiple_hits=multiple_hits)
+
+        return (locations - self.translation) * self.scale, index_ray, index_tri
+
+
+# Unscaled mesh used by the worker processes of voxelize_scales, shared like
+# the mesh of the voxelization slab workers in STLImport
+_sweep_mesh = None
+
+
+def _init_sweep_worker(stl_mesh):
+    """
+    Initializes a sweep worker process with the shared mesh.
+    """
+    global _sweep_mesh
+    _sweep_mesh = stl_mesh
+
+
+def _voxelize_scale_task(task):
+    """
+    Voxelizes the shared mesh at one scale in a worker process.
+    """
+    scale, voxel_size, backend, max_batch_bytes = task
+    return stl_to_voxel_array(ScaledMesh(_sweep_mesh, voxel_size, scale), voxel_size,
+                              backend=backend, max_batch_bytes=max_batch_bytes)
+
+
+def voxelize_scales(stl_mesh, scales, voxel_size, backend="scanline", workers=1,
+                    max_batch_bytes=256 * 1024**2, progress=None, cancel=None):
+    """
+    Voxelizes a mesh at many scales. The voxel arrays are the ones that
+    rescale_mesh followed by stl_to_voxel_array gives, but the mesh is never
+    modified and its ray structure is only built once.
+
+    Args:
+        stl_mesh: The input STL mesh, or the path of an STL file.
+        scales: The scales, see pipeline.height_to_scale.
+        voxel_size: The size of the voxel in each dimension.
+        backend: The voxelization backend, one of SWEEP_BACKENDS.
+        workers: The number of processes. With more than one, the scales are
+            voxelized concurrently.
+        max_batch_bytes: See stl_to_voxel_array.
+        progress: Optional callable progress(done, total), called with the
+            number of scales voxelized so far.
+        cancel: Optional CancelToken, checked between the scales.
+
+    Yields:
+        Tuples (scale, voxel_array), in the order of scales.
+    """
+    global _sweep_mesh
+
+    if backend not in SWEEP_BACKENDS:
+        raise ValueError("Invalid backend. Must be one of: " + ", ".join(SWEEP_BACKENDS))
+
+    if not isinstance(stl_mesh, trimesh.Trimesh):
+        stl_mesh = stl_to_mesh(stl_mesh)
+
+    scales = list(scales)
+    tasks = [(scale, voxel_size, backend, max_batch_bytes) for scale in scales]
+
+    # Build the ray acceleration structure once, before any worker is started
+    if backend == "scanline":
+        stl_mesh.ray.intersects_any(ray_origins=[stl_mesh.centroid],
+                                    ray_directions=[[0.0, 0.0, 1.0]])
+
+    if workers <= 1 or len(tasks) <= 1:
+        _sweep_mesh = stl_mesh
+        try:
+            for done, task in enumerate(tasks, start=1):
+                check_cancelled(cancel)
+                yield task[0], _voxelize_scale_task(task)
+                if progress is not None:
+                    progress(done, len(tasks))
+        finally:
+            _sweep_mesh = None
+        return
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        # The forked workers share the mesh and its ray structure with the parent
+        context = multiprocessing.get_context("fork")
+        _sweep_mesh = stl_mesh
+        pool = context.Pool(workers)
+    else:
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(workers, initializer=_init_sweep_worker, initargs=(stl_mesh,))
+
+    try:
+        # The voxel arrays arrive in the order of the scales
+        for done, (task, voxel_array) in enumerate(
+                zip(tasks, pool.imap(_voxelize_scale_task, tasks)), start=1):
+            yield task[0], voxel_array
+            if progress is not None:
+                progress(done, len(tasks))
+            check_cancelled(cancel)
+        pool.close()
+    finally:
+        # Stops the remaining scales if the sweep was cancelled or abandoned
+        pool.terminate()
+        pool.join()
+        _sweep_mesh = None
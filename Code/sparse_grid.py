@@ -0,0 +1,341 @@
+"""
+This module contains a sparse, chunked 3D grid for voxel arrays of very large
+models, which are mostly empty air. The grid is split into cubic chunks. Chunks
+that are completely empty are not stored, chunks with a single value (such as
+completely full chunks) are stored as that value, and only the remaining chunks
+hold an array.
+
+The grid supports the slicing used by the tiler (integer and step 1 slice
+indexing, reading and writing), so tile_volume accepts it in place of a dense
+array. Reads return dense NumPy arrays of the requested region.
+"""
+
+import itertools
+import operator
+
+import numpy as np
+
+import instrumentation
+from STLImport import voxel_grid_geometry, iter_voxel_slabs, shell_walls, support_shell
+
+
+# Edge length of the chunks in voxels
+CHUNK_SIZE = 16
+
+
+class ChunkedGrid:
+    """
+    A sparse 3D grid stored in cubic chunks.
+
+    Attributes:
+        shape: The shape of the grid.
+        dtype: The data type of the grid.
+        chunk_size: The edge length of the chunks.
+        chunks: The stored chunks keyed on their chunk index. A missing chunk is
+            all zeros, a NumPy scalar is a chunk with that value everywhere and
+            an array of shape (chunk_size,) * 3 holds the chunk's voxels.
+    """
+
+    def __init__(self, shape, dtype=bool, chunk_size=CHUNK_SIZE):
+        if len(shape) != 3:
+            raise ValueError("Invalid shape. Please provide three dimensions.")
+
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.chunks = {}
+
+    @classmethod
+    def from_dense(cls, array, chunk_size=CHUNK_SIZE):
+        """
+        Creates a chunked grid from a dense 3D array.
+        """
+        grid = cls(array.shape, array.dtype, chunk_size)
+        grid.set_block((0, 0, 0), array)
+        return grid
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Returns the grid as a dense array.
+        """
+        return self[:, :, :]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_dense()
+        return array if dtype is None else array.astype(dtype)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes used by the stored chunk arrays.
+        """
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def _normalize_key(self, key):
+        """
+        Converts an index to one (start, stop) range per axis and the axes that
+        were indexed with an integer.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError("Too many indices for a 3D grid.")
+        key = key + (slice(None),) * (3 - len(key))
+
+        ranges = []
+        integer_axes = []
+        for axis, index in enumerate(key):
+            length = self.shape[axis]
+            if isinstance(index, slice):
+                start, stop, step = index.indices(length)
+                if step != 1:
+                    raise IndexError("Only slices with a step of 1 are supported.")
+                ranges.append((start, max(start, stop)))
+            else:
+                index = operator.index(index)
+                if index < 0:
+                    index += length
+                if not 0 <= index < length:
+                    raise IndexError(f"Index {index} is out of bounds for axis {axis}.")
+                ranges.append((index, index + 1))
+                integer_axes.append(axis)
+
+        return ranges, tuple(integer_axes)
+
+    def _chunk_indices(self, ranges, stored_only):
+        """
+        Returns the indices of the chunks overlapping the region. With
+        stored_only, chunks that are not stored are left out.
+        """
+        chunk_ranges = [range(start // self.chunk_size, -(-stop // self.chunk_size))
+                        for start, stop in ranges]
+        count = np.prod([len(chunk_range) for chunk_range in chunk_ranges])
+
+        if stored_only and count > len(self.chunks):
+            # Fewer stored chunks than chunks in the region, filter the stored ones
+            return [index for index in self.chunks
+                    if all(index[axis] in chunk_ranges[axis] for axis in range(3))]
+
+        indices = itertools.product(*chunk_ranges)
+        if stored_only:
+            return [index for index in indices if index in self.chunks]
+        return list(indices)
+
+    def _overlap(self, chunk_index, ranges):
+        """
+        Returns the slices of the overlap between a chunk and a region, relative
+        to the chunk and relative to the region.
+        """
+        in_chunk = []
+        in_region = []
+        for axis in range(3):
+            chunk_start = chunk_index[axis] * self.chunk_size
+            start = max(ranges[axis][0], chunk_start)
+            stop = min(ranges[axis][1], chunk_start + self.chunk_size)
+            in_chunk.append(slice(start - chunk_start, stop - chunk_start))
+            in_region.append(slice(start - ranges[axis][0], stop - ranges[axis][0]))
+        return tuple(in_chunk), tuple(in_region)
+
+    def _chunk_extent(self, chunk_index):
+        """
+        Returns the slices of a chunk that lie inside the grid.
+        """
+        return tuple(slice(0, min(self.chunk_size,
+                                  self.shape[axis] - chunk_index[axis] * self.chunk_size))
+                     for axis in range(3))
+
+    def __getitem__(self, key):
+        ranges, integer_axes = self._normalize_key(key)
+        region = np.zeros([stop - start for start, stop in ranges], dtype=self.dtype)
+
+        for chunk_index in self._chunk_indices(ranges, stored_only=True):
+            in_chunk, in_region = self._overlap(chunk_index, ranges)
+            chunk = self.chunks[chunk_index]
+            region[in_region] = chunk[in_chunk] if chunk.ndim else chunk
+
+        if integer_axes:
+            region = region.squeeze(axis=integer_axes)
+            if region.ndim == 0:
+                return region[()]
+        return region
+
+    def __setitem__(self, key, value):
+        ranges, integer_axes = self._normalize_key(key)
+        value = np.asarray(value, dtype=self.dtype)
+        if value.ndim:
+            value = np.expand_dims(value, integer_axes) if integer_axes else value
+            value = np.broadcast_to(value, [stop - start for start, stop in ranges])
+
+        for chunk_index in self._chunk_indices(ranges, stored_only=False):
+            in_chunk, in_region = self._overlap(chunk_index, ranges)
+
+            if value.ndim == 0 and in_chunk == self._chunk_extent(chunk_index):
+                # The whole chunk gets one value
+                self._store_uniform(chunk_index, value)
+                continue
+
+            chunk = self._chunk_array(chunk_index)
+            chunk[in_chunk] = value[in_region] if value.ndim else value
+
+    def _store_uniform(self, chunk_index, value):
+        if value == 0:
+            self.chunks.pop(chunk_index, None)
+        else:
+            self.chunks[chunk_index] = self.dtype.type(value)
+
+    def _chunk_array(self, chunk_index):
+        """
+        Returns the array of a chunk, creating it from an empty or uniform chunk.
+        """
+        chunk = self.chunks.get(chunk_index)
+        if chunk is None or chunk.ndim == 0:
+            fill = 0 if chunk is None else chunk
+            chunk = np.full((self.chunk_size,) * 3, fill, dtype=self.dtype)
+            self.chunks[chunk_index] = chunk
+        return chunk
+
+    def set_block(self, offset, block):
+        """
+        Writes a dense block into the grid and compacts the chunks it touched.
+
+        Args:
+            offset: The (x, y, z) index of the first voxel of the block.
+            block: The dense 3D array to write.
+        """
+        key = tuple(slice(start, start + length) for start, length in zip(offset, block.shape))
+        self[key] = block
+
+        ranges, _ = self._normalize_key(key)
+        self.compact(self._chunk_indices(ranges, stored_only=True))
+
+    def compact(self, chunk_indices=None):
+        """
+        Replaces chunk arrays that hold a single value by that value, and drops
+        empty chunks.
+
+        Args:
+            chunk_indices: The chunks to compact, all chunks by default.
+        """
+        if chunk_indices is None:
+            chunk_indices = list(self.chunks)
+
+        for chunk_index in chunk_indices:
+            chunk = self.chunks.get(chunk_index)
+            if chunk is None or chunk.ndim == 0:
+                continue
+            inside = chunk[self._chunk_extent(chunk_index)]
+            first = inside.flat[0]
+            if np.all(inside == first):
+                self._store_uniform(chunk_index, first)
+
+    def count_nonzero(self) -> int:
+        """
+        Returns the number of nonzero voxels without creating a dense array.
+        """
+        total = 0
+        for chunk_index, chunk in self.chunks.items():
+            extent = self._chunk_extent(chunk_index)
+            if chunk.ndim:
+                total += int(np.count_nonzero(chunk[extent]))
+            elif chunk:
+                total += int(np.prod([s.stop for s in extent]))
+        return total
+
+    def transpose(self, axes):
+        """
+        Returns a grid with permuted axes, like np.transpose. Only the chunk
+        keys and the chunk arrays are permuted, so switch_axis_of_array also
+        works on chunked grids.
+        """
+        axes = tuple(axes)
+        grid = ChunkedGrid([self.shape[axis] for axis in axes], self.dtype, self.chunk_size)
+        for chunk_index, chunk in self.chunks.items():
+            new_index = tuple(chunk_index[axis] for axis in axes)
+            grid.chunks[new_index] = np.ascontiguousarray(chunk.transpose(axes)) \
+                if chunk.ndim else chunk
+        return grid
+
+
+def stl_to_chunked_grid(stl_mesh, voxel_size, chunk_size=CHUNK_SIZE, **kwargs) -> ChunkedGrid:
+    """
+    Converts an STL mesh into a chunked voxel grid. The mesh is voxelized one
+    slab of chunks at a time, so no dense array of the whole grid is created.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the voxel in each dimension.
+        chunk_size: The edge length of the chunks.
+        **kwargs: The voxelization options of stl_to_voxel_array (backend,
+            num_random_rays, seed, max_batch_bytes, progress, cancel).
+
+    Returns:
+        The voxel grid, indexed (x, y, z) like stl_to_voxel_array.
+    """
+    _, grid_dimensions, _ = voxel_grid_geometry(stl_mesh, voxel_size)
+    grid = ChunkedGrid(grid_dimensions, bool, chunk_size)
+
+    for x_start, slab in iter_voxel_slabs(stl_mesh, voxel_size, chunk_size, **kwargs):
+        grid.set_block((x_start, 0, 0), slab)
+
+    return grid
+
+
+def shell_chunked_grid(grid, wall_thickness=2, max_overhang=1) -> ChunkedGrid:
+    """
+    Hollows out a chunked grid like shell_voxels, without creating a dense array
+    of the whole grid. The grid is processed in slabs of one chunk along z, from
+    the top down. Each slab is read with a halo of wall_thickness + 1 layers on
+    both sides for the walls, and its supports are added below the finished
+    bottom layer of the slab above, so the result equals shell_voxels on the
+    dense grid.
+
+    Args:
+        grid: The ChunkedGrid of the voxels, indexed (x, y, z) with z pointing up.
+        wall_thickness, max_overhang: See shell_voxels.
+
+    Returns:
+        A ChunkedGrid of booleans with the shell and its supports.
+    """
+    if wall_thickness < 1:
+        raise ValueError("Invalid wall thickness. Must be at least 1 voxel.")
+
+    num_z = grid.shape[2]
+    halo = wall_thickness + 1
+    shell_grid = ChunkedGrid(grid.shape, bool, grid.chunk_size)
+    removed = 0
+
+    # The finished bottom layer of the slab above and its solid layer
+    shell_above = solid_above = None
+    for z_start in reversed(range(0, num_z, grid.chunk_size)):
+        z_stop = min(z_start + grid.chunk_size, num_z)
+        read_start, read_stop = max(0, z_start - halo), min(num_z, z_stop + halo)
+
+        solid = grid[:, :, read_start:read_stop].astype(bool)
+        shell = shell_walls(solid, wall_thickness)[:, :, z_start - read_start:
+                                                   z_stop - read_start]
+        solid = solid[:, :, z_start - read_start:z_stop - read_start]
+
+        if shell_above is None:
+            support_shell(shell, solid, max_overhang)
+        else:
+            # The layer above is finished and only lends its support to this slab
+            shell = np.concatenate([shell, shell_above[:, :, None]], axis=2)
+            support_shell(shell, np.concatenate([solid, solid_above[:, :, None]], axis=2),
+                          max_overhang)
+            shell = shell[:, :, :-1]
+
+        shell_grid.set_block((0, 0, z_start), shell)
+        removed += int(np.count_nonzero(solid & ~shell))
+        shell_above, solid_above = shell[:, :, 0].copy(), solid[:, :, 0].copy()
+
+    instrumentation.count("shell_voxels_removed", removed)
+
+    return shell_grid
@@ -14,24 +14,44 @@ alignment, rescaling, conversion to voxel arrays and ultimately, plotting the st
 Authors: Max Idermark & Mats Gard
 """
 
+import queue
+import threading
+import time
 import tkinter as tk
 import numpy as np
+import trimesh
 
 from tkinter import filedialog
-from stl import mesh
 from tkinter import ttk
 
 from bricker_functions import *
 from STLImport import *
+from brick_catalog import load_catalog
+from brick_graph import BrickGraph, find_floating_bricks
+from layer_cache import LayerCache
+from pipeline import height_to_scale, voxelize_mesh, preview_mesh
+from progress import CancelToken, ConversionCancelled
+from voxel_cache import VoxelCache
 
 
-def STL_height(file_path):
-    stl_mesh = mesh.Mesh.from_file(file_path)
-    min_height, max_height = np.min(stl_mesh.z), np.max(stl_mesh.z)
-    return max_height - min_height
+# Interval in milliseconds at which the loading screen reads the conversion events
+PROGRESS_POLL_MS = 100
 
 
-def loading_screen(root, progress_var):
+def STL_height(stl_mesh):
+    """
+    Returns the height (z extent) of an STL mesh, or of the STL file at the given path.
+    """
+    if not isinstance(stl_mesh, trimesh.Trimesh):
+        # Binary files are only probed for their bounds, no mesh is built
+        bounds = stl_bounds(stl_mesh)
+        if bounds is not None:
+            return bounds[1][2] - bounds[0][2]
+        stl_mesh = stl_to_mesh(stl_mesh)
+    return stl_mesh.extents[2]
+
+
+def loading_screen(root, progress_var, cancel_command=None):
     root.title("Loading...")
 
     progress_label = tk.Label(root, textvariable=progress_var)
@@ -41,8 +61,12 @@ def loading_screen(root, progress_var):
     canvas = tk.Canvas(root, width=350, height=0)
     canvas.pack()
 
-    # Prevent closing the loading screen
-    root.protocol("WM_DELETE_WINDOW", lambda: None)
+    if cancel_command is not None:
+        cancel_button = tk.Button(root, text="Cancel", command=cancel_command)
+        cancel_button.pack(pady=10)
+
+    # Prevent closing the loading screen, other than by cancelling
+    root.protocol("WM_DELETE_WINDOW", cancel_command or (lambda: None))
 
 
 def browse_file():
@@ -50,51 +74,143 @@ def browse_file():
         filetypes=[("STL files", "*.stl")]))
 
 
-def main_calculations(stl_path, scale):
+def run_conversion(stl_path, scale, workers, export_json, cache_dir, layer_cache, events, cancel):
+    """
+    Runs the conversion in a background thread. Progress and the outcome are 
+    posted to the events queue as (kind, payload) tuples: ("progress", text), 
+    ("done", bricks_placed), ("cancelled", None) or ("error", exception). The 
+    bricks placed are a list or a brick table, see load_bricks_binary.
+    """
+    try:
+        # Rescale the STL mesh and convert it to a voxel array
+        voxel_cache = None if cache_dir is None else VoxelCache(cache_dir)
+        voxel_array = voxelize_mesh(
+            stl_path, scale, backend="scanline", workers=workers, cache=voxel_cache,
+            progress=lambda done, total: events.put(
+                ("progress", f"Voxelizing: slab {done} of {total}")),
+            cancel=cancel)
+        if voxel_cache is not None:
+            print("Voxel cache: " + str(voxel_cache.stats()))
+
+        # Visualize the voxel array
+        # plot_voxel_array(voxel_array, VOXEL_SIZE)
+
+        save_array_packed(voxel_array, "voxel_array")
+        if export_json:
+            save_array_json(voxel_array, "voxel_array")
+
+        # Convert the nested list to a NumPy array and switches axises
+        new_axes_order = [2, 1, 0]  # [0, 1, 2] = [x,y, z] ergo same
+        voxel_array = switch_axis_of_array(np.array(voxel_array), new_axes_order)
+
+        start_time = time.time()
+        # Tile the volume starting from the middle bottom
+        def tiling_progress(done, total):
+            events.put(("progress", f"Tiling: layer {done} of {total}"))
+
+        # Tile the layers in parallel when several workers are available
+        if workers > 1:
+            bricks_placed, tiled_volume = tile_volume_parallel(
+                voxel_array, order="center", workers=workers,
+                progress=tiling_progress, cancel=cancel, layer_cache=layer_cache)
+            floating = find_floating_bricks(bricks_placed, tiled_volume)
+            save_bricks_binary(bricks_placed, "latest_bricks_placed")
+        else:
+            # Every layer is written as soon as it is tiled, and the connectivity is
+            # updated layer by layer. Only the bricks of one layer are kept.
+            brick_graph = BrickGraph()
+            with BrickStreamWriter("latest_bricks_placed", export_ndjson=export_json) as writer:
+                for z, layer_bricks in tile_layers(
+                        voxel_array, order="center", progress=tiling_progress,
+                        cancel=cancel, layer_cache=layer_cache, brick_graph=brick_graph):
+                    writer.write_layer(z, layer_bricks)
+            # The plot and the JSON file read the written brick table
+            bricks_placed = load_bricks_binary("latest_bricks_placed.bbrk")
+            floating = brick_graph.floating(len(bricks_placed))
+        print(f"The optimizer took {time.time() - start_time} seconds to execute.")
+        if len(floating):
+            print(f"Warning: {len(floating)} bricks are not connected to the base layer.")
+        if layer_cache is not None:
+            print("Layer cache: " + str(layer_cache.stats()))
+
+        # JSON is only needed by the Catia tool
+        if export_json:
+            save_bricks_json(bricks_placed, "latest_bricks_placed")
+
+        events.put(("done", bricks_placed))
+    except ConversionCancelled:
+        events.put(("cancelled", None))
+    except Exception as e:
+        events.put(("error", e))
+
+
+def main_calculations(stl_path, scale, workers=1, export_json=True, cache_dir=None,
+                      layer_cache=None):
     # Initialize the loading screen
     root = tk.Tk()
     progress_var = tk.StringVar()
     progress_var.set("Starting...")
-    loading_screen(root, progress_var)
-    root.update()
+    cancel = CancelToken()
 
-    # Create a mesh object
-    stl_mesh = stl_to_mesh(stl_path)
+    def request_cancel():
+        cancel.cancel()
+        progress_var.set("Cancelling...")
 
-    # Rotate the STL mesh
-    # stl_mesh = set_new_z_axis(stl_mesh, 2)
+    loading_screen(root, progress_var, request_cancel)
 
-    # Align the tallest dimension of the mesh with the Z axis
-    # stl_mesh = align_tallest_dimension_with_z(stl_mesh)
+    # Run the conversion off the GUI thread, it reports back through the queue
+    events = queue.Queue()
+    worker = threading.Thread(
+        target=run_conversion,
+        args=(stl_path, scale, workers, export_json, cache_dir, layer_cache, events, cancel),
+        daemon=True)
+    worker.start()
 
-    # Rescale the STL mesh
-    target_scale = scale
-    voxel_size = np.array([7.8, 7.8, 9.6])
-    stl_mesh = rescale_mesh(stl_mesh, voxel_size, target_scale)
+    outcome = {}
 
-    # Convert the STL mesh to a voxel array
-    voxel_array = stl_to_voxel_array(stl_mesh, voxel_size)
+    def poll_events():
+        try:
+            while True:
+                kind, payload = events.get_nowait()
+                if kind == "progress":
+                    progress_var.set(payload)
+                else:
+                    # The conversion has finished, close the loading screen
+                    outcome[kind] = payload
+                    root.destroy()
+                    return
+        except queue.Empty:
+            pass
+        root.after(PROGRESS_POLL_MS, poll_events)
+
+    root.after(PROGRESS_POLL_MS, poll_events)
 
-    # Visualize the voxel array
-    # plot_voxel_array(voxel_array, voxel_size)
+    # Start the main loop
+    root.mainloop()
 
-    save_array_json(voxel_array, "voxel_array")
+    if "error" in outcome:
+        raise outcome["error"]
 
-    # Convert the nested list to a NumPy array and switches axises
-    new_axes_order = [2, 1, 0]  # [0, 1, 2] = [x,y, z] ergo same
-    voxel_array = switch_axis_of_array(np.array(voxel_array), new_axes_order)
+    if "cancelled" in outcome:
+        print("The conversion was cancelled.")
+        return
 
-    # Initialize an array to store the tiled output
-    tiled_volume = np.zeros_like(voxel_array, dtype=int)
+    # Plot the finished model
+    plot_bricks(outcome["done"], load_catalog())
 
-    # Instead of calling the plotting functions directly, call the new center_plot_legos
-    root.after(0, center_plot_legos, tiled_volume, voxel_array)
 
-    # Destroy the loading screen
-    root.after(0, root.destroy)
+def preview_model():
+    """
+    Function calls when 'Preview' button is pressed. Plots a coarse voxelization of the
+    model at the chosen height, which takes a fraction of the time of the conversion.
+    """
+    height = float(desired_height.get())
+    stl_mesh = stl_to_mesh(file_path.get())
+    scale = height_to_scale(height, height_unit.get(), STL_height(stl_mesh))
 
-    # Start the main loop
-    root.mainloop()
+    coarse_array, cell_size = preview_mesh(stl_mesh, scale, PREVIEW_COARSE_FACTOR)
+    if coarse_array.any():
+        plot_voxel_array(coarse_array, cell_size)
 
 
 def calculate_scale_and_call_function():
@@ -105,19 +221,14 @@ def calculate_scale_and_call_function():
     height = float(desired_height.get())
     unit = height_unit.get()
 
-    if unit == "cm":
-        height = height * 10
-    elif unit == "m":
-        height = height * 1000
-
-    if unit != "LEGO bricks":
-        height = height / LEGO_BRICK_HEIGHT_MM
-    original_stl_height = STL_height(file_path.get())
+    # Load the mesh once, for both the height and the conversion
+    stl_mesh = stl_to_mesh(file_path.get())
+    original_stl_height = STL_height(stl_mesh)
     print('OG hight', original_stl_height)
-    scale = height / original_stl_height
+    scale = height_to_scale(height, unit, original_stl_height)
 
     # Run the MAIN calculations
-    main_calculations(file_path.get(), scale)
+    main_calculations(stl_mesh, scale, cache_dir=VOXEL_CACHE_DIR, layer_cache=LAYER_CACHE)
 
 
 if __name__ == "__main__":
@@ -129,7 +240,11 @@ if __name__ == "__main__":
     desired_height = tk.StringVar()
     height_unit = tk.StringVar()
 
-    LEGO_BRICK_HEIGHT_MM = 9.6
+    VOXEL_CACHE_DIR = "voxel_cache"
+    # Tiled layers are kept for the session, converting again only tiles changed layers
+    LAYER_CACHE = LayerCache()
+    # Edge length in bricks of the cells of the preview
+    PREVIEW_COARSE_FACTOR = 4
     original_stl_height = 1
     if file_path.get() != '':
         try:
@@ -163,9 +278,13 @@ if __name__ == "__main__":
         frame2, textvariable=height_unit, values=unit_options, state="readonly", width=10)
     unit_dropdown.pack(side=tk.LEFT)
 
+    # Look at a coarse version of the model before converting it
+    preview_button = tk.Button(frame3, text="Preview", command=preview_model)
+    preview_button.pack(side=tk.LEFT, padx=5, pady=10)
+
     # Start the program from the GUI and init all calls
     convert_button = tk.Button(
         frame3, text="Convert", command=calculate_scale_and_call_function)
-    convert_button.pack(pady=10)
+    convert_button.pack(side=tk.LEFT, padx=5, pady=10)
 
     root_GUI.mainloop()
@@ -0,0 +1,25 @@
+"""
+Tests of the brick optimizer. Run with pytest from the Code directory.
+"""
+
+from brick_catalog import BrickCatalog
+from brick_optimizer import optimize_bricks
+
+
+def single_cell_bricks(num_y, num_x):
+    """
+    Returns a layer of num_y by num_x cells tiled with 1x1 bricks.
+    """
+    return [{"brick": (1, 1, 1), "position": (0, y, x)}
+            for y in range(num_y) for x in range(num_x)]
+
+
+def test_catalog_bricks_are_used_in_both_orientations():
+    bricks_placed = single_cell_bricks(4, 2)
+
+    # Only the bricks of the model are used without a catalog
+    assert len(optimize_bricks(bricks_placed, time_budget=0.5)) == 8
+
+    catalog = BrickCatalog.from_bricks([(1, 1, 1), (1, 2, 4)])
+    optimized = optimize_bricks(bricks_placed, time_budget=0.5, catalog=catalog)
+    assert [placed["brick"] for placed in optimized] == [(1, 4, 2)]
@@ -0,0 +1,27 @@
+"""
+Tests of the instrumentation. Run with pytest from the Code directory.
+"""
+
+import numpy as np
+import pytest
+
+import instrumentation
+
+
+@pytest.mark.skipif(instrumentation.current_rss_mb() is None,
+                    reason="the resident set size is not measured on this platform")
+def test_stage_memory_is_not_the_lifetime_peak():
+    with instrumentation.collect() as metrics:
+        with instrumentation.stage("allocate"):
+            array = np.ones(2**25)
+            del array
+        with instrumentation.stage("idle"):
+            pass
+    record = metrics.record()
+
+    allocate = record["stages"]["allocate"]
+    idle = record["stages"]["idle"]
+    assert allocate["rss_growth_mb"] > 200
+    assert idle["rss_growth_mb"] < 50
+    assert idle["peak_rss_mb"] < allocate["peak_rss_mb"] - 200
+    assert record["peak_rss_mb"] >= allocate["peak_rss_mb"]
@@ -0,0 +1,64 @@
+"""
+Tests of the batch conversion pipeline. Run with pytest from the Code directory.
+"""
+
+import filecmp
+import json
+import os
+
+import batch_stl2lego
+
+
+STL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "STLs")
+
+
+def run_batch_cli(output_dir, *arguments):
+    """
+    Runs the batch command line on sphere.stl at height 15 with one worker and
+    returns the job directory and its job.json.
+    """
+    batch_stl2lego.main([os.path.join(STL_DIRECTORY, "sphere.stl"), "--heights", "15",
+                         "--workers", "1", "--output-dir", str(output_dir), *arguments])
+
+    with open(os.path.join(output_dir, "summary.json")) as infile:
+        summary = json.load(infile)
+    assert summary["failed"] == 0, summary["results"]
+
+    job_dir = os.path.join(output_dir, "sphere_h15")
+    with open(os.path.join(job_dir, "job.json")) as infile:
+        return job_dir, json.load(infile)
+
+
+def test_sparse_json_export_matches_dense(tmp_path):
+    dense_dir, _ = run_batch_cli(tmp_path / "dense", "--json")
+    for extra in ([], ["--remove-floating"]):
+        sparse_dir, result = run_batch_cli(tmp_path / ("sparse" + "".join(extra)),
+                                           "--json", "--sparse", *extra)
+        assert result["bricks"] > 0
+        for name in ("voxel_array.json", "voxel_array.bvox", "bricks_placed.json",
+                     "bricks_placed.bbrk"):
+            assert filecmp.cmp(os.path.join(dense_dir, name), os.path.join(sparse_dir, name),
+                               shallow=False), name
+
+
+def test_voxel_cache_stats_are_recorded_in_job_json(tmp_path, capsys):
+    cache_dir = str(tmp_path / "cache")
+    _, first = run_batch_cli(tmp_path / "first", "--cache-dir", cache_dir)
+    _, second = run_batch_cli(tmp_path / "second", "--cache-dir", cache_dir)
+
+    assert (first["voxel_cache"]["hits"], first["voxel_cache"]["misses"]) == (0, 1)
+    assert (second["voxel_cache"]["hits"], second["voxel_cache"]["misses"]) == (1, 0)
+    assert "Voxel cache" not in capsys.readouterr().out
+
+
+def test_parallel_tiling_uses_the_layer_cache(tmp_path):
+    job_dir, first = run_batch_cli(tmp_path, "--tiling-workers", "2", "--layer-cache")
+    with open(os.path.join(job_dir, "bricks_placed.bbrk"), "rb") as infile:
+        first_bricks = infile.read()
+    _, second = run_batch_cli(tmp_path, "--tiling-workers", "2", "--layer-cache")
+
+    assert first["layer_cache"]["misses"] > 0
+    assert second["layer_cache"] == {"hits": first["layer_cache"]["misses"], "misses": 0,
+                                     "layers": first["layer_cache"]["layers"]}
+    with open(os.path.join(job_dir, "bricks_placed.bbrk"), "rb") as infile:
+        assert infile.read() == first_bricks
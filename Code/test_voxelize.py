@@ -0,0 +1,36 @@
+"""
+Tests of the voxelization. Run with pytest from the Code directory.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from pipeline import VOXEL_SIZE, height_to_scale
+from STLImport import (stl_to_mesh, rescale_mesh, stl_to_voxel_array,
+                       stl_to_voxel_array_progressive)
+
+
+STL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "STLs")
+
+
+def scaled_mesh(name, height):
+    """
+    Loads a bundled STL file and rescales it to a height in LEGO bricks.
+    """
+    stl_mesh = stl_to_mesh(os.path.join(STL_DIRECTORY, name + ".stl"))
+    scale = height_to_scale(height, "LEGO bricks", stl_mesh.extents[2])
+    return rescale_mesh(stl_mesh, VOXEL_SIZE, scale)
+
+
+# The "rays" backend casts rays from every voxel, so it is tested on a small grid
+@pytest.mark.parametrize("backend, heights", [("scanline", (15, 20)), ("winding", (15, 20)),
+                                              ("rays", (6,))])
+@pytest.mark.parametrize("name", ["Pyramid", "sphere"])
+def test_progressive_matches_full_resolution(name, backend, heights):
+    for height in heights:
+        stl_mesh = scaled_mesh(name, height)
+        full = stl_to_voxel_array(stl_mesh, VOXEL_SIZE, backend=backend)
+        progressive = stl_to_voxel_array_progressive(stl_mesh, VOXEL_SIZE, backend=backend)
+        assert np.array_equal(full, progressive), (name, backend, height)
@@ -0,0 +1,185 @@
+"""
+This module contains an on-disk cache for voxelization results. Results are
+stored in the packed voxel format under a key derived from the mesh geometry and
+the voxelization settings, so converting the same model at the same scale again
+skips the voxelization entirely. The cache is bounded in size and evicts the
+least recently used results first.
+
+A cache directory may be shared by several processes. Entries are written to a
+hidden temporary file and renamed into place, so a reader never sees a partly
+written entry, and an entry removed by another process is treated as a miss.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from STLImport import stl_to_voxel_array, save_array_packed, load_array_packed
+
+
+class VoxelCache:
+    """
+    A size-bounded, least recently used cache of voxel arrays in a directory.
+
+    Attributes:
+        directory: The directory the cached arrays are stored in.
+        max_bytes: The maximum total size of the cached files.
+        hits: The number of lookups that found a cached array.
+        misses: The number of lookups that did not.
+    """
+
+    def __init__(self, directory, max_bytes=1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stl_mesh, voxel_size, backend, num_random_rays, seed) -> str:
+        """
+        Computes the cache key of a voxelization. The key covers the vertices
+        and faces of the mesh, which already include the scale applied by
+        rescale_mesh, and the settings that change the result.
+
+        Args:
+            stl_mesh: The input STL mesh.
+            voxel_size: The size of the voxel in each dimension.
+            backend: The voxelization backend.
+            num_random_rays: The number of random rays of the "rays" backend.
+            seed: The seed of the "rays" backend.
+
+        Returns:
+            The key as a hex string.
+        """
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(stl_mesh.vertices, dtype="<f8").tobytes())
+        digest.update(np.ascontiguousarray(stl_mesh.faces, dtype="<i8").tobytes())
+        digest.update(json.dumps({
+            "voxel_size": np.asarray(voxel_size, dtype=float).tolist(),
+            "backend": backend,
+            "num_random_rays": num_random_rays,
+            "seed": seed,
+        }, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, key)
+
+    def _entries(self) -> list:
+        # Temporary files of entries being written start with a dot
+        return [name for name in os.listdir(self.directory)
+                if name.endswith(".bvox") and not name.startswith(".")]
+
+    def get(self, key):
+        """
+        Looks up a cached voxel array and marks it as recently used.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The voxel array, or None if it is not cached.
+        """
+        path = self._path(key) + ".bvox"
+        try:
+            # The modification time records when the entry was last used
+            os.utime(path)
+            voxel_array = load_array_packed(path)
+        except FileNotFoundError:
+            # Not cached, or evicted by another process
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return voxel_array
+
+    def put(self, key, voxel_array):
+        """
+        Stores a voxel array and evicts the least recently used entries until
+        the cache fits in max_bytes.
+
+        Args:
+            key: The cache key.
+            voxel_array: The voxel array to store.
+        """
+        handle, temp_path = tempfile.mkstemp(suffix=".bvox", prefix="." + key + ".",
+                                             dir=self.directory)
+        os.close(handle)
+        try:
+            save_array_packed(voxel_array, temp_path[:-len(".bvox")])
+            os.replace(temp_path, self._path(key) + ".bvox")
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in self._entries():
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            total_bytes -= size
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the current size of the cache.
+        """
+        size = 0
+        for name in self._entries():
+            try:
+                size += os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+        return {"hits": self.hits, "misses": self.misses, "bytes": size}
+
+
+def cached_stl_to_voxel_array(stl_mesh, voxel_size, cache, num_random_rays=10,
+                              seed=0, backend="rays", **kwargs) -> np.array:
+    """
+    Converts an STL mesh into a voxel representation like stl_to_voxel_array,
+    but returns the cached result if the same mesh has been voxelized with the
+    same settings before. On a hit the mesh is only hashed, no ray structures
+    are built.
+
+    Args:
+        stl_mesh: The input STL mesh.
+        voxel_size: The size of the voxel in each dimension.
+        cache: The VoxelCache to use.
+        num_random_rays, seed, backend: See stl_to_voxel_array.
+        **kwargs: Other arguments of stl_to_voxel_array, which do not change
+            the result.
+
+    Returns:
+        A 3D numpy array representing the voxelized mesh.
+    """
+    key = cache.key(stl_mesh, voxel_size, backend, num_random_rays, seed)
+
+    voxel_array = cache.get(key)
+    if voxel_array is not None:
+        return voxel_array
+
+    voxel_array = stl_to_voxel_array(stl_mesh, voxel_size, num_random_rays=num_random_rays,
+                                     seed=seed, backend=backend, **kwargs)
+    cache.put(key, voxel_array)
+
+    return voxel_array